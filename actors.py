@@ -0,0 +1,137 @@
+"""
+Asynchronous critic / generator training of build_gan (train_async.py), experimental.
+A critic process trains discriminator_model and a generator process trains generator_model at the same time, each
+with its own copy of both networks. They exchange weights through a parameter_store in shared memory: every
+sync_interval own steps an actor publishes its network and pulls the latest one of the other actor.
+ratio > 0 bounds the critic to ratio steps per generator step (0: both run freely).
+Every log_interval steps an actor reports its throughput and staleness: how many steps the other actor has made
+since the weights it trains against were published.
+"""
+import time
+import collections
+import multiprocessing
+import numpy as np
+from keras import backend as K
+from tools import generate_images
+from parallel import build_models, make_data, weights_size, get_flat, set_flat
+
+class parameter_store(object):
+    """ The latest published weights of one network in shared memory, with the publisher's step count (version) """
+    def __init__(self, ctx, size):
+        self.values = ctx.RawArray('f', size)
+        self.version = ctx.RawValue('l', -1)
+        self.lock = ctx.Lock()
+    def attach(self):
+        # numpy view of the shared array, made in the actor process
+        self.view = np.frombuffer(self.values, dtype=np.float32)
+    def publish(self, vector, version):
+        with self.lock:
+            self.view[:] = vector
+            self.version.value = version
+    def pull(self):
+        with self.lock:
+            return self.view.copy(), self.version.value
+
+def actor(role, config, stores, counters, stop, logs):
+    import tensorflow as tf
+    session = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=config['threads'], inter_op_parallelism_threads=1))
+    K.set_session(session)
+    for store in stores.values():
+        store.attach()
+    trainers, (generator, discriminator) = build_models(config)
+    other = 'generator' if role == 'critic' else 'critic'
+    own_weights, other_weights = (discriminator.weights, generator.weights) if role == 'critic' else (generator.weights, discriminator.weights)
+    latent_dim, std, ratio = config['model']['latent_dim'], config['model']['epsilon_std'], config['ratio']
+    np.random.seed(config['data']['seed'] + (1 if role == 'critic' else 2))
+
+    # each actor owns its network: publish the initial weights, wait for the other's
+    stores[role].publish(get_flat(own_weights), 0)
+    while stores[other].version.value < 0:
+        if stop.value:
+            return
+        time.sleep(0.01)
+    vector, other_version = stores[other].pull()
+    set_flat(other_weights, vector)
+
+    if role == 'critic':
+        data = make_data(config)
+        total = config['epochs'] * len(data)
+        data.random_shuffle(0)
+    steps, t_log, staleness, losses = 0, time.time(), 0.0, []
+    while not stop.value:
+        if role == 'critic':
+            if ratio > 0 and steps >= ratio * (counters['generator'].value + 1): # ahead of the generator
+                time.sleep(0.001)
+                continue
+            if steps > 0 and steps % len(data) == 0:
+                data.random_shuffle(steps // len(data))
+            x_batch, _ = data[steps % len(data)]
+            z = np.random.normal(0, std, (len(x_batch), latent_dim)).astype(np.float32)
+            losses.append(np.mean(trainers['discriminator'].train_on_batch([x_batch, z], None)))
+        else:
+            if ratio > 0 and steps * ratio >= counters['critic'].value: # ahead of the critic
+                time.sleep(0.001)
+                continue
+            z = np.random.normal(0, std, (config['batch_size'], latent_dim)).astype(np.float32)
+            losses.append(np.mean(trainers['generator'].train_on_batch(z, None)))
+        steps += 1
+        counters[role].value = steps
+        staleness += counters[other].value - other_version
+        if steps % config['sync_interval'] == 0:
+            stores[role].publish(get_flat(own_weights), steps)
+            vector, other_version = stores[other].pull()
+            set_flat(other_weights, vector)
+        if steps % config['log_interval'] == 0:
+            now = time.time()
+            logs.put((role, steps, config['log_interval'] / (now - t_log), staleness / config['log_interval'], float(np.mean(losses))))
+            t_log, staleness, losses = now, 0.0, []
+        if role == 'generator' and config['preview_path'] is not None and steps % config['preview_iteration'] == 0:
+            h, w, c = config['model']['h'], config['model']['w'], config['model']['c']
+            generate_images(generator, config['preview_path'], h, w, c, latent_dim, std, 15, 15, steps, config['batch_size'], save_weights=False, seed=0)
+        if role == 'critic' and steps == total:
+            stop.value = 1
+    if role == 'generator' and config.get('output') is not None:
+        generator.save(config['output'])
+
+def run(config):
+    """
+    Trains until the critic has seen config['epochs'] epochs. Prints the actors' reports and returns
+    {role: (steps/s, mean staleness)} averaged over all reports.
+    """
+    if config['conditional'] > 0:
+        raise ValueError('the asynchronous mode trains build_gan only')
+    config = dict(config, threads=config.get('threads') or max(1, multiprocessing.cpu_count() // 2))
+    # sizes of the parameter stores, from a copy of the models built here
+    trainers, (generator, discriminator) = build_models(config)
+    sizes = {'generator': weights_size(generator.weights), 'critic': weights_size(discriminator.weights)}
+    K.clear_session()
+
+    ctx = multiprocessing.get_context('spawn') # fresh interpreters: no TF state inherited through fork
+    stores = dict((role, parameter_store(ctx, size)) for role, size in sizes.items())
+    counters = dict((role, ctx.RawValue('l', 0)) for role in sizes)
+    stop = ctx.RawValue('i', 0)
+    logs = ctx.Queue()
+    processes = [ctx.Process(target=actor, name=role, args=(role, config, stores, counters, stop, logs)) for role in ('critic', 'generator')]
+    for p in processes:
+        p.start()
+    reports = collections.defaultdict(list)
+    try:
+        while any(p.is_alive() for p in processes):
+            try:
+                role, steps, rate, staleness, loss = logs.get(timeout=1)
+            except Exception: # queue.Empty: check that no actor has died
+                failed = [p for p in processes if p.exitcode not in (None, 0)]
+                if failed:
+                    stop.value = 1
+                    raise RuntimeError('%s actor exited with code %d'%(failed[0].name, failed[0].exitcode))
+                continue
+            reports[role].append((rate, staleness))
+            print('{:9s} step {:7d}: {:6.1f} steps/s, staleness {:6.1f} {} steps, loss {:.3f}'.format(
+                  role, steps, rate, staleness, 'generator' if role == 'critic' else 'critic', loss))
+    finally:
+        stop.value = 1
+        for p in processes:
+            p.join(timeout=60)
+            if p.is_alive():
+                p.terminate()
+    return dict((role, tuple(np.mean(r, axis=0))) for role, r in reports.items())
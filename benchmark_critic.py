@@ -0,0 +1,49 @@
+import argparse
+parser = argparse.ArgumentParser(description='Time a WGAN-GP critic step with three discriminator passes vs. one batched pass (batched_critic)')
+parser.add_argument('--width', type=int, default=32, required=False,
+                    help='width')
+parser.add_argument('--height', type=int, default=32, required=False,
+                    help='height')
+parser.add_argument('--channels', type=int, default=1, required=False,
+                    help='channels')
+parser.add_argument('--z_dim', type=int, default=100, required=False,
+                    help='latent dimension')
+parser.add_argument('--batch_size', type=int, default=16, required=False,
+                    help='batch size')
+parser.add_argument('--conditional', type=int, default=0, required=False,
+                    help='number of classes: time wgangp_conditional instead of build_gan')
+parser.add_argument('--steps', type=int, default=50, required=False,
+                    help='timed critic steps')
+parser.add_argument('--warmup', type=int, default=5, required=False,
+                    help='untimed critic steps before timing')
+args = parser.parse_args()
+
+import time
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from models import build_gan, wgangp_conditional
+
+h, w, c = args.height, args.width, args.channels
+BS = args.batch_size
+latent_dim = args.z_dim + args.conditional
+x = np.random.uniform(-1, 1, (BS, h, w, c)).astype(np.float32)
+
+times = dict()
+for batched in [False, True]:
+    K.clear_session()
+    np.random.seed(0)
+    tf.set_random_seed(0)
+    if args.conditional > 0:
+        discriminator_model = wgangp_conditional(h=h, w=w, c=c, latent_dim=args.z_dim, condition_dim=args.conditional, dropout_rate=0.2, batched_critic=batched)[1]
+    else:
+        discriminator_model = build_gan(h=h, w=w, c=c, latent_dim=args.z_dim, dropout_rate=0.2, batched_critic=batched)[1]
+    for i in range(args.warmup):
+        discriminator_model.train_on_batch([x, np.random.normal(size=(BS, latent_dim)).astype(np.float32)], None)
+    t0 = time.time()
+    for i in range(args.steps):
+        loss = discriminator_model.train_on_batch([x, np.random.normal(size=(BS, latent_dim)).astype(np.float32)], None)
+    times[batched] = (time.time() - t0) / args.steps
+    print('{:8s}: {:7.2f} ms/step, loss {:.3f}'.format('batched' if batched else 'separate', 1000. * times[batched], np.mean(loss)))
+
+print('per-step time change: {:+.1f}%'.format(100. * (times[True] - times[False]) / times[False]))
@@ -0,0 +1,48 @@
+import argparse
+parser = argparse.ArgumentParser(description='Time a CVAEGAN step with four separate trainers vs. the fused trainer (CVAEGAN(fused=True))')
+parser.add_argument('--dataset', type=str, default='mnist', required=False,
+                    help='mnist/fashion_mnist, with the settings of train_cvaegan_mnist.py / train_cvaegan_fashion_mnist.py')
+parser.add_argument('--batch_size', type=int, default=32, required=False,
+                    help='batch size')
+parser.add_argument('--steps', type=int, default=50, required=False,
+                    help='timed training steps')
+parser.add_argument('--warmup', type=int, default=5, required=False,
+                    help='untimed training steps before timing')
+args = parser.parse_args()
+
+import time
+import numpy as np
+import tensorflow as tf
+import keras
+from keras import backend as K
+from keras.datasets import mnist, fashion_mnist
+from cvaegan import CVAEGAN
+
+w, h, c = 32, 32, 1
+latent_dim = 100
+N_CLASS = 10
+BS = args.batch_size
+reconstruct_loss = 'bce' if args.dataset == 'mnist' else 'l1'
+
+(x_train, y_train), (___, __) = (mnist if args.dataset == 'mnist' else fashion_mnist).load_data()
+x_train = np.squeeze(x_train.astype(np.float32)-127.5) / 127.5
+x_train = np.pad(x_train, ((0,0),(2,2),(2,2)), 'constant', constant_values=-1)[...,np.newaxis]
+y_train = keras.utils.to_categorical(y_train, N_CLASS)
+
+times = dict()
+for fused in [False, True]:
+    K.clear_session()
+    np.random.seed(0)
+    tf.set_random_seed(0)
+    model = CVAEGAN(input_shape=(h, w, c), num_attrs=N_CLASS, z_dims=latent_dim, reconstruct_loss=reconstruct_loss, fused=fused)
+    batches = [np.random.randint(len(x_train), size=BS) for i in range(args.warmup + args.steps)]
+    for ids in batches[:args.warmup]:
+        model.train_on_batch((x_train[ids], y_train[ids]))
+    t0 = time.time()
+    for ids in batches[args.warmup:]:
+        losses = model.train_on_batch((x_train[ids], y_train[ids]))
+    times[fused] = (time.time() - t0) / args.steps
+    print('{:8s}: {:7.2f} ms/step, '.format('fused' if fused else 'separate', 1000. * times[fused]) +
+          ', '.join('{} {:.3f}'.format(k, np.mean(v)) for k, v in sorted(losses.items())))
+
+print('per-step time change: {:+.1f}%'.format(100. * (times[True] - times[False]) / times[False]))
@@ -0,0 +1,34 @@
+import argparse
+parser = argparse.ArgumentParser(description='Compare image decoders of tools.read_image on a directory of real images')
+parser.add_argument('--dataset', type=str, required=True,
+                    help='path to dataset')
+parser.add_argument('--width', type=int, default=96, required=False,
+                    help='width')
+parser.add_argument('--height', type=int, default=96, required=False,
+                    help='height')
+parser.add_argument('--channels', type=int, default=3, required=False,
+                    help='channels')
+parser.add_argument('--n', type=int, default=500, required=False,
+                    help='max. number of images')
+parser.add_argument('--repeat', type=int, default=3, required=False,
+                    help='timing runs per decoder (the best one is reported)')
+args = parser.parse_args()
+
+import time
+import numpy as np
+from tools import file_manifest, read_image
+
+paths = file_manifest(args.dataset)['paths'][:args.n]
+print('%d images, target size %dx%dx%d'%(len(paths), args.height, args.width, args.channels))
+
+outputs = dict()
+for decoder in ['skimage', 'pil']:
+    best = np.inf
+    for r in range(args.repeat):
+        t0 = time.time()
+        imgs = [ read_image(p, args.height, args.width, args.channels, decoder) for p in paths ]
+        best = min(best, time.time() - t0)
+    outputs[decoder] = np.clip(np.asarray(imgs, dtype=np.float32), 0, 255)
+    print('{:8s}: {:8.1f} images/s ({:.2f} ms/image)'.format(decoder, len(paths) / best, 1000. * best / len(paths)))
+
+print('mean abs. difference (pil vs. skimage, 0~255): {:.2f}'.format(np.mean(np.abs(outputs['pil'] - outputs['skimage']))))
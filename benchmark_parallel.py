@@ -0,0 +1,40 @@
+import argparse
+parser = argparse.ArgumentParser(description='Scaling of data-parallel WGAN-GP training (parallel.py) over worker counts, at a fixed batch size')
+parser.add_argument('--workers', type=str, default='1,2,4', required=False,
+                    help='comma separated worker counts (1 is always timed, as the baseline)')
+parser.add_argument('--width', type=int, default=32, required=False,
+                    help='width')
+parser.add_argument('--height', type=int, default=32, required=False,
+                    help='height')
+parser.add_argument('--channels', type=int, default=1, required=False,
+                    help='channels')
+parser.add_argument('--z_dim', type=int, default=100, required=False,
+                    help='latent dimension')
+parser.add_argument('--batch_size', type=int, default=32, required=False,
+                    help='batch size (split over the workers)')
+parser.add_argument('--conditional', type=int, default=0, required=False,
+                    help='number of classes: time wgangp_conditional instead of build_gan')
+parser.add_argument('--threads', type=int, default=0, required=False,
+                    help='TF threads per worker (0: cores / workers)')
+parser.add_argument('--steps', type=int, default=50, required=False,
+                    help='timed training steps')
+parser.add_argument('--warmup', type=int, default=5, required=False,
+                    help='untimed training steps before timing')
+args = parser.parse_args()
+
+# the workers are spawned: they import this script again, without running it
+if __name__ == '__main__':
+    from parallel import run
+
+    config = {'model': {'h': args.height, 'w': args.width, 'c': args.channels, 'latent_dim': args.z_dim, 'epsilon_std': 1.0, 'dropout_rate': 0.2},
+              'data': {'source': 'random', 'seed': 0},
+              'conditional': args.conditional, 'batch_size': args.batch_size, 'epochs': 1, 'd_iter': 5, 'threads': args.threads,
+              'steps': args.steps, 'warmup': args.warmup, 'preview_path': None}
+    counts = sorted(set([1] + [int(n) for n in args.workers.split(',')]))
+    times = dict()
+    for n in counts:
+        result = run(config, n)
+        times[n] = result['seconds_per_step']
+        print('{:2d} workers: {:7.2f} ms/step, {:6.1f} samples/s, speedup {:4.2f}, efficiency {:5.1f}%, allreduce {:4.1f}% of worker time'.format(
+              n, 1000. * times[n], args.batch_size / times[n], times[1] / times[n], 100. * times[1] / times[n] / n,
+              100. * result['allreduce'] / max(result['allreduce'] + result['compute'], 1e-9)))
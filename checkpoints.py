@@ -0,0 +1,187 @@
+import os
+import json
+import pickle
+import shutil
+import threading
+import collections
+import h5py
+import keras
+import numpy as np
+from queue import Queue
+from keras import backend as K
+
+class checkpoint_manager(object):
+    """
+    Rotating checkpoints, written off the training thread.
+    save(step, iteration, epoch, cursor, losses, loop_state, export) reads the weights of step.models() and the optimizer state
+    (iterations, moments, weight norm scalers) of step.trainers() in one session call and returns; a writer thread writes
+        path/iteration_XXXXXXXX/weights.bin   all tensors, back to back (64 byte aligned)
+                                state.json    iteration, epoch, data cursor, metric, index of weights.bin
+                                loop.pkl      loop_state (Trainer counters, running losses, RNG states, step state)
+    (into a .tmp directory that is renamed when complete) and deletes checkpoints that are neither among the
+    keep_last newest nor among the keep_best with the lowest losses[metric].
+    With export (a directory) it also writes export/<name>.h5 of every step.models() network from the same snapshot,
+    in the format of model.save (without optimizer), for load_model in the inference / interpolation scripts.
+    restore(step) memory-maps weights.bin of the newest checkpoint, assigns all tensors in one session call
+    and returns its state (with 'loop'), or None if there is none.
+    """
+    prefix = 'iteration_'
+    align = 64
+    def __init__(self, path, keep_last=3, keep_best=0, metric=None, queue_size=2):
+        self.path = path
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.metric = metric
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.queue = Queue(maxsize=queue_size) # a full queue blocks save(): at most queue_size snapshots in memory
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    def optimizer_weights(self, model):
+        model._make_train_function() # the optimizer's slots are created with the train function
+        return model.optimizer.weights
+    def snapshot(self, step):
+        groups = collections.OrderedDict((name, model.weights) for name, model in step.models().items())
+        for name, model in step.trainers().items():
+            groups['optimizer_'+name] = self.optimizer_weights(model)
+        values = iter(K.batch_get_value([w for weights in groups.values() for w in weights]))
+        return collections.OrderedDict((name, [next(values) for w in weights]) for name, weights in groups.items())
+    def layout(self, model):
+        # what <name>.h5 needs besides the values: the model config and, per layer, its weight names and indices in model.weights
+        index = dict((id(w), i) for i, w in enumerate(model.weights))
+        layers = [(layer.name, [w.name for w in layer.weights], [index[id(w)] for w in layer.weights]) for layer in model.layers]
+        return model.to_json(), layers
+    def save(self, step, iteration, epoch, cursor, losses=None, loop_state=None, export=None):
+        if self.error is not None:
+            raise self.error
+        state = {'iteration': int(iteration), 'epoch': int(epoch), 'cursor': cursor}
+        if self.metric is not None and losses is not None and self.metric in losses:
+            state['metric'] = float(losses[self.metric])
+        layouts = None if export is None else collections.OrderedDict((name, self.layout(model)) for name, model in step.models().items())
+        # loop_state is pickled now: the training thread goes on changing the objects in it
+        self.queue.put((self.snapshot(step), state, pickle.dumps(loop_state, protocol=pickle.HIGHEST_PROTOCOL), export, layouts))
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.write(*item)
+                    self.rotate()
+            except Exception as e: # raised on the training thread by the next save() / close()
+                self.error = e
+            finally:
+                self.queue.task_done()
+    def export(self, path, arrays, layouts):
+        for name, (config, layers) in layouts.items():
+            filename = os.path.join(path, name+'.h5')
+            with h5py.File(filename+'.tmp', 'w') as f:
+                f.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+                f.attrs['backend'] = K.backend().encode('utf8')
+                f.attrs['model_config'] = config.encode('utf8')
+                group = f.create_group('model_weights')
+                group.attrs['layer_names'] = [layer.encode('utf8') for layer, _, _ in layers]
+                group.attrs['keras_version'] = str(keras.__version__).encode('utf8')
+                group.attrs['backend'] = K.backend().encode('utf8')
+                for layer, names, indices in layers:
+                    g = group.create_group(layer)
+                    g.attrs['weight_names'] = [n.encode('utf8') for n in names]
+                    for n, i in zip(names, indices):
+                        g.create_dataset(n, data=arrays[name][i])
+            os.replace(filename+'.tmp', filename) # the previous export stays loadable until this one is complete
+    def write(self, arrays, state, loop_state, export=None, layouts=None):
+        final = os.path.join(self.path, self.prefix + '{:08d}'.format(state['iteration']))
+        tmp = final + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        index, offset = [], 0
+        with open(os.path.join(tmp, 'weights.bin'), 'wb') as fp:
+            for name, values in arrays.items():
+                for value in values:
+                    value = np.ascontiguousarray(value)
+                    padding = -offset % self.align
+                    fp.write(b'\0' * padding)
+                    offset += padding
+                    index.append({'group': name, 'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset})
+                    value.tofile(fp)
+                    offset += value.nbytes
+        state = dict(state, index=index)
+        with open(os.path.join(tmp, 'state.json'), 'w') as fp:
+            json.dump(state, fp)
+        with open(os.path.join(tmp, 'loop.pkl'), 'wb') as fp:
+            fp.write(loop_state)
+        if os.path.exists(final):
+            shutil.rmtree(final)
+        os.rename(tmp, final)
+        if export is not None:
+            self.export(export, arrays, layouts)
+    def checkpoints(self):
+        # [(iteration, directory, state)] of the complete checkpoints, oldest first
+        found = []
+        for name in os.listdir(self.path):
+            directory = os.path.join(self.path, name)
+            if name.startswith(self.prefix) and not name.endswith('.tmp') and os.path.exists(os.path.join(directory, 'state.json')):
+                with open(os.path.join(directory, 'state.json'), 'r') as fp:
+                    state = json.load(fp)
+                found.append((state['iteration'], directory, state))
+        return sorted(found, key=lambda c: c[0])
+    def rotate(self):
+        found = self.checkpoints()
+        keep = set(c[1] for c in found[-self.keep_last:]) if self.keep_last > 0 else set()
+        scored = sorted([c for c in found if 'metric' in c[2]], key=lambda c: c[2]['metric'])
+        keep.update(c[1] for c in scored[:self.keep_best])
+        for c in found:
+            if c[1] not in keep:
+                shutil.rmtree(c[1])
+    def flush(self):
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+    def latest_loop_state(self):
+        # loop.pkl of the newest checkpoint (None if there is none), for a step that has to be set up before restore()
+        self.flush()
+        found = self.checkpoints()
+        if len(found) == 0:
+            return None
+        with open(os.path.join(found[-1][1], 'loop.pkl'), 'rb') as fp:
+            return pickle.load(fp)
+    def restore(self, step):
+        self.flush()
+        found = self.checkpoints()
+        if len(found) == 0:
+            return None
+        iteration, directory, state = found[-1]
+        blob = np.memmap(os.path.join(directory, 'weights.bin'), dtype=np.uint8, mode='r')
+        groups = collections.OrderedDict()
+        for entry in state.pop('index'):
+            dtype, shape = np.dtype(entry['dtype']), tuple(entry['shape'])
+            size = int(np.prod(shape)) * dtype.itemsize
+            groups.setdefault(entry['group'], []).append(blob[entry['offset']:entry['offset']+size].view(dtype).reshape(shape))
+        models = step.models()
+        tensors = collections.OrderedDict((name, model.weights) for name, model in models.items())
+        for name, model in step.trainers().items():
+            tensors['optimizer_'+name] = self.optimizer_weights(model)
+        pairs, missing = [], []
+        for name, weights in tensors.items():
+            if name not in groups and hasattr(models.get(name), 'reset'): # a generator_ema the run was trained without
+                missing.append(models[name])
+                continue
+            values = groups.get(name, [])
+            if len(weights) != len(values):
+                raise ValueError('checkpoint %s has %d tensors for %s, the model has %d'%(directory, len(values), name, len(weights)))
+            pairs += zip(weights, values)
+        K.batch_set_value(pairs)
+        for model in missing: # starts at the restored generator
+            model.reset()
+        with open(os.path.join(directory, 'loop.pkl'), 'rb') as fp:
+            state['loop'] = pickle.load(fp)
+        return state
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -1,5 +1,6 @@
 import os
 import numpy as np
+import tensorflow as tf
 import keras
 from keras.engine.topology import Layer
 from keras.models import Model
@@ -121,18 +122,24 @@ class FeatureMatchingLayer_GD(Layer):
 class FeatureMatchingLayer_GC(Layer):
     __name__ = 'feature_matching_layer_GC'
 
-    def __init__(self, lambda_4=1e-3, **kwargs):
+    def __init__(self, lambda_4=1e-3, segment_sum=False, **kwargs):
         self.is_placeholder = True
         self.lambda_4 = lambda_4
+        self.segment_sum = segment_sum
         super(FeatureMatchingLayer_GC, self).__init__(**kwargs)
+    def class_sums(self, f, y):
+        # (class_n,): per class, the feature mean summed over the samples of that class
+        if self.segment_sum: # one-hot labels: per-sample means summed by class, no (?, class_n) product
+            return tf.unsorted_segment_sum(K.mean(f, axis=1), K.argmax(y, axis=-1), K.int_shape(y)[-1])
+        return K.mean(K.dot(K.transpose(f), y), axis=0)
     def call(self, inputs):
         f1 = K.batch_flatten(inputs[0]) # (batch_size, ?)
         f2 = K.batch_flatten(inputs[1]) # (batch_size, ?)
         y   = inputs[2] # (batch_size, class_n)
         y_p = inputs[3] # (batch_size, class_n)
         
-        f1_ma = K.mean(K.dot(K.transpose(f1), y  ), axis=0)
-        f2_ma = K.mean(K.dot(K.transpose(f2), y_p), axis=0)
+        f1_ma = self.class_sums(f1, y)
+        f2_ma = self.class_sums(f2, y_p)
         
         loss = 0.5 * K.mean(K.square(f1_ma-f2_ma)) * self.lambda_4
         self.add_loss(K.clip(loss, -100, 100), inputs=inputs)
@@ -168,6 +175,8 @@ class CVAEGAN(object):
         lambda_3 = 1.0,   # 1e-3
         lambda_4 = 1.5,   # 1e-3
         reconstruct_loss = 'l1',
+        fused = False,    # one session call for all four updates (see build_fused_trainer)
+        low_memory = False, # condition as a per-channel bias after the encoder's first conv, segment sums in the GC feature matching
         name='cvaegan',
         **kwargs
     ):
@@ -180,6 +189,7 @@ class CVAEGAN(object):
         self.lambda_3 = lambda_3
         self.lambda_4 = lambda_4
         self.reconstruct_loss = reconstruct_loss
+        self.low_memory = low_memory
 
         self.f_enc = None
         self.f_dec = None
@@ -189,15 +199,29 @@ class CVAEGAN(object):
         self.dec_trainer = None
         self.dis_trainer = None
         self.cls_trainer = None
+        self.fused_trainer = None
 
         self.build_model()
+        if fused:
+            self.build_fused_trainer()
 
-    def train_on_batch(self, x_batch):
-        x_r, c = x_batch
-
-        batchsize = len(x_r)
+    def sample_prior(self, batchsize):
         z_p = np.random.normal(size=(batchsize, self.z_dims)).astype('float32')
         c_p = keras.utils.to_categorical(np.random.randint(self.num_attrs, size=batchsize), self.num_attrs)
+        return z_p, c_p
+
+    def train_on_batch(self, x_batch):
+        prior = self.sample_prior(len(x_batch[0]))
+        if self.fused_trainer is not None:
+            return self.train_fused_on_batch(x_batch, prior)
+        loss = self.train_critic_on_batch(x_batch, prior)
+        loss.update(self.train_generator_on_batch(x_batch, prior))
+        return loss
+
+    # the two halves of train_on_batch, so a training loop can time / schedule them separately
+    def train_critic_on_batch(self, x_batch, prior):
+        x_r, c = x_batch
+        z_p, c_p = prior
 
         # Train classifier
         c_loss = self.cls_trainer.train_on_batch([x_r, c], None)
@@ -205,19 +229,41 @@ class CVAEGAN(object):
         # Train discriminator
         d_loss = self.dis_trainer.train_on_batch([x_r, c, c_p, z_p], None)
 
+        return {'d_loss': d_loss, 'c_loss': c_loss}
+
+    def train_generator_on_batch(self, x_batch, prior):
+        x_r, c = x_batch
+        z_p, c_p = prior
+
         # Train generator
         g_loss = self.dec_trainer.train_on_batch([x_r, c, c_p, z_p], None)
-        
+
         # Train autoencoder
         e_loss = self.enc_trainer.train_on_batch([x_r, c, z_p], None)
-        
-        loss = {
-            'g_loss': g_loss,
-            'd_loss': d_loss,
-            'c_loss': c_loss,
-            'e_loss': e_loss
-        }
-        return loss
+
+        return {'g_loss': g_loss, 'e_loss': e_loss}
+
+    def train_fused_on_batch(self, x_batch, prior):
+        x_r, c = x_batch
+        z_p, c_p = prior
+        c_loss, d_loss, g_loss, e_loss = self.fused_trainer([x_r, c, c_p, z_p, 1])
+        return {'c_loss': c_loss, 'd_loss': d_loss, 'g_loss': g_loss, 'e_loss': e_loss}
+
+    def build_fused_trainer(self):
+        # The four trainers share one graph: encoder, decoder for x_f and x_p, discriminator and classifier passes.
+        # fused_trainer([x_r, c, c_p, z_p, 1]) evaluates it once and applies the four optimizers to their own weights in one call.
+        # All gradients are taken before any update, so every update sees the weights before the step
+        # (train_on_batch runs them one after another and the later trainers see the earlier updates).
+        trainers = [self.cls_trainer, self.dis_trainer, self.dec_trainer, self.enc_trainer]
+        grads = []
+        for trainer in trainers:
+            params = trainer._collected_trainable_weights
+            grads.append(trainer.optimizer.get_gradients(trainer.total_loss, params))
+        updates = []
+        with tf.control_dependencies([trainer.total_loss for trainer in trainers] + [g for gs in grads for g in gs]):
+            for trainer, gs in zip(trainers, grads):
+                updates += trainer.optimizer.get_updates_from_grads(trainer._collected_trainable_weights, gs) + trainer.updates
+        self.fused_trainer = K.function(self.dis_trainer.inputs + [K.learning_phase()], [trainer.total_loss for trainer in trainers], updates=updates)
 
     def predict(self, z_samples):
         return self.f_dec.predict(z_samples)
@@ -257,7 +303,7 @@ class CVAEGAN(object):
 
         g_loss = GeneratorLossLayer(reconstruct_loss=self.reconstruct_loss, lambda_2 = self.lambda_2)([x_r, x_f, f_D_x_r, f_D_x_f, f_C_x_r, f_C_x_f])
         gd_loss = FeatureMatchingLayer_GD(lambda_3 = self.lambda_3)([f_D_x_r, f_D_x_p])
-        gc_loss = FeatureMatchingLayer_GC(lambda_4 = self.lambda_4)([f_C_x_r, f_C_x_p, c, c_p])
+        gc_loss = FeatureMatchingLayer_GC(lambda_4 = self.lambda_4, segment_sum = self.low_memory)([f_C_x_r, f_C_x_p, c, c_p])
 
         c_loss = ClassifierLossLayer()([c, c_r])
 
@@ -312,11 +358,19 @@ class CVAEGAN(object):
         x_inputs = Input(shape=self.input_shape)
         c_inputs = Input(shape=(self.num_attrs,))
 
-        c = Reshape((1, 1, self.num_attrs))(c_inputs)
-        c = UpSampling2D(size=self.input_shape[:2])(c)
-        x = Concatenate(axis=-1)([x_inputs, c])
+        if self.low_memory:
+            # the tiled condition channels only add a (per-channel) constant to the first conv's output:
+            # add it as a bias instead of concatenating num_attrs full-resolution channels to the image
+            x = conv(f=128, k=k, stride=2)(x_inputs)
+            c = Dense(128, use_bias=False)(c_inputs)
+            c = Reshape((1, 1, 128))(c)
+            x = Lambda(lambda xs: xs[0] + xs[1], output_shape=lambda shapes: shapes[0])([x, c])
+        else:
+            c = Reshape((1, 1, self.num_attrs))(c_inputs)
+            c = UpSampling2D(size=self.input_shape[:2])(c)
+            x = Concatenate(axis=-1)([x_inputs, c])
 
-        x = conv(f=128, k=k, stride=2)(x)
+            x = conv(f=128, k=k, stride=2)(x)
         x = LeakyReLU(0.2) (x)
         x = conv(f=256, k=k, stride=2)(x)
         x = LeakyReLU(0.2) (x)
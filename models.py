@@ -6,12 +6,15 @@ from keras.layers.merge import _Merge
 from keras.layers import Input, Add, Activation, Dense, Reshape, Flatten, GlobalAveragePooling2D, LeakyReLU, GaussianNoise
 from keras.layers.core import Dropout, Lambda
 from keras.layers.convolutional import Conv2D, Conv2DTranspose, UpSampling2D, ZeroPadding2D
+from keras.layers.pooling import AveragePooling2D
+from keras.engine.topology import Layer
 from keras.layers.merge import concatenate
 from keras.regularizers import l2
 from keras import metrics
 from keras import backend as K
 from pixel_shuffler import PixelShuffler
 import tensorflow as tf
+from tensorflow.python.ops import resource_variable_ops
 from weightnorm import AdamWithWeightnorm
 
 def RandomWeightedAverage():
@@ -21,6 +24,134 @@ def RandomWeightedAverage():
         return (weights * input1) + ((1 - weights) * input2)
     return Lambda(block)
 
+def augment_images_graph(x, flip_prob=0.3, affine_prob=0.2, max_rotate=3., max_shear=2., max_add=2., max_hue=2., max_mul=0.01):
+    # in-graph counterpart of tools.get_imgaug(). x: float32 images in [0, 255], shape (n, h, w, c)
+    n = tf.shape(x)[0]
+    h, w, c = K.int_shape(x)[1:]
+    
+    # horizontal flip
+    flip = tf.random_uniform((n,)) < flip_prob
+    x = tf.where(flip, tf.reverse(x, axis=[2]), x)
+    
+    # small rotate / shear around the image center, constant fill with a random value in (10, 245)
+    use_affine = K.cast(tf.random_uniform((n,)) < affine_prob, 'float32')
+    angle = use_affine * tf.random_uniform((n,), -max_rotate, max_rotate) * (np.pi / 180.)
+    shear = tf.tan(use_affine * tf.random_uniform((n,), -max_shear, max_shear) * (np.pi / 180.))
+    cos_a, sin_a = tf.cos(angle), tf.sin(angle)
+    cx, cy = (w-1) / 2., (h-1) / 2.
+    a0, a1 = cos_a + shear * sin_a, sin_a - shear * cos_a # inverse of (rotate, then shear): maps output -> input coordinates
+    b0, b1 = -sin_a, cos_a
+    a2 = cx - a0 * cx - a1 * cy
+    b2 = cy - b0 * cx - b1 * cy
+    zeros = tf.zeros_like(angle)
+    transforms = tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
+    mask = tf.contrib.image.transform(tf.ones_like(x[...,:1]), transforms, interpolation='NEAREST')
+    cval = tf.random_uniform((n, 1, 1, 1), 10., 245.)
+    x = tf.contrib.image.transform(x, transforms, interpolation='BILINEAR') + (1. - mask) * cval
+    
+    # 0~3 of: brightness (add), hue/saturation, multiply. each one is applied to ~50% of the images
+    def sometimes(shape):
+        return K.cast(tf.random_uniform(shape) < 0.5, 'float32')
+    per_channel = sometimes((n, 1, 1, 1))
+    add = tf.random_uniform((n, 1, 1, c), -max_add, max_add) * per_channel + tf.random_uniform((n, 1, 1, 1), -max_add, max_add) * (1. - per_channel)
+    x = x + add * sometimes((n, 1, 1, 1))
+    if c == 3:
+        hsv = tf.image.rgb_to_hsv(K.clip(x, 0., 255.) / 255.)
+        use_hue = sometimes((n, 1, 1))
+        hue = hsv[...,0] + use_hue * tf.random_uniform((n, 1, 1), -max_hue, max_hue) / 180. # hue in (0, 180) as in imgaug/OpenCV
+        sat = hsv[...,1] + use_hue * tf.random_uniform((n, 1, 1), -max_hue, max_hue) / 255.
+        hsv = tf.stack([tf.mod(hue, 1.), K.clip(sat, 0., 1.), hsv[...,2]], axis=-1)
+        x = tf.image.hsv_to_rgb(hsv) * 255.
+    mul = tf.random_uniform((n, 1, 1, 1), 1.-max_mul, 1.+max_mul)
+    x = x * (1. + (mul - 1.) * sometimes((n, 1, 1, 1)))
+    
+    x = K.clip(x, 0., 255.)
+    x.set_shape((None, h, w, c))
+    return x
+
+def BatchConcat():
+    # equally sized batches -> one batch
+    return Lambda(lambda xs: K.concatenate(xs, axis=0), output_shape=lambda shapes: shapes[0])
+
+def BatchSplit(k):
+    # BatchSplit(k)([joined] + parts): the k-th part of a batch joined by BatchConcat (parts may differ in size)
+    def block(xs):
+        sizes = [K.shape(x)[0] for x in xs[1:]]
+        start = sum(sizes[:k])
+        return xs[0][start:start+sizes[k]]
+    return Lambda(block, output_shape=lambda shapes: shapes[0])
+
+def SubBatch(fraction):
+    # the first ceil(fraction * batch size) samples of a batch
+    def block(x):
+        n = K.cast(K.ceil(fraction * K.cast(K.shape(x)[0], 'float32')), 'int32')
+        return x[:n]
+    return Lambda(block, output_shape=lambda s: s)
+
+def critic_outputs(discriminator, samples, batched=False):
+    # discriminator(x) for every x in samples. batched: a single pass over the samples joined along the batch axis,
+    # the outputs are split back per sample tensor. Every sample is scored on its own (no batch statistics),
+    # so gradients w.r.t. one of the inputs (the gradient penalty) only see its own slice.
+    if not batched:
+        return [discriminator(x) for x in samples]
+    outputs = discriminator(BatchConcat()(samples))
+    outputs = outputs if isinstance(outputs, list) else [outputs]
+    split = [[BatchSplit(k)([o] + samples) for o in outputs] for k in range(len(samples))]
+    return [s if len(s)>1 else s[0] for s in split]
+
+def critic_graph(discriminator, real_images, generated_samples, gradient_penalty_weight, batched=False, penalty=True, penalty_fraction=1.0):
+    # WGAN-GP critic loss: mean(D(real)) - mean(D(generated)) (+ the gradient penalty at random interpolates,
+    # taken on the first penalty_fraction of the batch). Returns the loss and D's outputs for real, generated (, interpolated) samples
+    samples = [real_images, generated_samples]
+    if penalty:
+        if penalty_fraction < 1:
+            averaged_samples = RandomWeightedAverage()([SubBatch(penalty_fraction)(real_images), SubBatch(penalty_fraction)(generated_samples)])
+        else:
+            averaged_samples = RandomWeightedAverage()([real_images, generated_samples])
+        samples.append(averaged_samples)
+    outputs = critic_outputs(discriminator, samples, batched)
+    scores = [o[0] if isinstance(o, list) else o for o in outputs]
+    loss = K.mean(scores[0]) - K.mean(scores[1])
+    if penalty:
+        loss += gradient_penalty_loss(scores[2], averaged_samples, gradient_penalty_weight)
+    return loss, outputs
+
+def compile_critic(discriminator, inputs, real_images, generated_samples, optimizer, gradient_penalty_weight, batched=False,
+                   gp_interval=1, gp_batch_fraction=1.0, feature_loss=None):
+    # a trainable WGAN-GP critic (see critic_graph) with inputs -> D's scores for real, generated (, interpolated) samples.
+    # gp_interval > 1 (lazy regularization): the model has the penalty, weighted by gp_interval, and is meant for every gp_interval-th
+    # critic step. model.no_penalty (same optimizer state) skips the interpolates and the double-backprop on the other steps.
+    # feature_loss(D's outputs for the real samples): an extra discriminator loss (c_loss of wgangp_conditional)
+    def build(penalty):
+        loss, outputs = critic_graph(discriminator, real_images, generated_samples, gradient_penalty_weight * gp_interval, batched, penalty, gp_batch_fraction)
+        model = Model(inputs, [o[0] if isinstance(o, list) else o for o in outputs])
+        model.add_loss(loss)
+        if feature_loss is not None:
+            model.feature_loss = feature_loss(outputs[0])
+            model.add_loss(model.feature_loss, inputs=[discriminator])
+        model.compile(optimizer=optimizer, loss=None)
+        return model
+    model = build(True)
+    model.gp_interval = gp_interval
+    if gp_interval > 1:
+        model.no_penalty = build(False)
+    return model
+
+def feature_matching_loss(d_hidden, c_hidden):
+    # c_loss of wgangp_conditional: hidden features of the classifier should match the discriminator's
+    ds = K.concatenate([K.flatten(t) for t in d_hidden], axis=-1)
+    cs = K.concatenate([K.flatten(t) for t in c_hidden], axis=-1)
+    return .1 * K.mean(K.square(ds-cs))
+
+def Uint8Preprocess(augment=False):
+    # uint8 [0, 255] -> float32 [-1, 1], optionally with augment_images_graph in between
+    def block(img):
+        x = K.cast(img, 'float32')
+        if augment:
+            x = augment_images_graph(x)
+        return (x - 127.5) / 127.5
+    return Lambda(block, output_shape=lambda s: s)
+
 def set_trainable(model, trainable):
     for layer in model.layers:
         layer.trainable=trainable
@@ -200,15 +331,28 @@ def residual_decoder(h, w, c=3, k=4, latent_dim=2, dropout_rate=0.1):
     model = Model([inputs_], [outputs])
     return model
 
-def build_gan(h=128, w=128, c=3, latent_dim=2, epsilon_std=1.0, dropout_rate=0.1, GRADIENT_PENALTY_WEIGHT=10):
-    
-    optimizer_g = AdamWithWeightnorm(lr=0.0001, beta_1=0.5)
-    optimizer_d = AdamWithWeightnorm(lr=0.0001, beta_1=0.5)
+def build_gan(h=128, w=128, c=3, latent_dim=2, epsilon_std=1.0, dropout_rate=0.1, GRADIENT_PENALTY_WEIGHT=10, uint8_input=False, augment=False, fused_critic_steps=0, batched_critic=False, gp_interval=1, gp_batch_fraction=1.0, reuse_fakes=False, ema_decay=0):
     
     t_h, t_w = h//16, w//16
     generator = residual_decoder(t_h, t_w, c=c, latent_dim=latent_dim, dropout_rate=dropout_rate)
-    
     discriminator = residual_discriminator(h=h,w=w,c=c,dropout_rate=dropout_rate)
+    bundle = compile_gan(generator, discriminator, h, w, c, latent_dim, epsilon_std, GRADIENT_PENALTY_WEIGHT, uint8_input, augment,
+                         fused_critic_steps, batched_critic, gp_interval, gp_batch_fraction, reuse_fakes)
+    # ema_decay > 0: generator_model.ema, a residual_decoder holding the moving average of the generator (see generator_ema)
+    if ema_decay > 0:
+        generator_model, discriminator_model = bundle[:2]
+        generator_model._make_train_function()
+        generator_model.ema = generator_ema(generator, residual_decoder(t_h, t_w, c=c, latent_dim=latent_dim, dropout_rate=dropout_rate),
+                                            ema_decay, [generator_model.train_function, getattr(discriminator_model, 'fused', None)])
+    return bundle
+
+def compile_gan(generator, discriminator, h, w, c, latent_dim, epsilon_std=1.0, GRADIENT_PENALTY_WEIGHT=10, uint8_input=False, augment=False,
+                fused_critic_steps=0, batched_critic=False, gp_interval=1, gp_batch_fraction=1.0, reuse_fakes=False):
+    # the WGAN-GP training models of build_gan for a generator (latent -> h x w x c) and a critic (h x w x c -> score)
+    
+    optimizer_g = AdamWithWeightnorm(lr=0.0001, beta_1=0.5)
+    optimizer_d = AdamWithWeightnorm(lr=0.0001, beta_1=0.5)
+    
     for layer in discriminator.layers:
         layer.trainable = False
     discriminator.trainable = False
@@ -233,22 +377,134 @@ def build_gan(h=128, w=128, c=3, latent_dim=2, epsilon_std=1.0, dropout_rate=0.1
     # The noise seed is run through the generator model to get generated images. Both real and generated images
     # are then run through the discriminator. Although we could concatenate the real and generated images into a
     # single tensor, we don't (see model compilation for why).
-    real_samples = Input(shape=(h, w, c))
+    # With uint8_input=True, real samples are fed as uint8 (1/4 of the float32 feed) and scaled (and augmented) in the graph.
+    real_samples = Input(shape=(h, w, c), dtype='uint8' if uint8_input else 'float32')
+    preprocess = Uint8Preprocess(augment=augment) if uint8_input else None
+    real_images = preprocess(real_samples) if uint8_input else real_samples
     generator_input_for_discriminator = Input(shape=(latent_dim,))
     generated_samples_for_discriminator = generator(generator_input_for_discriminator)
-    discriminator_output_from_generator = discriminator(generated_samples_for_discriminator)
-    discriminator_output_from_real_samples = discriminator(real_samples)
+    # batched_critic: one discriminator pass over real, generated and averaged samples instead of three
+    # gp_interval > 1: lazy gradient penalty, discriminator_model.no_penalty for the steps without it (see compile_critic)
+    discriminator_model = compile_critic(discriminator, [real_samples, generator_input_for_discriminator], real_images, generated_samples_for_discriminator,
+                                         optimizer_d, GRADIENT_PENALTY_WEIGHT, batched_critic, gp_interval, gp_batch_fraction)
+    # reuse_fakes: discriminator_model.on_samples([real samples, generated samples]) takes generated images instead of noise,
+    # so the critic steps between two generator updates can draw them from one block / a replay pool (trainer.fake_pool)
+    if reuse_fakes:
+        generated_samples = Input(shape=(h, w, c))
+        discriminator_model.on_samples = compile_critic(discriminator, [real_samples, generated_samples], real_images, generated_samples,
+                                                        optimizer_d, GRADIENT_PENALTY_WEIGHT, batched_critic, gp_interval, gp_batch_fraction)
 
-    averaged_samples = RandomWeightedAverage()([real_samples, generated_samples_for_discriminator])
-    averaged_samples_out = discriminator(averaged_samples)
-    
-    discriminator_model = Model([real_samples, generator_input_for_discriminator], [discriminator_output_from_real_samples, discriminator_output_from_generator, averaged_samples_out])
-    discriminator_model.add_loss(K.mean(discriminator_output_from_real_samples) - K.mean(discriminator_output_from_generator) + gradient_penalty_loss(averaged_samples_out, averaged_samples, GRADIENT_PENALTY_WEIGHT))
-    discriminator_model.compile(optimizer=optimizer_d, loss=None)
+    # fused_critic_steps > 0: discriminator_model.fused([real batches, 1]) runs fused_critic_steps critic updates + a generator update at once
+    if fused_critic_steps > 0:
+        discriminator_model.fused = fused_gan_step(generator, discriminator, generator_model, discriminator_model, latent_dim, epsilon_std, fused_critic_steps,
+                                                   GRADIENT_PENALTY_WEIGHT, preprocess, 'uint8' if uint8_input else 'float32', batched_critic=batched_critic,
+                                                   gp_interval=gp_interval, gp_batch_fraction=gp_batch_fraction)
 
     return generator_model, discriminator_model, generator, discriminator
 
-def wgangp_conditional(h=128, w=128, c=3, latent_dim=2, condition_dim=10, epsilon_std=1.0, dropout_rate=0.1, GRADIENT_PENALTY_WEIGHT=10):
+class FadeIn(Layer):
+    """ alpha * new + (1 - alpha) * old, for layers faded in by progressive_gan. alpha is a non-trainable weight: K.set_value(layer.alpha, a) """
+    def build(self, input_shape):
+        self.alpha = self.add_weight(name='alpha', shape=(), initializer='zeros', trainable=False)
+        super(FadeIn, self).build(input_shape)
+    def call(self, inputs):
+        return self.alpha * inputs[0] + (1. - self.alpha) * inputs[1]
+    def compute_output_shape(self, input_shape):
+        return input_shape[0]
+
+def progressive_networks(h=128, w=128, c=3, k=4, latent_dim=2, dropout_rate=0.1):
+    """
+    The layers of residual_decoder / residual_discriminator as stage models, shared by all levels of progressive_gan.
+    Level L (0..4) works on (h/16 * 2**L) x (w/16 * 2**L) images:
+    g_stages[0]: latent -> h/16 features, g_stages[L]: level L-1 features -> level L features (one upsampling stage)
+    to_rgb[L]: level L features -> image
+    d_stages[L]: level L features -> level L-1 features (one stride 2 conv), d_stages[0]: h/16 features -> score
+    from_rgb[L]: image -> level L features
+    """
+    t_h, t_w = h//16, w//16
+    def stage(shape, block):
+        inputs = Input(shape=shape)
+        return Model([inputs], [block(inputs)])
+    def size(L, channels):
+        return (t_h * 2**L, t_w * 2**L, channels)
+
+    def g_stem(x):
+        x = Dense(t_h*t_w*512, kernel_regularizer=l2(0.001)) (x)
+        x = LeakyReLU(0.1) (x)
+        x = Reshape((t_h,t_w,512)) (x)
+        return Dropout(dropout_rate) (x)
+    def g_up(f, pixel_shuffle, residual):
+        def block(x):
+            x = PixelShuffler() (x) if pixel_shuffle else up_bilinear() (x)
+            x = Conv2DTranspose(f, k, padding='same') (x)
+            x = LeakyReLU(0.2) (x)
+            return _res_conv(f, k, dropout_rate) (x) if residual else x
+        return block
+    g_channels = [512, 128, 128, 64, 32]
+    g_stages = [stage((latent_dim,), g_stem)]
+    for L, (pixel_shuffle, residual) in enumerate([(False, False), (False, False), (False, True), (True, True)], 1):
+        g_stages.append(stage(size(L-1, g_channels[L-1]), g_up(g_channels[L], pixel_shuffle, residual)))
+    to_rgb = [stage(size(L, g_channels[L]), lambda x: conv(c, k, 1, act='tanh') (x)) for L in range(5)]
+
+    def d_down(f):
+        def block(x):
+            x = conv(f, k, 2) (x)
+            x = LeakyReLU(0.2) (x)
+            return Dropout(dropout_rate) (x)
+        return block
+    def d_head(x):
+        x = _res_conv(512, k, dropout_rate) (x)
+        x = Flatten() (x)
+        return Dense(1, kernel_regularizer=l2(0.001), kernel_initializer='he_normal') (x)
+    def d_from_rgb(f, kernel):
+        def block(x):
+            x = conv(f, kernel, 1) (x)
+            x = LeakyReLU(0.2) (x)
+            return Dropout(dropout_rate) (x)
+        return block
+    d_channels = [256, 256, 128, 64, 32]
+    d_stages = [stage(size(0, d_channels[0]), d_head)] + [stage(size(L, d_channels[L]), d_down(d_channels[L-1])) for L in range(1, 5)]
+    from_rgb = [stage(size(L, c), d_from_rgb(d_channels[L], k if L == 4 else 1)) for L in range(5)]
+    return {'g_stages': g_stages, 'to_rgb': to_rgb, 'd_stages': d_stages, 'from_rgb': from_rgb}
+
+def progressive_gan(networks, level, fade=False, c=3, latent_dim=2, **kwargs):
+    """
+    build_gan at level (see progressive_networks): generator and critic for (h/16 * 2**level)^2 images, made of the
+    shared stages, compiled by compile_gan (kwargs) with new optimizers.
+    fade=True: the new stage of the level is blended with the level below (upsampled output / downsampled input)
+    by FadeIn layers, listed in discriminator_model.fade. Their alpha goes from 0 to 1 during the fade-in.
+    """
+    g_stages, to_rgb, d_stages, from_rgb = networks['g_stages'], networks['to_rgb'], networks['d_stages'], networks['from_rgb']
+    fade = fade and level > 0
+    h, w = K.int_shape(to_rgb[level].outputs[0])[1:3]
+    fade_layers = []
+
+    z = Input(shape=(latent_dim,))
+    x = g_stages[0](z)
+    for L in range(1, level+1):
+        previous, x = x, g_stages[L](x)
+    image = to_rgb[level](x)
+    if fade:
+        fade_layers.append(FadeIn())
+        image = fade_layers[-1]([image, UpSampling2D()(to_rgb[level-1](previous))])
+    generator = Model([z], [image])
+
+    inputs = Input(shape=(h, w, c))
+    x = from_rgb[level](inputs)
+    top = level
+    if fade:
+        fade_layers.append(FadeIn())
+        x = fade_layers[-1]([d_stages[level](x), from_rgb[level-1](AveragePooling2D()(inputs))])
+        top = level-1
+    for L in range(top, 0, -1):
+        x = d_stages[L](x)
+    discriminator = Model([inputs], [d_stages[0](x)])
+
+    generator_model, discriminator_model, generator, discriminator = compile_gan(generator, discriminator, h, w, c, latent_dim, **kwargs)
+    discriminator_model.fade = fade_layers
+    return generator_model, discriminator_model, generator, discriminator
+
+def wgangp_conditional(h=128, w=128, c=3, latent_dim=2, condition_dim=10, epsilon_std=1.0, dropout_rate=0.1, GRADIENT_PENALTY_WEIGHT=10, uint8_input=False, augment=False, fused_critic_steps=0, batched_critic=False, gp_interval=1, gp_batch_fraction=1.0, reuse_fakes=False, joint_classifier=False, ema_decay=0):
     
     optimizer_g = AdamWithWeightnorm(lr=0.0001, beta_1=0.5)
     optimizer_d = AdamWithWeightnorm(lr=0.0001, beta_1=0.5)
@@ -288,37 +544,210 @@ def wgangp_conditional(h=128, w=128, c=3, latent_dim=2, condition_dim=10, epsilo
     # The noise seed is run through the generator model to get generated images. Both real and generated images
     # are then run through the discriminator. Although we could concatenate the real and generated images into a
     # single tensor, we don't (see model compilation for why).
-    real_samples = Input(shape=(h, w, c))
+    # With uint8_input=True, real samples are fed as uint8 (1/4 of the float32 feed) and scaled (and augmented) in the graph.
+    real_samples = Input(shape=(h, w, c), dtype='uint8' if uint8_input else 'float32')
+    preprocess = Uint8Preprocess(augment=augment) if uint8_input else None
+    real_images = preprocess(real_samples) if uint8_input else real_samples
     generator_input_for_discriminator = Input(shape=(latent_dim+condition_dim,))
     generated_samples_for_discriminator = generator(generator_input_for_discriminator)
-    discriminator_output_from_generator = discriminator(generated_samples_for_discriminator)[0]
-    
-    discriminator_output_from_real_samples, d0, d1, d2 = discriminator(real_samples)
-    classifier_output_from_real_samples, c0, c1, c2 = classifier(real_samples)
-    
-    ds = K.concatenate([K.flatten(d0), K.flatten(d1), K.flatten(d2)], axis=-1)
-    cs = K.concatenate([K.flatten(c0), K.flatten(c1), K.flatten(c2)], axis=-1)
-    
-    c_loss = .1 * K.mean(K.square(ds-cs))
-
-    averaged_samples = RandomWeightedAverage()([real_samples, generated_samples_for_discriminator])
-    averaged_samples_out = discriminator(averaged_samples)[0]
-    
-    discriminator_model = Model([real_samples, generator_input_for_discriminator], [discriminator_output_from_real_samples, discriminator_output_from_generator, averaged_samples_out])
-    discriminator_model.add_loss(K.mean(discriminator_output_from_real_samples) - K.mean(discriminator_output_from_generator) + gradient_penalty_loss(averaged_samples_out, averaged_samples, GRADIENT_PENALTY_WEIGHT))
-    discriminator_model.add_loss(c_loss, inputs=[discriminator])
-    discriminator_model.compile(optimizer=optimizer_d, loss=None)
+    classifier_output_from_real_samples, c0, c1, c2 = classifier(real_images)
+    def c_loss(d_real): # hidden features of the classifier and the discriminator on real samples should match
+        return feature_matching_loss(d_real[1:], [c0, c1, c2])
+    
+    # batched_critic: one discriminator pass over real, generated and averaged samples instead of three
+    # gp_interval > 1: lazy gradient penalty, discriminator_model.no_penalty for the steps without it (see compile_critic)
+    discriminator_model = compile_critic(discriminator, [real_samples, generator_input_for_discriminator], real_images, generated_samples_for_discriminator,
+                                         optimizer_d, GRADIENT_PENALTY_WEIGHT, batched_critic, gp_interval, gp_batch_fraction, c_loss)
+    # reuse_fakes: discriminator_model.on_samples([real samples, generated samples]) takes generated images instead of noise,
+    # so the critic steps between two generator updates can draw them from one block / a replay pool (trainer.fake_pool)
+    if reuse_fakes:
+        generated_samples = Input(shape=(h, w, c))
+        discriminator_model.on_samples = compile_critic(discriminator, [real_samples, generated_samples], real_images, generated_samples,
+                                                        optimizer_d, GRADIENT_PENALTY_WEIGHT, batched_critic, gp_interval, gp_batch_fraction, c_loss)
     
     for layer in classifier.layers:
         layer.trainable = True
     classifier.trainable = True
     
     classifier_model = Model([real_samples], [classifier_output_from_real_samples])
-    classifier_model.add_loss(c_loss, inputs=[classifier])
+    classifier_model.add_loss(c_loss(discriminator(real_images)), inputs=[classifier])
     classifier_model.compile(optimizer=optimizer_c, loss='categorical_crossentropy')
 
+    # joint_classifier: critic.joint([real samples, generator input, labels, 1]) for discriminator_model and its variants runs the
+    # critic and the classifier update of a batch in one call, on one classifier pass over the real samples
+    if joint_classifier:
+        critics = [discriminator_model] + ([discriminator_model.on_samples] if reuse_fakes else [])
+        for critic in critics + [critic.no_penalty for critic in critics if hasattr(critic, 'no_penalty')]:
+            critic.joint = joint_critic_step(critic, classifier_model, classifier, classifier_output_from_real_samples, discriminator, real_images, c_loss)
+
+    # fused_critic_steps > 0: discriminator_model.fused([real batches, labels, 1]) runs fused_critic_steps critic + classifier updates
+    # and a generator update at once
+    if fused_critic_steps > 0:
+        discriminator_model.fused = fused_gan_step(generator, discriminator, generator_model, discriminator_model, latent_dim, epsilon_std, fused_critic_steps,
+                                                   GRADIENT_PENALTY_WEIGHT, preprocess, 'uint8' if uint8_input else 'float32',
+                                                   classifier, classifier_model, condition_dim, batched_critic, gp_interval, gp_batch_fraction)
+
+    # ema_decay > 0: generator_model.ema, a residual_decoder holding the moving average of the generator (see generator_ema)
+    if ema_decay > 0:
+        generator_model._make_train_function()
+        generator_model.ema = generator_ema(generator, residual_decoder(t_h, t_w, c=c, latent_dim=latent_dim+condition_dim, dropout_rate=dropout_rate),
+                                            ema_decay, [generator_model.train_function, getattr(discriminator_model, 'fused', None)])
+
     return generator_model, discriminator_model, classifier_model, generator, discriminator, classifier
 
+def regularization_loss(model):
+    # weight regularizers of model's layers, computed from the variables as they are read now
+    # (the tensors in model.losses read them once, at the start of a session call)
+    loss = 0.
+    for layer in model.layers:
+        for attr in ('kernel', 'bias'):
+            regularizer = getattr(layer, attr+'_regularizer', None)
+            if regularizer is not None and getattr(layer, attr, None) is not None:
+                loss += regularizer(getattr(layer, attr))
+    return loss
+
+def apply_gradients(model, loss):
+    # the optimizer updates model.train_on_batch would make for loss (same optimizer state and trainable weights)
+    params = model._collected_trainable_weights
+    return model.optimizer.get_updates_from_grads(params, model.optimizer.get_gradients(loss, params))
+
+def gradient_accumulator(model):
+    """
+    model.train_on_batch for a batch fed as micro-batches, one at a time (activation memory of a micro-batch):
+    accumulate(inputs + targets + sample weights + [learning phase]) adds the gradients of a micro-batch, weighted by its
+    size, to accumulator variables and returns its loss.
+    apply() makes one optimizer update with their weighted mean and clears them. The losses (WGAN, gradient penalty,
+    classifier, feature matching) are means over the samples, so this is the gradient of the whole batch.
+    """
+    params = model._collected_trainable_weights
+    n = K.cast(K.shape(model._feed_inputs[0])[0], 'float32')
+    grads = model.optimizer.get_gradients(model.total_loss, params)
+    accumulators = [K.zeros(K.int_shape(p)) for p in params]
+    count = K.variable(0.)
+    accumulate = K.function(model._feed_inputs + model._feed_targets + model._feed_sample_weights + [K.learning_phase()], [model.total_loss],
+                            updates=[K.update_add(a, n * g) for a, g in zip(accumulators, grads)] + [K.update_add(count, n)] + model.updates)
+    updates = model.optimizer.get_updates_from_grads(params, [a / count for a in accumulators])
+    with tf.control_dependencies(updates): # clear after the update has read them
+        clear = [K.update(a, K.zeros_like(a)) for a in accumulators] + [K.update(count, 0.)]
+    apply = K.function([], [], updates=clear)
+    if hasattr(model, 'ema'): # generator_model of build_gan / wgangp_conditional(ema_decay > 0)
+        model.ema.follow(apply)
+    return accumulate, apply
+
+def joint_critic_step(critic, classifier_model, classifier, classifier_output, discriminator, real_images, c_loss):
+    """
+    A K.function for the critic and the classifier update of wgangp_conditional on the same real batch.
+    inputs:  critic.inputs + [labels, learning phase]
+    outputs: [critic loss, classifier loss], as critic / classifier_model.train_on_batch would return them
+    Same losses as the split steps: the classifier loss is taken under a control dependency on the critic update, its
+    feature matching term c_loss(discriminator(real_images)) reads the updated discriminator. The classifier pass over the
+    real samples (classifier_output, the features in c_loss) is shared, the critic update does not change it.
+    The reads after the critic update need resource variables: call tf.enable_resource_variables() before the models are built.
+    """
+    for weight in discriminator.weights:
+        if not isinstance(weight, resource_variable_ops.ResourceVariable):
+            raise ValueError('joint steps need resource variables: call tf.enable_resource_variables() before building the models')
+    labels = K.placeholder((None, K.int_shape(classifier_output)[-1]))
+    d_loss = critic.total_loss
+    d_params, c_params = critic._collected_trainable_weights, classifier_model._collected_trainable_weights
+    d_grads = critic.optimizer.get_gradients(d_loss, d_params)
+    with tf.control_dependencies([d_loss] + d_grads):
+        d_updates = critic.optimizer.get_updates_from_grads(d_params, d_grads)
+    with tf.control_dependencies(d_updates):
+        classifier_loss = K.mean(K.categorical_crossentropy(labels, classifier_output)) + c_loss(discriminator(real_images)) + regularization_loss(classifier)
+        c_updates = classifier_model.optimizer.get_updates_from_grads(c_params, classifier_model.optimizer.get_gradients(classifier_loss, c_params))
+    return K.function(critic.inputs + [labels, K.learning_phase()], [d_loss, classifier_loss], updates=d_updates + c_updates + critic.updates + classifier_model.updates)
+
+def fused_gan_step(generator, discriminator, generator_model, discriminator_model, latent_dim, epsilon_std, d_iter,
+                   GRADIENT_PENALTY_WEIGHT=10, preprocess=None, real_dtype='float32',
+                   classifier=None, classifier_model=None, condition_dim=0, batched_critic=False, gp_interval=1, gp_batch_fraction=1.0):
+    """
+    A K.function that runs d_iter critic updates (+ classifier updates) and one generator update in a single session call.
+    inputs:  [real batches (d_iter, batch_size, h, w, c), (labels (d_iter, batch_size, condition_dim),) learning phase]
+    outputs: [critic losses (d_iter,), (classifier losses (d_iter,),) generator loss]
+    Noise and conditions are sampled in the graph. Each update is built under control dependencies on the one before,
+    so it sees the weights that update wrote. That only holds for resource variables (their reads are ops of their own),
+    call tf.enable_resource_variables() before the models are built.
+    """
+    for weight in generator.weights + discriminator.weights + ([] if classifier is None else classifier.weights):
+        if not isinstance(weight, resource_variable_ops.ResourceVariable):
+            raise ValueError('fused steps need resource variables: call tf.enable_resource_variables() before building the models')
+    h, w, c = K.int_shape(discriminator.inputs[0])[1:]
+    real_block = K.placeholder((d_iter, None, h, w, c), dtype=real_dtype)
+    label_block = K.placeholder((d_iter, None, condition_dim)) if classifier is not None else None
+    n = tf.shape(real_block)[1]
+
+    def first(outputs): # critic score (the conditional critics also return hidden features)
+        return outputs[0] if isinstance(outputs, list) else outputs
+    def make_some_noise():
+        z = K.random_normal((n, latent_dim), 0., epsilon_std)
+        if classifier is None:
+            return z, None
+        condition = tf.one_hot(tf.random_uniform((n,), 0, condition_dim, dtype=tf.int32), condition_dim)
+        return K.concatenate([z, condition], axis=-1), condition
+
+    # lazy gradient penalty: only on the critic steps k % gp_interval == 0 of a call,
+    # scaled so that the penalty weight per call stays d_iter * GRADIENT_PENALTY_WEIGHT
+    penalized = list(range(0, d_iter, gp_interval))
+    gp_weight = GRADIENT_PENALTY_WEIGHT * float(d_iter) / len(penalized)
+    after = []
+    d_losses, c_losses = [], []
+    for k in range(d_iter):
+        with tf.control_dependencies(after):
+            real = real_block[k] if preprocess is None else preprocess(real_block[k])
+            z, _ = make_some_noise()
+            fake = generator(z)
+            d_loss, d_outputs = critic_graph(discriminator, real, fake, gp_weight, batched_critic, k in penalized, gp_batch_fraction)
+            d_loss += regularization_loss(discriminator)
+            if classifier is not None:
+                d_loss += feature_matching_loss(d_outputs[0][1:], classifier(real)[1:])
+            d_losses.append(d_loss)
+            after = [tf.group(*apply_gradients(discriminator_model, d_loss))]
+        if classifier is not None: # the classifier step of the same batch, after the critic step
+            with tf.control_dependencies(after):
+                real = real_block[k] if preprocess is None else preprocess(real_block[k])
+                c_real = classifier(real)
+                c_loss = K.mean(K.categorical_crossentropy(label_block[k], c_real[0])) + feature_matching_loss(discriminator(real)[1:], c_real[1:]) \
+                       + regularization_loss(classifier)
+                c_losses.append(c_loss)
+                after = [tf.group(*apply_gradients(classifier_model, c_loss))]
+    with tf.control_dependencies(after):
+        z, condition = make_some_noise()
+        fake = generator(z)
+        g_loss = K.mean(first(discriminator(fake))) + regularization_loss(generator)
+        if classifier is not None:
+            g_loss += K.mean(K.categorical_crossentropy(condition, classifier(fake)[0]))
+        after = [tf.group(*apply_gradients(generator_model, g_loss))]
+
+    inputs = [real_block] + ([] if classifier is None else [label_block]) + [K.learning_phase()]
+    outputs = [K.stack(d_losses)] + ([] if classifier is None else [K.stack(c_losses)]) + [g_loss]
+    return K.function(inputs, outputs, updates=after)
+
+def generator_ema(generator, shadow, decay, functions):
+    """
+    Keeps shadow (a network built like generator) at the exponential moving average of generator's weights:
+    shadow = decay * shadow + (1 - decay) * generator, as assign ops that run at the end of every call of functions
+    (the K.functions that update the generator: generator_model.train_function, fused_gan_step), after their updates.
+    The average never leaves the graph. shadow starts at the current weights of generator and is saved / previewed /
+    loaded by inference.py like the generator itself. shadow.follow(function) adds a K.function made later (gradient_accumulator),
+    shadow.reset() restarts the average at the current weights of generator (a resumed run trained without it).
+    """
+    for layer in shadow.layers:
+        layer.trainable = False
+    shadow.trainable = False
+    copy = tf.group(*[tf.assign(s, w) for s, w in zip(shadow.weights, generator.weights)])
+    shadow.reset = lambda: K.get_session().run(copy)
+    shadow.reset()
+    def follow(function):
+        with tf.control_dependencies([function.updates_op]): # read_value(): a read of the updated weights, not the variable's snapshot
+            averages = [tf.assign(s, decay * s.read_value() + (1. - decay) * w.read_value()) for s, w in zip(shadow.weights, generator.weights)]
+        function.updates_op = tf.group(*averages) # the callable of a K.function is made at its first call
+    for function in functions:
+        if function is not None:
+            follow(function)
+    shadow.follow = follow
+    return shadow
+
 def make_encoder(decoder):
     latent_dim = decoder.input_shape[-1]
     h, w, c = decoder.output_shape[-3:]
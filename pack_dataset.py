@@ -0,0 +1,27 @@
+import argparse
+parser = argparse.ArgumentParser(description='Pack an image directory into shards for shard_generator')
+parser.add_argument('--dataset', type=str, required=True,
+                    help='path to dataset (tags are taken from the parent directories)')
+parser.add_argument('--output', type=str, required=True,
+                    help='output directory')
+parser.add_argument('--shard_size', type=int, default=256, required=False,
+                    help='shard size in MB')
+parser.add_argument('--raw', action='store_true', default=False,
+                    help='store decoded + resized uint8 images instead of the encoded files')
+parser.add_argument('--width', type=int, default=96, required=False,
+                    help='width (--raw only)')
+parser.add_argument('--height', type=int, default=96, required=False,
+                    help='height (--raw only)')
+parser.add_argument('--channels', type=int, default=3, required=False,
+                    help='channels (--raw only)')
+parser.add_argument('--manifest', type=str, default=None, required=False,
+                    help='file listing of the dataset (.npz), written once and updated incrementally')
+parser.add_argument('--decoder', type=str, default='skimage', required=False,
+                    help='image decoder for --raw: skimage/pil')
+parser.add_argument('--seed', type=int, default=None, required=False,
+                    help='seed of the packing order')
+args = parser.parse_args()
+
+from tools import pack_shards
+
+pack_shards(args.dataset, args.output, shard_size=args.shard_size*1024*1024, raw=args.raw, height=args.height, width=args.width, channel=args.channels, manifest_path=args.manifest, seed=args.seed, decoder=args.decoder)
@@ -0,0 +1,240 @@
+"""
+Data-parallel WGAN-GP training on the CPU cores of one host (train_parallel.py, benchmark_parallel.py).
+Every worker process builds the same models (build_gan / wgangp_conditional), starts from the weights of worker 0
+and trains on its shard of every batch. The gradients (and losses) of a step are averaged through shared memory
+(shared_gradients.allreduce) and every replica applies the average with its own AdamWithWeightnorm: same weights,
+same optimizer state and the same update, so the replicas stay identical.
+The WGAN loss, the gradient penalty and the classifier loss are batch means, so the average over equal shards is the
+gradient of the whole batch (batch_size has to be a multiple of the number of workers).
+"""
+import os
+import time
+import collections
+import multiprocessing
+import numpy as np
+from keras import backend as K
+from keras.utils import to_categorical
+from models import build_gan, wgangp_conditional
+from tools import array_generator, data_generator, generate_images, generate_images_cgan
+
+class shared_gradients(object):
+    """
+    Shared-memory allreduce of one float32 vector per worker: every worker writes its row, averages its
+    1/workers chunk of the columns into the result, and after a second barrier all workers read the result.
+    """
+    def __init__(self, ctx, workers, size, timeout=None):
+        self.workers, self.size = workers, size
+        self.rows = ctx.RawArray('f', workers * size)
+        self.result = ctx.RawArray('f', size)
+        self.barrier = ctx.Barrier(workers, timeout=timeout) # a crashed worker breaks the barrier instead of hanging the others
+        self.bounds = np.linspace(0, size, workers+1).astype(int)
+    def attach(self):
+        # numpy views of the shared arrays, made in the worker process
+        self.rows_view = np.frombuffer(self.rows, dtype=np.float32).reshape(self.workers, self.size)
+        self.result_view = np.frombuffer(self.result, dtype=np.float32)
+    def allreduce(self, rank, vector):
+        self.rows_view[rank] = vector
+        self.barrier.wait()
+        lo, hi = self.bounds[rank], self.bounds[rank+1]
+        np.mean(self.rows_view[:, lo:hi], axis=0, out=self.result_view[lo:hi])
+        self.barrier.wait()
+        return self.result_view.copy()
+    def broadcast(self, rank, vector=None, root=0):
+        if rank == root:
+            self.rows_view[root] = vector
+        self.barrier.wait()
+        vector = self.rows_view[root].copy()
+        self.barrier.wait()
+        return vector
+
+def weights_size(weights):
+    return sum(int(np.prod(K.int_shape(w))) for w in weights)
+
+def get_flat(weights):
+    # the values of weights as one float32 vector (one session call)
+    return np.concatenate([v.ravel() for v in K.batch_get_value(weights)]).astype(np.float32)
+
+def set_flat(weights, vector):
+    # inverse of get_flat (one session call)
+    offsets = np.cumsum([0] + [int(np.prod(K.int_shape(w))) for w in weights])
+    K.batch_set_value([(w, vector[offsets[i]:offsets[i+1]].reshape(K.int_shape(w))) for i, w in enumerate(weights)])
+
+def gradient_size(model):
+    # length of the vectors of gradient_functions(model): all trainable weights + the loss
+    return sum(int(np.prod(K.int_shape(p))) for p in model._collected_trainable_weights) + 1
+
+def gradient_functions(model):
+    """
+    The two halves of model.train_on_batch:
+    gradients(inputs + targets + sample weights + [learning phase]) -> [gradients of all trainable weights and the loss, as one vector]
+    apply([vector]) -> the optimizer update of model with those gradients (the loss at the end is ignored)
+    """
+    params = model._collected_trainable_weights
+    grads = model.optimizer.get_gradients(model.total_loss, params)
+    flat = K.concatenate([K.flatten(g) for g in grads] + [K.reshape(model.total_loss, (1,))])
+    gradients = K.function(model._feed_inputs + model._feed_targets + model._feed_sample_weights + [K.learning_phase()], [flat])
+    vector = K.placeholder((gradient_size(model),))
+    applied, offset = [], 0
+    for p in params:
+        shape = K.int_shape(p)
+        applied.append(K.reshape(vector[offset:offset+int(np.prod(shape))], shape))
+        offset += int(np.prod(shape))
+    apply = K.function([vector], [], updates=model.optimizer.get_updates_from_grads(params, applied))
+    return gradients, apply
+
+def build_models(config):
+    # name -> compiled model (generator, discriminator, classifier), [networks]
+    if config['conditional'] > 0:
+        generator_model, discriminator_model, classifier_model, generator, discriminator, classifier = \
+            wgangp_conditional(condition_dim=config['conditional'], **config['model'])
+        return collections.OrderedDict([('generator', generator_model), ('discriminator', discriminator_model), ('classifier', classifier_model)]), \
+               [generator, discriminator, classifier]
+    generator_model, discriminator_model, generator, discriminator = build_gan(**config['model'])
+    return collections.OrderedDict([('generator', generator_model), ('discriminator', discriminator_model)]), [generator, discriminator]
+
+def make_data(config):
+    """
+    config['data']['source']: 'random' (benchmarks), 'mnist' / 'fashion_mnist' (32x32, as wgangp_mnist.py) or a dataset path.
+    Every worker makes the same seeded generator, so all of them see the same batch order.
+    """
+    source, seed, bs = config['data']['source'], config['data']['seed'], config['batch_size']
+    h, w, c = config['model']['h'], config['model']['w'], config['model']['c']
+    if source == 'random':
+        random = np.random.RandomState(seed)
+        x = random.uniform(-1, 1, (config['data'].get('samples', 16*bs), h, w, c)).astype(np.float32)
+        y = to_categorical(random.randint(max(config['conditional'], 1), size=len(x)), max(config['conditional'], 1))
+        return array_generator(x, y, batch_size=bs, seed=seed)
+    if source in ('mnist', 'fashion_mnist'):
+        from keras.datasets import mnist, fashion_mnist
+        (x, y), (___, __) = (mnist if source == 'mnist' else fashion_mnist).load_data()
+        x = np.squeeze(x.astype(np.float32)-127.5) / 127.5
+        x = np.pad(x, ((0,0),(2,2),(2,2)), 'constant', constant_values=-1)[...,np.newaxis]
+        return array_generator(x, to_categorical(y, 10), batch_size=bs, seed=seed)
+    return data_generator(source, height=h, width=w, channel=c, batch_size=bs, shuffle=True, cache_path=config['data'].get('cache'), seed=seed)
+
+def shard(data, idx, rank, workers):
+    # worker rank's part of batch idx (the ids of data[idx], as in array_generator / data_generator.__getitem__)
+    r_bound = min(len(data.index), (idx+1) * data.bs)
+    ids = data.index[r_bound - data.bs:r_bound]
+    return data.get_items(np.array_split(ids, workers)[rank])
+
+def worker(rank, workers, config, buffers, results):
+    import tensorflow as tf
+    session = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=config['threads'], inter_op_parallelism_threads=1))
+    K.set_session(session)
+    for buffer in buffers.values():
+        buffer.attach()
+    trainers, networks = build_models(config)
+    functions = collections.OrderedDict((name, gradient_functions(model)) for name, model in trainers.items())
+    sample_weights = dict((name, len(model._feed_sample_weights)) for name, model in trainers.items())
+
+    # start from worker 0's weights
+    weights = [w for net in networks for w in net.weights]
+    set_flat(weights, buffers['weights'].broadcast(rank, get_flat(weights) if rank == 0 else None))
+
+    latent_dim, std, d_iter, conditional = config['model']['latent_dim'], config['model']['epsilon_std'], config['d_iter'], config['conditional']
+    np.random.seed(config['data']['seed'] + 1 + rank) # a different noise shard per worker
+    timing = {'compute': 0.0, 'allreduce': 0.0}
+    def step(name, inputs, targets=[]):
+        t0 = time.time()
+        n = len(inputs[0])
+        vector = functions[name][0](inputs + targets + [np.ones(n, dtype=np.float32)] * sample_weights[name] + [1])[0]
+        t1 = time.time()
+        vector = buffers[name].allreduce(rank, vector)
+        t2 = time.time()
+        functions[name][1]([vector])
+        timing['compute'] += (t1 - t0) + (time.time() - t2)
+        timing['allreduce'] += t2 - t1
+        return vector[-1]
+    def make_some_noise(n):
+        z = np.random.normal(0, std, (n, latent_dim)).astype(np.float32)
+        if conditional == 0:
+            return z, None
+        condition = to_categorical(np.random.randint(conditional, size=(n,)), conditional)
+        return np.append(z, condition, axis=-1), condition
+
+    data = make_data(config)
+    total = config['epochs'] * len(data) if config.get('steps') is None else config['warmup'] + config['steps']
+    progress = None
+    if rank == 0 and config.get('steps') is None:
+        from tqdm import tqdm
+        progress = tqdm(total=total)
+    loss_sums = collections.OrderedDict()
+    iteration, t_start = 0, None
+    while iteration < total:
+        data.random_shuffle(iteration // len(data))
+        for i in range(len(data)):
+            if iteration == total:
+                break
+            if config.get('steps') is not None and iteration == config['warmup']: # benchmark: time after warmup
+                t_start = time.time()
+                timing = {'compute': 0.0, 'allreduce': 0.0}
+            x_batch, y_batch = shard(data, i, rank, workers)
+            losses = collections.OrderedDict()
+            z, _ = make_some_noise(len(x_batch))
+            losses['DL'] = step('discriminator', [x_batch, z])
+            if conditional > 0:
+                losses['CL'] = step('classifier', [x_batch], [y_batch])
+            if (iteration+1) % d_iter == 0:
+                z, condition = make_some_noise(len(x_batch))
+                losses['GL'] = step('generator', [z], [] if condition is None else [condition])
+            iteration += 1
+            if progress is not None:
+                for k, v in losses.items():
+                    loss_sums[k] = 0.98 * loss_sums.get(k, v) + 0.02 * v
+                progress.set_description(', '.join('{}: {:.2f}'.format(k, v) for k, v in loss_sums.items()))
+                progress.update()
+                if config['preview_path'] is not None and iteration % config['preview_iteration'] == 0:
+                    h, w, c = config['model']['h'], config['model']['w'], config['model']['c']
+                    if conditional > 0:
+                        generate_images_cgan(networks[0], config['preview_path'], h, w, c, latent_dim, std, 5, conditional, iteration, save_weights=False, seed=0)
+                    else:
+                        generate_images(networks[0], config['preview_path'], h, w, c, latent_dim, std, 15, 15, iteration, config['batch_size'], save_weights=False, seed=0)
+    if progress is not None:
+        progress.close()
+    if rank == 0:
+        if config.get('output') is not None:
+            networks[0].save(config['output'])
+        result = dict(timing)
+        if t_start is not None:
+            result['seconds_per_step'] = (time.time() - t_start) / config['steps']
+        results.put(result)
+
+def run(config, workers):
+    """
+    Trains with workers processes, returns the timing of worker 0 ('compute' / 'allreduce' seconds,
+    'seconds_per_step' when config['steps'] is set: a benchmark of steps iterations after warmup).
+    """
+    if config['batch_size'] % workers != 0:
+        raise ValueError('batch_size %d is not a multiple of %d workers'%(config['batch_size'], workers))
+    config = dict(config, threads=config.get('threads') or max(1, multiprocessing.cpu_count() // workers))
+    # sizes of the shared buffers, from a copy of the models built here
+    trainers, networks = build_models(config)
+    sizes = dict((name, gradient_size(model)) for name, model in trainers.items())
+    sizes['weights'] = weights_size([w for net in networks for w in net.weights])
+    K.clear_session()
+
+    ctx = multiprocessing.get_context('spawn') # fresh interpreters: no TF state inherited through fork
+    buffers = dict((name, shared_gradients(ctx, workers, size, config.get('timeout'))) for name, size in sizes.items())
+    results = ctx.Queue()
+    processes = [ctx.Process(target=worker, args=(rank, workers, config, buffers, results)) for rank in range(workers)]
+    for p in processes:
+        p.start()
+    result = None
+    try:
+        while result is None:
+            try:
+                result = results.get(timeout=1)
+            except Exception: # queue.Empty: check that no worker has died
+                failed = [p for p in processes if p.exitcode not in (None, 0)]
+                if failed:
+                    raise RuntimeError('data-parallel worker exited with code %d'%failed[0].exitcode)
+                if not any(p.is_alive() for p in processes):
+                    raise RuntimeError('data-parallel workers exited without a result')
+        for p in processes:
+            p.join()
+    finally:
+        for p in processes:
+            if p.is_alive():
+                p.terminate()
+    return result
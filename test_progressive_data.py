@@ -0,0 +1,29 @@
+import os
+import numpy as np
+from PIL import Image
+from tools import data_generator, downsample2x, match_resolution
+
+def make_dataset(path, n=6, size=16):
+    random = np.random.RandomState(0)
+    os.makedirs(os.path.join(path, 'images', 'tag'))
+    for i in range(n):
+        Image.fromarray(random.randint(0, 256, (size, size, 3)).astype(np.uint8)).save(os.path.join(path, 'images', 'tag', '%d.png'%i))
+    return os.path.join(path, 'images')
+
+def test_level_boundary(tmpdir):
+    # a batch loaded at scale 1 (level 3) followed by the level-up to full size, with and without the pyramid cache
+    images_path = make_dataset(str(tmpdir))
+    for pyramid_levels in (0, 2):
+        data = data_generator(images_path, height=16, width=16, channel=3, batch_size=2, shuffle=False, normalize=False,
+                              cache_path=os.path.join(str(tmpdir), 'cache'), pyramid_levels=pyramid_levels, seed=0)
+        data.random_shuffle(0)
+        full = data.get_items(np.arange(2))[0]
+        data.set_scale(1)
+        stale = data.get_items(np.arange(2))[0]
+        assert stale.shape == (2, 8, 8, 3)
+        assert np.array_equal(stale, downsample2x(full))
+        data.set_scale(0) # level up: the batch in hand is too small for the new phase
+        fitted = match_resolution(stale, 16)
+        assert fitted.shape == data.get_items(np.arange(2))[0].shape
+        assert np.array_equal(downsample2x(fitted), stale) # what the faded-out lower level sees is unchanged
+        assert np.array_equal(match_resolution(full, 8), stale)
@@ -1,5 +1,15 @@
 import os
+import io
+import json
+import time
+import mmap
+import threading
+import hashlib
+import collections
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
+from PIL import Image
 from skimage.io import imread
 import glob
 from keras.utils import Sequence
@@ -163,6 +173,26 @@ def get_imgaug():
     )
     return seq
 
+def linear_resize_matrix(n_in, n_out):
+    # (n_out, n_in) weights of 1-D linear interpolation, pixel centers aligned as in skimage.transform.resize (edge clamped)
+    src = np.clip((np.arange(n_out) + 0.5) * (float(n_in) / n_out) - 0.5, 0, n_in-1)
+    lo = np.floor(src).astype(np.int64)
+    hi = np.minimum(lo+1, n_in-1)
+    frac = (src - lo).astype(np.float32)
+    m = np.zeros((n_out, n_in), dtype=np.float32)
+    np.add.at(m, (np.arange(n_out), lo), 1. - frac)
+    np.add.at(m, (np.arange(n_out), hi), frac)
+    return m
+
+def batch_resize(images, height, width):
+    # bilinear resize of a whole batch (n, h, w) or (n, h, w, c) as two batched matrix products: R_h @ x @ R_w^T
+    rh = linear_resize_matrix(images.shape[1], height)
+    rw = linear_resize_matrix(images.shape[2], width)
+    x = images.astype(np.float32)
+    if x.ndim == 4:
+        return np.matmul(np.matmul(rh, x.transpose(0, 3, 1, 2)), rw.T).transpose(0, 2, 3, 1)
+    return np.matmul(np.matmul(rh, x), rw.T)
+
 class mnist_generator(Sequence):
     def __init__(self, images, height=32, width=32, batch_size=8):
         self.bs = batch_size
@@ -177,16 +207,18 @@ class mnist_generator(Sequence):
         if r_bound > len(self.imgs):
             r_bound = len(self.imgs)
             l_bound = r_bound - self.bs
-        x_batch = np.zeros((r_bound - l_bound, self.h, self.w, 1))
-        for n, img in enumerate(self.imgs[l_bound:r_bound]):
-            img = resize(np.squeeze(img), (self.h, self.w), order=1, preserve_range=True)[...,np.newaxis]
-            x_batch[n] = np.clip((img.astype(np.float32)-127.5) / 127.5, -1, 1)
+        imgs = self.imgs[l_bound:r_bound]
+        imgs = imgs.reshape(imgs.shape[:3]) # (n, h, w): drop the channel axis (if exist)
+        x_batch = batch_resize(imgs, self.h, self.w)[...,np.newaxis]
+        x_batch = np.clip((x_batch-127.5) / 127.5, -1, 1)
         return x_batch, None
 
-def get_all_data(images_path, height=128, width=128):
+def get_all_data(images_path, height=128, width=128, decoder='skimage', workers=0):
     img_path_list = glob.glob(images_path+'/**/*.jpg') ## paths
     img_path_list.extend(glob.glob(images_path+'/**/*.png'))
     def read_img(img_name):
+        if decoder == 'pil':
+            return read_image_pil(img_name, height, width, 3)
         img = imread(img_name, as_grey=False)
         if img.ndim==2:
             img = gray2rgb(img)
@@ -194,27 +226,297 @@ def get_all_data(images_path, height=128, width=128):
             order = 2 if img.shape[0]<height or img.shape[1]<width else 0 # reduce artifact
             img = resize(img, (height, width), order=order, preserve_range=True)
         return img[...,:3] # discard alpha channel (if exist)
-    images = np.asarray([ read_img(imgp) for imgp in img_path_list], dtype=np.uint8) # save memory space
+    # 1st pass: list the files, 2nd pass: decode straight into the preallocated array (peak memory ~ the dataset itself)
+    images = np.zeros((len(img_path_list), height, width, 3), dtype=np.uint8) # save memory space
+    def fill(n):
+        images[n] = np.clip(read_img(img_path_list[n]), 0, 255)
+    if workers > 0:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(fill, range(len(img_path_list))))
+    else:
+        for n in range(len(img_path_list)):
+            fill(n)
+    return images
+    
+
+def read_image_pil(path, height, width, channel=3):
+    # For JPEGs, draft() lets libjpeg decode at 1/2, 1/4 or 1/8 scale in the DCT domain (never below the requested size),
+    # so large originals are only fully decoded at about the target size. draft() is a no-op for PNGs.
+    img = Image.open(path)
+    mode = 'L' if channel==1 else 'RGB'
+    img.draft(mode, (width, height))
+    img = img.convert(mode)
+    if img.size != (width, height):
+        resample = Image.BICUBIC if img.size[0]<width or img.size[1]<height else Image.NEAREST # same choice as order=2 / order=0 below
+        img = img.resize((width, height), resample=resample)
+    img = np.asarray(img)
+    if img.ndim==2:
+        img = np.expand_dims(img, -1)
+    return img
+
+def read_image(path, height, width, channel=3, decoder='skimage'):
+    if decoder == 'pil':
+        return read_image_pil(path if hasattr(path, 'read') else str(path), height, width, channel)
+    img = imread(path if hasattr(path, 'read') else str(path), as_grey=(channel==1))
+    if img.shape[0]!=height or img.shape[1]!=width:
+        order = 2 if img.shape[0]<height or img.shape[1]<width else 0
+        img = resize(img, (height, width), order=order, preserve_range=True)
+    if img.ndim==2:
+        img = np.expand_dims(img, -1)
+    if channel == 3:
+        img = gray2rgb(img)
+    return img[...,:channel]
+
+def dataset_fingerprint(images_path, paths, height, width, channel, sizes=None, mtimes=None, decoder='skimage'):
+    # anything that changes the decoded content must change the fingerprint
+    sha = hashlib.sha1()
+    sha.update(('%s|%d|%d|%d|%s\n'%(os.path.abspath(images_path), height, width, channel, decoder)).encode('utf-8'))
+    for n, p in enumerate(paths):
+        if sizes is None:
+            st = os.stat(p)
+            size, mtime = st.st_size, st.st_mtime
+        else:
+            size, mtime = sizes[n], mtimes[n]
+        sha.update(('%s|%d|%d\n'%(p, size, int(mtime))).encode('utf-8'))
+    return sha.hexdigest()
+
+def compile_dataset(paths, labels, tags, cache_path, height, width, channel, fingerprint, decoder='skimage'):
+    """
+    Decode + resize every image once and store them in a single memory-mapped uint8 array.
+    Layout of cache_path:
+        images.npy    : (n, height, width, channel) uint8
+        labels.npy    : (n,) int32
+        manifest.json : fingerprint, shape and tags. Written last, so a half-written cache is never used.
+    """
+    if not os.path.exists(cache_path):
+        os.makedirs(cache_path)
+    manifest_path = os.path.join(cache_path, 'manifest.json')
+    for path in (manifest_path, os.path.join(cache_path, 'pyramid.json')):
+        if os.path.exists(path):
+            os.remove(path) # invalidate the old cache (and its pyramid) before overwriting it
+    images = np.lib.format.open_memmap(os.path.join(cache_path, 'images.npy'), mode='w+', dtype=np.uint8, shape=(len(paths), height, width, channel))
+    for n, imgp in enumerate(tqdm(paths, total=len(paths), desc='compile dataset')):
+        images[n] = np.clip(read_image(imgp, height, width, channel, decoder), 0, 255)
+    images.flush()
+    del images
+    np.save(os.path.join(cache_path, 'labels.npy'), np.asarray(labels, dtype=np.int32))
+    manifest = {'fingerprint': fingerprint, 'count': len(paths), 'height': height, 'width': width, 'channel': channel, 'tags': list(tags)}
+    with open(manifest_path, 'w') as fp:
+        json.dump(manifest, fp)
+
+def load_dataset_cache(cache_path, fingerprint):
+    # returns (images, labels) if cache_path holds an up-to-date cache, else None
+    manifest_path = os.path.join(cache_path, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, 'r') as fp:
+        manifest = json.load(fp)
+    if manifest['fingerprint'] != fingerprint:
+        return None
+    images = np.load(os.path.join(cache_path, 'images.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(cache_path, 'labels.npy'))
+    return images, labels
+
+def downsample2x(images):
+    # 2x2 average pooling of a batch (n, h, w, c), as AveragePooling2D in the fade-in of progressive_gan. uint8 stays uint8
+    n, h, w, c = images.shape
+    x = images[:, :h//2*2, :w//2*2].astype(np.float32).reshape(n, h//2, 2, w//2, 2, c).mean(axis=(2, 4))
+    return np.round(x).astype(np.uint8) if images.dtype == np.uint8 else x
+
+def upsample2x(images):
+    # nearest neighbour 2x upsampling of a batch (n, h, w, c): downsample2x(upsample2x(x)) == x
+    return images.repeat(2, axis=1).repeat(2, axis=2)
+
+def match_resolution(images, height):
+    """
+    A batch loaded at another scale (progressive training: loaded or prefetched before a level change), brought to height
+    by factors of 2. Smaller batches are upsampled by pixel repetition, so the input of the faded-out lower level
+    (2x2 average pooling) is exactly the batch as it was loaded.
+    """
+    while images.shape[1] > height:
+        images = downsample2x(images)
+    while images.shape[1] < height:
+        images = upsample2x(images)
     return images
+
+def compile_pyramid(cache_path, fingerprint, levels, chunk_size=1024):
+    """
+    Downsampled copies of a compiled dataset cache, for progressive training:
+        images_{s}.npy : (n, height / 2**s, width / 2**s, channel) uint8, s = 1..levels, each from the one above
+        pyramid.json   : fingerprint (of manifest.json) and levels. Written last, as manifest.json.
+    """
+    pyramid_path = os.path.join(cache_path, 'pyramid.json')
+    if os.path.exists(pyramid_path):
+        os.remove(pyramid_path)
+    source = np.load(os.path.join(cache_path, 'images.npy'), mmap_mode='r')
+    for s in range(1, levels+1):
+        n, h, w, c = source.shape
+        images = np.lib.format.open_memmap(os.path.join(cache_path, 'images_%d.npy'%s), mode='w+', dtype=np.uint8, shape=(n, h//2, w//2, c))
+        for i in tqdm(range(0, n, chunk_size), desc='compile pyramid level %d'%s):
+            images[i:i+chunk_size] = downsample2x(source[i:i+chunk_size])
+        images.flush()
+        del images
+        source = np.load(os.path.join(cache_path, 'images_%d.npy'%s), mmap_mode='r')
+    with open(pyramid_path, 'w') as fp:
+        json.dump({'fingerprint': fingerprint, 'levels': levels}, fp)
+
+def load_pyramid(cache_path, fingerprint, levels):
+    # returns [images_1, .., images_levels] if cache_path holds an up-to-date pyramid of at least levels levels, else None
+    pyramid_path = os.path.join(cache_path, 'pyramid.json')
+    if not os.path.exists(pyramid_path):
+        return None
+    with open(pyramid_path, 'r') as fp:
+        pyramid = json.load(fp)
+    if pyramid['fingerprint'] != fingerprint or pyramid['levels'] < levels:
+        return None
+    return [np.load(os.path.join(cache_path, 'images_%d.npy'%s), mmap_mode='r') for s in range(1, levels+1)]
+
+def _scan_image_dir(path):
+    # images directly under path (same files as glob(path+'/*.jpg') + glob(path+'/*.png')), sorted by name
+    names, sizes, mtimes = [], [], []
+    for entry in os.scandir(path):
+        if entry.name.startswith('.') or not entry.name.endswith(('.jpg', '.png')) or not entry.is_file():
+            continue
+        st = entry.stat()
+        names.append(entry.name)
+        sizes.append(st.st_size)
+        mtimes.append(st.st_mtime)
+    order = np.argsort(names)
+    return np.asarray(names, dtype=str)[order], np.asarray(sizes, dtype=np.int64)[order], np.asarray(mtimes, dtype=np.float64)[order]
+
+def file_manifest(images_path, manifest_path=None):
+    """
+    Lists the images of images_path and of its sub-directories (tag = name of the parent directory),
+    i.e. the files data_generator trains on. Returns a dict of arrays:
+        paths, labels, sizes, mtimes (one entry per image) and tags (label id -> tag).
+    If manifest_path is given, the listing is saved there (.npz) and later calls only re-scan
+    the directories whose mtime changed. Tag ids of existing tags never change, new tags are appended.
+    Note: overwriting a file in place does not change the mtime of its directory and is not detected.
+    """
+    root = os.path.abspath(images_path)
+    root_mtime = os.stat(root).st_mtime
+    m = None
+    if manifest_path is not None and os.path.exists(manifest_path):
+        with np.load(manifest_path) as fp:
+            m = dict((k, fp[k]) for k in fp.files)
+        if str(m['root']) != root:
+            m = None
+    if m is None:
+        m = {'dirs': np.asarray([''], dtype=str), 'dir_mtimes': np.asarray([np.nan]), 'dir_tags': np.asarray([-1], dtype=np.int32),
+             'tags': np.asarray([], dtype=str), 'file_dir': np.zeros(0, dtype=np.int32), 'names': np.asarray([], dtype=str),
+             'sizes': np.zeros(0, dtype=np.int64), 'mtimes': np.zeros(0, dtype=np.float64)}
+    dirs, dir_mtimes, dir_tags = list(m['dirs']), list(m['dir_mtimes']), list(m['dir_tags'])
+    file_dir, names, sizes, mtimes = m['file_dir'], m['names'], m['sizes'], m['mtimes']
+    tags = list(m['tags'])
+    
+    keep = np.ones(len(dirs), dtype=bool)
+    if dir_mtimes[0] != root_mtime: # sub-directories may have been added / removed
+        subdirs = sorted(e.name for e in os.scandir(root) if e.is_dir() and not e.name.startswith('.'))
+        existing = set(dirs[1:])
+        keep[1:] = [d in subdirs for d in dirs[1:]]
+        for d in subdirs:
+            if d not in existing:
+                dirs.append(d)
+                dir_mtimes.append(np.nan)
+                dir_tags.append(-1)
+                keep = np.append(keep, True)
+    # drop removed directories and renumber
+    new_id = np.cumsum(keep) - 1
+    files_kept = keep[file_dir]
+    file_dir, names, sizes, mtimes = new_id[file_dir[files_kept]].astype(np.int32), names[files_kept], sizes[files_kept], mtimes[files_kept]
+    dirs = [d for d, k in zip(dirs, keep) if k]
+    dir_mtimes = [t for t, k in zip(dir_mtimes, keep) if k]
+    dir_tags = [t for t, k in zip(dir_tags, keep) if k]
+    
+    # re-scan directories whose mtime changed
+    parts = [(file_dir, names, sizes, mtimes)]
+    stale = np.zeros(len(dirs), dtype=bool)
+    for n, d in enumerate(dirs):
+        mtime = root_mtime if n==0 else os.stat(os.path.join(root, d)).st_mtime
+        if mtime != dir_mtimes[n]:
+            stale[n] = True
+            dir_mtimes[n] = mtime
+            d_names, d_sizes, d_mtimes = _scan_image_dir(os.path.join(root, d))
+            parts.append((np.full(len(d_names), n, dtype=np.int32), d_names, d_sizes, d_mtimes))
+            if len(d_names) > 0 and dir_tags[n] < 0:
+                tag = os.path.basename(root) if n==0 else d
+                if tag not in tags:
+                    tags.append(tag)
+                dir_tags[n] = tags.index(tag)
+    if stale.any():
+        files_kept = ~stale[file_dir]
+        parts[0] = (file_dir[files_kept], names[files_kept], sizes[files_kept], mtimes[files_kept])
+    file_dir = np.concatenate([p[0] for p in parts]).astype(np.int32)
+    names    = np.concatenate([p[1] for p in parts]).astype(str)
+    sizes    = np.concatenate([p[2] for p in parts]).astype(np.int64)
+    mtimes   = np.concatenate([p[3] for p in parts]).astype(np.float64)
+    order = np.lexsort((names, file_dir))
+    file_dir, names, sizes, mtimes = file_dir[order], names[order], sizes[order], mtimes[order]
+    
+    m = {'root': np.asarray(root), 'dirs': np.asarray(dirs, dtype=str), 'dir_mtimes': np.asarray(dir_mtimes, dtype=np.float64),
+         'dir_tags': np.asarray(dir_tags, dtype=np.int32), 'tags': np.asarray(tags, dtype=str), 'file_dir': file_dir,
+         'names': names, 'sizes': sizes, 'mtimes': mtimes}
+    if manifest_path is not None:
+        tmp_path = manifest_path + '.tmp.npz'
+        np.savez(tmp_path, **m)
+        os.replace(tmp_path, manifest_path)
     
+    dir_paths = np.asarray([os.path.join(root, d) if len(d)>0 else root for d in dirs], dtype=str)
+    paths = np.char.add(np.char.add(dir_paths[file_dir], os.sep), names)
+    labels = np.asarray(dir_tags, dtype=np.int32)[file_dir]
+    return {'paths': paths, 'labels': labels, 'sizes': sizes, 'mtimes': mtimes, 'tags': tags}
 
-class data_generator(Sequence):
-    def __init__(self, images_path, height=128, width=128, channel=3, batch_size=8, shuffle=True, normalize=True, save_tags=False):
+class seeded_epochs(object):
+    """
+    Seeded, resumable epoch order for the generators below. The order of epoch e only depends on (seed, e),
+    so get_cursor() -> {'epoch', 'position', 'seed'} is all that is needed to continue an interrupted run:
+    set_cursor() + random_shuffle(cursor['epoch']) restores the order without reading any data,
+    and training continues at batch cursor['position']. The training loop updates self.position.
+    """
+    def init_epochs(self, seed=None):
+        self.seed = np.random.randint(2**31-1) if seed is None else seed
+        self.epoch = -1
+        self.position = 0
+    def epoch_random_state(self, epoch):
+        return np.random.RandomState((self.seed + 1000003 * epoch) % (2**31-1))
+    def next_epoch(self, epoch=None):
+        self.epoch = self.epoch + 1 if epoch is None else epoch
+        self.position = 0
+        return self.epoch
+    def get_cursor(self):
+        return {'epoch': int(self.epoch), 'position': int(self.position), 'seed': int(self.seed)}
+    def set_cursor(self, cursor):
+        self.seed = cursor['seed']
+        self.random_shuffle(cursor['epoch'])
+        self.position = cursor['position']
+
+class data_generator(seeded_epochs, Sequence):
+    def __init__(self, images_path, height=128, width=128, channel=3, batch_size=8, shuffle=True, normalize=True, save_tags=False, cache_path=None, manifest_path=None, decoder='skimage', seed=None, pyramid_levels=0):
         self.bs = batch_size
-        self.imgs = glob.glob(images_path+'/*.jpg') ## paths
-        self.imgs.extend(glob.glob(images_path+'/*.png'))
-        self.imgs.extend(glob.glob(images_path+'/**/*.png'))
-        self.imgs.extend(glob.glob(images_path+'/**/*.jpg'))
-        self.tags = []
-        self.labels = []
-        self.tag_dict = dict()
-        for file in self.imgs: # get all tags
-            parent_dir = os.path.split(file)[0]
-            tag = os.path.split(parent_dir)[-1]
-            if not tag in self.tag_dict:
-                self.tag_dict[tag] = len(self.tags)
-                self.tags.append(tag)
-            self.labels.append(self.tag_dict[tag])
+        self.init_epochs(seed)
+        sizes, mtimes = None, None
+        if manifest_path is not None:
+            manifest = file_manifest(images_path, manifest_path)
+            self.imgs, self.labels, self.tags = manifest['paths'], manifest['labels'], manifest['tags']
+            sizes, mtimes = manifest['sizes'], manifest['mtimes']
+            self.tag_dict = dict((tag, n) for n, tag in enumerate(self.tags))
+        else:
+            imgs = glob.glob(images_path+'/*.jpg') ## paths
+            imgs.extend(glob.glob(images_path+'/*.png'))
+            imgs.extend(glob.glob(images_path+'/**/*.png'))
+            imgs.extend(glob.glob(images_path+'/**/*.jpg'))
+            self.tags = []
+            labels = []
+            self.tag_dict = dict()
+            for file in imgs: # get all tags
+                parent_dir = os.path.split(file)[0]
+                tag = os.path.split(parent_dir)[-1]
+                if not tag in self.tag_dict:
+                    self.tag_dict[tag] = len(self.tags)
+                    self.tags.append(tag)
+                labels.append(self.tag_dict[tag])
+            self.imgs = np.asarray(imgs, dtype=str)
+            self.labels = np.asarray(labels, dtype=np.int32)
         assert len(self.labels) == len(self.imgs)
         if save_tags:
             tag_csv = pd.DataFrame()
@@ -225,63 +527,455 @@ class data_generator(Sequence):
         self.c = channel
         self.shuffle = shuffle
         self.normalize = normalize
+        self.decoder = decoder
+        self.index = np.arange(len(self.imgs)) # order of this epoch
+        self.cache = None
+        if cache_path is not None:
+            fingerprint = dataset_fingerprint(images_path, self.imgs, height, width, channel, sizes, mtimes, decoder)
+            self.cache = load_dataset_cache(cache_path, fingerprint)
+            if self.cache is None: # missing or stale (source directory / target size changed)
+                compile_dataset(self.imgs, self.labels, self.tags, cache_path, height, width, channel, fingerprint, decoder)
+                self.cache = load_dataset_cache(cache_path, fingerprint)
+        # progressive training: batches downsampled scale times by 2 (set_scale), from a pyramid next to the cache if there is one
+        self.scale = 0
+        self.pyramid = None
+        if self.cache is not None and pyramid_levels > 0:
+            self.pyramid = load_pyramid(cache_path, fingerprint, pyramid_levels)
+            if self.pyramid is None:
+                compile_pyramid(cache_path, fingerprint, pyramid_levels)
+                self.pyramid = load_pyramid(cache_path, fingerprint, pyramid_levels)
+    def set_scale(self, scale):
+        self.scale = scale
+    def images(self):
+        # the cached images at the current scale
+        images, _ = self.cache
+        if self.scale > 0 and self.pyramid is not None:
+            return self.pyramid[min(self.scale, len(self.pyramid))-1]
+        return images
+    def downsample(self, x_batch):
+        # what is left of the current scale after self.images() / decoding at full size
+        for _ in range(self.scale - (len(self.pyramid) if self.pyramid is not None and self.cache is not None else 0)):
+            x_batch = downsample2x(x_batch)
+        return x_batch
     def __len__(self):
         return int(np.ceil(float(len(self.imgs))/self.bs))
-    def random_shuffle(self):
+    def random_shuffle(self, epoch=None):
+        epoch = self.next_epoch(epoch)
         if self.shuffle:
-            self.imgs, self.labels = skshuffle(self.imgs, self.labels)
+            self.index = self.epoch_random_state(epoch).permutation(len(self.imgs))
     def __getitem__(self, idx):
         l_bound = idx     * self.bs
         r_bound = (idx+1) * self.bs
         if r_bound > len(self.imgs):
             r_bound = len(self.imgs)
             l_bound = r_bound - self.bs
-        x_batch = np.zeros((r_bound - l_bound, self.h, self.w, self.c), dtype=np.float32 if self.normalize else np.uint8)
-        for n, imgp in enumerate(self.imgs[l_bound:r_bound]):
-            img = imread(str(imgp), as_grey=(self.c==1))
-            if img.shape[0]!=self.h or img.shape[1]!=self.w:
-                order = 2 if img.shape[0]<self.h or img.shape[1]<self.w else 0
-                img = resize(img, (self.h, self.w), order=order, preserve_range=True)
-            if img.ndim==2:
-                img = np.expand_dims(img, -1)
-            if self.c == 3:
-                img = gray2rgb(img)
-            img = img[...,:self.c]
-            x_batch[n] = np.clip((img.astype(np.float32)-127.5) / 127.5, -1, 1) if self.normalize else img[...,:self.c]
-        return x_batch, to_categorical(self.labels[l_bound:r_bound], len(self.tags))
-
-def generate_images(generator, path, h, w, c, latent_dim, std, nr, nc, iteration, batch_size=1):
-    noise = np.random.normal(0, std, (nr*nc, latent_dim))
+        if self.cache is not None and not self.shuffle:
+            _, labels = self.cache
+            x_batch, y_batch = self.downsample(self.images()[l_bound:r_bound]), labels[l_bound:r_bound] # a view, no copy
+            if self.normalize:
+                x_batch = np.clip((x_batch.astype(np.float32)-127.5) / 127.5, -1, 1)
+            return x_batch, to_categorical(y_batch, len(self.tags))
+        return self.get_items(self.index[l_bound:r_bound])
+    def get_items(self, ids):
+        if self.cache is not None:
+            _, labels = self.cache
+            ids = np.sort(ids) # ascending rows -> forward reads on the memmap
+            x_batch = self.downsample(self.images()[ids])
+            if self.normalize:
+                x_batch = np.clip((x_batch.astype(np.float32)-127.5) / 127.5, -1, 1)
+            return x_batch, to_categorical(labels[ids], len(self.tags))
+        x_batch = np.zeros((len(ids), self.h, self.w, self.c), dtype=np.float32 if self.normalize else np.uint8)
+        for n, imgp in enumerate(self.imgs[ids]):
+            img = read_image(imgp, self.h, self.w, self.c, self.decoder)
+            x_batch[n] = np.clip((img.astype(np.float32)-127.5) / 127.5, -1, 1) if self.normalize else img
+        return self.downsample(x_batch), to_categorical(self.labels[ids], len(self.tags))
+
+def pack_shards(images_path, output_path, shard_size=256*1024*1024, raw=False, height=128, width=128, channel=3, manifest_path=None, seed=None, decoder='skimage'):
+    """
+    Packs the images of a data_generator-style directory (tag = parent directory) into large shards:
+        shard_XXXXX.bin : records written back to back. encoded file bytes, or (height, width, channel) uint8 if raw=True
+        index.npz       : shard id, byte offset, byte length and label of every record, plus tags / image shape
+    Files are shuffled once before packing, so each shard holds a mix of all tags.
+    """
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    manifest = file_manifest(images_path, manifest_path)
+    paths, labels = manifest['paths'], manifest['labels']
+    order = np.random.RandomState(seed).permutation(len(paths))
+    n = len(order)
+    shard_ids, offsets, lengths = np.zeros(n, dtype=np.int32), np.zeros(n, dtype=np.int64), np.zeros(n, dtype=np.int64)
+    shard, offset, fp = 0, 0, None
+    for i, j in enumerate(tqdm(order, total=n, desc='pack shards')):
+        if raw:
+            data = np.clip(read_image(paths[j], height, width, channel, decoder), 0, 255).astype(np.uint8).tobytes()
+        else:
+            with open(paths[j], 'rb') as img_fp:
+                data = img_fp.read()
+        if fp is None or offset + len(data) > shard_size and offset > 0:
+            if fp is not None:
+                fp.close()
+                shard += 1
+            fp = open(os.path.join(output_path, 'shard_{:05d}.bin'.format(shard)), 'wb')
+            offset = 0
+        fp.write(data)
+        shard_ids[i], offsets[i], lengths[i] = shard, offset, len(data)
+        offset += len(data)
+    if fp is not None:
+        fp.close()
+    np.savez(os.path.join(output_path, 'index.npz'), shard=shard_ids, offset=offsets, length=lengths, label=labels[order],
+             tags=np.asarray(manifest['tags'], dtype=str), raw=raw, shape=np.asarray([height, width, channel]))
+
+class shard_generator(seeded_epochs, Sequence):
+    """
+    Drop-in replacement of data_generator reading a dataset packed by pack_shards.
+    Shards are memory-mapped and read front to back: each epoch visits the shards in a random order and
+    shuffles records only within a window of buffer_size records, so reads stay large and sequential.
+    For multi-process training, worker worker_id of num_workers only reads shards worker_id, worker_id+num_workers, ...
+    """
+    def __init__(self, shards_path, height=128, width=128, channel=3, batch_size=8, shuffle=True, normalize=True, save_tags=False,
+                 buffer_size=10000, num_workers=1, worker_id=0, decoder='skimage', seed=None):
+        self.path = shards_path
+        self.init_epochs(seed)
+        with np.load(os.path.join(shards_path, 'index.npz')) as fp:
+            index = dict((k, fp[k]) for k in fp.files)
+        mine = (index['shard'] % num_workers) == worker_id
+        if not mine.any():
+            raise ValueError('worker %d of %d has no shard (%s holds %d shards): use at most that many workers'%(
+                             worker_id, num_workers, shards_path, len(np.unique(index['shard']))))
+        self.shard_ids, self.offsets, self.lengths = index['shard'][mine], index['offset'][mine], index['length'][mine]
+        self.labels = index['label'][mine]
+        self.tags = list(index['tags'])
+        self.tag_dict = dict((tag, n) for n, tag in enumerate(self.tags))
+        self.raw = bool(index['raw'])
+        if self.raw:
+            assert tuple(index['shape']) == (height, width, channel), 'shards were packed as %s'%str(tuple(index['shape']))
+        if save_tags:
+            tag_csv = pd.DataFrame()
+            tag_csv['tags'] = self.tags
+            tag_csv.to_csv('./tags.csv', index=False)
+        self.bs = batch_size
+        self.h = height
+        self.w = width
+        self.c = channel
+        self.shuffle = shuffle
+        self.normalize = normalize
+        self.buffer_size = buffer_size
+        self.decoder = decoder
+        self.index = np.arange(len(self.labels))
+        self.maps = dict()
+        self.lock = threading.Lock()
+    def __len__(self):
+        return int(np.ceil(float(len(self.labels))/self.bs))
+    def random_shuffle(self, epoch=None):
+        epoch = self.next_epoch(epoch)
+        if not self.shuffle:
+            return
+        random_state = self.epoch_random_state(epoch)
+        shards = np.unique(self.shard_ids)
+        shard_rank = np.zeros(shards.max()+1, dtype=np.int64)
+        shard_rank[random_state.permutation(shards)] = np.arange(len(shards))
+        stream = np.lexsort((np.arange(len(self.labels)), shard_rank[self.shard_ids])) # shards in random order, records in file order
+        # a shuffle buffer of size B moves every record by less than ~B positions: sort by position + U(0, B)
+        key = np.arange(len(stream)) + random_state.uniform(0, self.buffer_size, len(stream))
+        self.index = stream[np.argsort(key)]
+    def shard(self, shard_id):
+        if shard_id not in self.maps:
+            with self.lock:
+                if shard_id not in self.maps:
+                    with open(os.path.join(self.path, 'shard_{:05d}.bin'.format(shard_id)), 'rb') as fp:
+                        m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+                    if hasattr(m, 'madvise'): # python >= 3.8: ask the kernel for aggressive read-ahead
+                        m.madvise(mmap.MADV_SEQUENTIAL)
+                    self.maps[shard_id] = m
+        return self.maps[shard_id]
+    def read_record(self, i):
+        m = self.shard(self.shard_ids[i])
+        data = m[self.offsets[i]:self.offsets[i]+self.lengths[i]]
+        if self.raw:
+            return np.frombuffer(data, dtype=np.uint8).reshape(self.h, self.w, self.c)
+        return read_image(io.BytesIO(data), self.h, self.w, self.c, self.decoder)
+    def __getitem__(self, idx):
+        l_bound = idx     * self.bs
+        r_bound = (idx+1) * self.bs
+        if r_bound > len(self.labels):
+            r_bound = len(self.labels)
+            l_bound = r_bound - self.bs
+        return self.get_items(self.index[l_bound:r_bound])
+    def get_items(self, ids):
+        x_batch = np.zeros((len(ids), self.h, self.w, self.c), dtype=np.float32 if self.normalize else np.uint8)
+        for n, i in enumerate(ids):
+            img = self.read_record(i)
+            x_batch[n] = np.clip((img.astype(np.float32)-127.5) / 127.5, -1, 1) if self.normalize else img
+        return x_batch, to_categorical(self.labels[ids], len(self.tags))
+
+def alias_table(p):
+    # Walker/Vose alias table: draw from p in O(1) with one uniform int + one uniform float
+    n = len(p)
+    scaled = np.asarray(p, dtype=np.float64) * n / np.sum(p)
+    prob, alias = np.ones(n), np.arange(n)
+    small = [i for i in range(n) if scaled[i] < 1.]
+    large = [i for i in range(n) if scaled[i] >= 1.]
+    while len(small) > 0 and len(large) > 0:
+        s, l = small.pop(), large.pop()
+        prob[s], alias[s] = scaled[s], l
+        scaled[l] = scaled[l] + scaled[s] - 1.
+        if scaled[l] < 1.:
+            small.append(l)
+        else:
+            large.append(l)
+    return prob, alias
+
+class class_balanced_sampler(object):
+    """
+    Draws sample indices whose classes follow a chosen distribution, in O(1) per sample:
+    a class from an alias table, then a uniform position inside that class' index array.
+    distribution: 'uniform' (same as the condition draw of make_some_noise), 'sqrt' (~ sqrt of class frequency),
+                  'frequency' (the data distribution) or an array of class probabilities.
+    """
+    def __init__(self, labels, num_classes=None, distribution='uniform'):
+        labels = np.asarray(labels)
+        if labels.ndim == 2: # one-hot
+            labels = np.argmax(labels, axis=-1)
+        num_classes = int(labels.max())+1 if num_classes is None else num_classes
+        self.counts = np.bincount(labels, minlength=num_classes)
+        self.order = np.argsort(labels, kind='mergesort') # per-class index arrays, stored back to back
+        self.starts = np.cumsum(self.counts) - self.counts
+        if isinstance(distribution, str):
+            if distribution == 'uniform':
+                p = np.ones(num_classes)
+            elif distribution == 'sqrt':
+                p = np.sqrt(self.counts)
+            elif distribution == 'frequency':
+                p = self.counts.astype(np.float64)
+            else:
+                raise ValueError('unknown class distribution: %s'%distribution)
+        else:
+            p = np.asarray(distribution, dtype=np.float64)
+        p = p * (self.counts > 0) # never draw a class without samples
+        self.p = p / np.sum(p)
+        self.prob, self.alias = alias_table(self.p)
+    def sample(self, n, random_state=np.random):
+        k = random_state.randint(len(self.prob), size=n)
+        cls = np.where(random_state.uniform(size=n) < self.prob[k], k, self.alias[k])
+        pos = (random_state.uniform(size=n) * self.counts[cls]).astype(np.int64)
+        return self.order[self.starts[cls] + pos]
+
+class balanced_generator(seeded_epochs, Sequence):
+    """
+    Class-balanced batches (see class_balanced_sampler) from a data_generator / shard_generator,
+    or from in-memory arrays data=(x, y) as in the mnist scripts.
+    Batch idx of an epoch is drawn with its own seed, so it can be loaded from any thread (prefetch_loader).
+    """
+    def __init__(self, data, distribution='uniform', batch_size=None, steps=None, seed=None):
+        self.data = data
+        if isinstance(data, tuple):
+            labels = data[1]
+            self.bs = batch_size
+            self.tags = list(range(labels.shape[-1] if labels.ndim==2 else int(labels.max())+1))
+        else:
+            labels = data.labels
+            self.bs = data.bs if batch_size is None else batch_size
+            self.tags = data.tags
+        self.sampler = class_balanced_sampler(labels, len(self.tags), distribution)
+        self.steps = int(np.ceil(float(len(labels))/self.bs)) if steps is None else steps
+        self.init_epochs(seed)
+    def __len__(self):
+        return self.steps
+    def random_shuffle(self, epoch=None):
+        self.next_epoch(epoch)
+    def __getitem__(self, idx):
+        ids = self.sampler.sample(self.bs, np.random.RandomState((self.seed + 1000003 * self.epoch + idx) % (2**31-1)))
+        if isinstance(self.data, tuple):
+            return self.data[0][ids], self.data[1][ids]
+        if hasattr(self.data, 'get_items'):
+            return self.data.get_items(ids)
+        raise ValueError('%s does not support random access (get_items)'%type(self.data).__name__)
+
+class array_generator(seeded_epochs, Sequence):
+    """
+    Batches from in-memory arrays (the mnist scripts), with the same seeded epoch order / cursor as data_generator.
+    The last batch of an epoch is filled up with the samples before it, so every batch has batch_size samples.
+    """
+    def __init__(self, x, y=None, batch_size=8, shuffle=True, seed=None):
+        self.x = x
+        self.y = y
+        self.bs = batch_size
+        self.shuffle = shuffle
+        self.index = np.arange(len(x))
+        self.init_epochs(seed)
+    def __len__(self):
+        return int(np.ceil(float(len(self.x))/self.bs))
+    def random_shuffle(self, epoch=None):
+        epoch = self.next_epoch(epoch)
+        if self.shuffle:
+            self.index = self.epoch_random_state(epoch).permutation(len(self.x))
+    def __getitem__(self, idx):
+        r_bound = min(len(self.x), (idx+1) * self.bs)
+        l_bound = r_bound - self.bs
+        return self.get_items(self.index[l_bound:r_bound])
+    def get_items(self, ids):
+        return self.x[ids], (None if self.y is None else self.y[ids])
+
+def save_cursor(generator, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fp:
+        json.dump(generator.get_cursor(), fp)
+    os.replace(tmp_path, path)
+
+def load_cursor(path):
+    with open(path, 'r') as fp:
+        return json.load(fp)
+
+def load_batch(generator, idx, augmenter=None, seed=None):
+    x_batch, y_batch = generator.__getitem__(idx)
+    if augmenter is not None:
+        augmenter = augmenter.deepcopy() # private copy: augmenters are not thread-safe and we want a per-batch seed
+        augmenter.reseed(np.random.RandomState(seed))
+        x_batch = augmenter.augment_images(x_batch)
+        x_batch = (x_batch.astype(np.float32) - 127.5) / 127.5
+    return x_batch, y_batch
+
+_loader_worker_state = None
+
+def _init_loader_worker(generator, augmenter):
+    global _loader_worker_state
+    _loader_worker_state = (generator, augmenter)
+
+def _load_batch_in_worker(idx, seed):
+    generator, augmenter = _loader_worker_state
+    return load_batch(generator, idx, augmenter, seed)
+
+class prefetch_loader(object):
+    """
+    Runs generator.__getitem__ (decode) and the imgaug augmentation in a pool of workers and keeps
+    at most queue_size finished/in-flight batches ahead of the training loop.
+    Batches are always yielded in index order and the augmentation of batch idx in epoch e is seeded
+    by (seed, e, idx), so an epoch is reproducible no matter how many workers are used.
+    wait_time accumulates the seconds the training loop spent blocked on data.
+    """
+    def __init__(self, generator, augmenter=None, workers=4, queue_size=8, use_processes=False, seed=None):
+        self.generator = generator
+        self.augmenter = augmenter
+        self.workers = workers
+        self.queue_size = max(1, queue_size)
+        self.use_processes = use_processes
+        if seed is None and not hasattr(generator, 'seed'):
+            seed = np.random.randint(2**31-1)
+        self.seed = seed # None: follow generator.seed, so restoring its cursor also restores the augmentation
+        self.wait_time = 0.0
+        self.pool = None
+        if workers > 0 and not use_processes:
+            self.pool = ThreadPoolExecutor(max_workers=workers)
+    def __len__(self):
+        return len(self.generator)
+    def batch_seed(self, epoch, idx):
+        seed = self.generator.seed if self.seed is None else self.seed
+        return (seed + 1000003 * epoch + idx) % (2**31-1)
+    def submit(self, epoch, idx):
+        if self.use_processes:
+            return self.pool.submit(_load_batch_in_worker, idx, self.batch_seed(epoch, idx))
+        return self.pool.submit(load_batch, self.generator, idx, self.augmenter, self.batch_seed(epoch, idx))
+    def iterate(self, epoch=0, start=0):
+        # call generator.random_shuffle() before iterating a new epoch
+        n = len(self.generator)
+        if self.workers <= 0: # no pool: load on the calling thread
+            for idx in range(start, n):
+                t0 = time.time()
+                batch = load_batch(self.generator, idx, self.augmenter, self.batch_seed(epoch, idx))
+                self.wait_time += time.time() - t0
+                yield batch
+            return
+        if self.use_processes: # fork per epoch, so workers see the order of this epoch
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('fork'),
+                                            initializer=_init_loader_worker, initargs=(self.generator, self.augmenter))
+        pending = collections.deque()
+        next_idx = start
+        try:
+            while next_idx < n and len(pending) < self.queue_size:
+                pending.append(self.submit(epoch, next_idx))
+                next_idx += 1
+            while len(pending) > 0:
+                t0 = time.time()
+                batch = pending.popleft().result()
+                self.wait_time += time.time() - t0
+                if next_idx < n:
+                    pending.append(self.submit(epoch, next_idx))
+                    next_idx += 1
+                yield batch
+        finally:
+            for future in pending:
+                future.cancel()
+            if self.use_processes:
+                self.pool.shutdown(wait=True)
+                self.pool = None
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+def mosaic(generated, h, w, c, nr, nc):
+    # (nr*nc, h, w, c) samples in [-1, 1] -> uint8 image with nr rows and nc columns of tiles
+    figure = np.asarray(generated).reshape(nr, nc, h, w, c).transpose(0, 2, 1, 3, 4).reshape(h*nr, w*nc, c)
+    return np.squeeze(np.clip(figure * 127.5 + 127.5, 0, 255).astype(np.uint8))
+
+def save_mosaic(filename, generated, h, w, c, nr, nc):
+    imsave(filename, mosaic(generated, h, w, c, nr, nc))
+
+class preview_writer(object):
+    """
+    Runs preview output (mosaic assembly, JPEG encoding) on a background thread:
+        writer.submit(save_mosaic, filename, generated, h, w, c, nr, nc)
+    so the training thread only waits for the forward pass. At most max_pending previews are queued,
+    errors of a preview are raised by the next submit() / close().
+    """
+    def __init__(self, max_pending=2):
+        self.pool = ThreadPoolExecutor(max_workers=1)
+        self.max_pending = max_pending
+        self.pending = collections.deque()
+    def submit(self, fn, *args):
+        while len(self.pending) >= self.max_pending or (self.pending and self.pending[0].done()):
+            self.pending.popleft().result()
+        self.pending.append(self.pool.submit(fn, *args))
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.pool.shutdown(wait=True)
+
+def preview_grid(h, w, c, nr, nc, filename, generated, writer=None):
+    # the mosaic of one preview, on writer's thread if there is one
+    if writer is None:
+        save_mosaic(filename, generated, h, w, c, nr, nc)
+    else:
+        writer.submit(save_mosaic, filename, generated, h, w, c, nr, nc)
+
+def preview_noise(n, latent_dim, std, seed=None):
+    # seed: the same samples at every preview, so previews show how the generator changes
+    random = np.random if seed is None else np.random.RandomState(seed)
+    return random.normal(0, std, (n, latent_dim)).astype(np.float32)
+
+def generate_images(generator, path, h, w, c, latent_dim, std, nr, nc, iteration, batch_size=1, save_weights=True, seed=None, writer=None):
+    noise = preview_noise(nr*nc, latent_dim, std, seed)
     generated = generator.predict(noise, batch_size=batch_size, verbose=0)
-    figure = np.zeros((h * nr, w * nc, c))
-    for ri in range(nr):
-        for ci in range(nc):
-            figure[h*ri:h*(ri+1), w*ci:w*(ci+1)] = generated[ri*nc+ci]
-    figure = np.squeeze(np.clip(figure * 127.5 + 127.5, 0, 255).astype(np.uint8))
-    imsave(os.path.join(path, 'ite_{:02d}.jpg'.format(iteration)), figure)
-    generator.save(os.path.join(path, 'weights_ite_{:02d}.h5'.format(iteration)))
+    preview_grid(h, w, c, nr, nc, os.path.join(path, 'ite_{:02d}.jpg'.format(iteration)), generated, writer)
+    if save_weights:
+        generator.save(os.path.join(path, 'weights_ite_{:02d}.h5'.format(iteration)))
 
-def generate_images_cgan(generator, path, h, w, c, latent_dim, std, nr, nc, iteration):
-    figure = np.zeros((h * nr, w * nc, c))
-    for ri in range(nr):
-        for ci in range(nc):
-            noise = np.random.normal(0, std, (1, latent_dim)).astype(np.float32)
-            label = to_categorical(np.array([[ci]]), num_classes=nc)
-            latent = np.concatenate((noise, label), axis=-1)
-            figure[h*ri:h*(ri+1), w*ci:w*(ci+1)] = generator.predict(latent, verbose=0, batch_size=1)[0]
-    figure = np.squeeze(np.clip(figure * 127.5 + 127.5, 0, 255).astype(np.uint8))
-    imsave(os.path.join(path, 'ite_{:02d}.jpg'.format(iteration)), figure)
-    generator.save(os.path.join(path, 'weights_ite_{:02d}.h5'.format(iteration)))
-
-def generate_images_cvaegan(generator, path, h, w, c, latent_dim, nr, nc, iteration):
-    figure = np.zeros((h * nr, w * nc, c))
-    for ri in range(nr):
-        for ci in range(nc):
-            noise = np.random.normal(0, 1, (1, latent_dim)).astype(np.float32)
-            label = to_categorical(np.array([[ci]]), num_classes=nc)
-            figure[h*ri:h*(ri+1), w*ci:w*(ci+1)] = generator.predict([noise, label], verbose=0, batch_size=1)[0]
-    figure = np.squeeze(np.clip(figure * 127.5 + 127.5, 0, 255).astype(np.uint8))
-    imsave(os.path.join(path, 'ite_{:02d}.jpg'.format(iteration)), figure)
+def generate_images_cgan(generator, path, h, w, c, latent_dim, std, nr, nc, iteration, save_weights=True, seed=None, writer=None, batch_size=None):
+    # one predict for the whole grid: row ri, column ci is class ci
+    noise = preview_noise(nr*nc, latent_dim, std, seed)
+    label = to_categorical(np.tile(np.arange(nc), nr), num_classes=nc)
+    latent = np.concatenate((noise, label), axis=-1)
+    generated = generator.predict(latent, verbose=0, batch_size=nr*nc if batch_size is None else batch_size)
+    preview_grid(h, w, c, nr, nc, os.path.join(path, 'ite_{:02d}.jpg'.format(iteration)), generated, writer)
+    if save_weights:
+        generator.save(os.path.join(path, 'weights_ite_{:02d}.h5'.format(iteration)))
+
+def generate_images_cvaegan(generator, path, h, w, c, latent_dim, nr, nc, iteration, seed=None, writer=None, batch_size=None):
+    # one predict for the whole grid: row ri, column ci is class ci
+    noise = preview_noise(nr*nc, latent_dim, 1, seed)
+    label = to_categorical(np.tile(np.arange(nc), nr), num_classes=nc)
+    generated = generator.predict([noise, label], verbose=0, batch_size=nr*nc if batch_size is None else batch_size)
+    preview_grid(h, w, c, nr, nc, os.path.join(path, 'ite_{:02d}.jpg'.format(iteration)), generated, writer)
     # generator.save(os.path.join(path, 'weights_ite_{:02d}.h5'.format(iteration)))
 
 def generate_images_cyclegan(generator_A, generator_B, img_A, img_B, path, h, w, c_A, c_B, iteration):
@@ -309,6 +1003,6 @@ class Preview(Callback):
         nr, nc = self.nr, self.nc
         h, w, c = self.h, self.w, self.c
         path = self.path
-        generate_images(self.decoder, self.path, self.h, self.w, self.c, self.latent_dim, self.std, self.nr, self.nc, epoch, self.batch_size)
+        generate_images(self.decoder, self.path, self.h, self.w, self.c, self.latent_dim, self.std, self.nr, self.nc, epoch, self.batch_size, self.sv)
 
         
@@ -1,9 +1,11 @@
 import argparse
 parser = argparse.ArgumentParser(description='WGAN-GP')
-parser.add_argument('--dataset', type=str, required=True,
+parser.add_argument('--dataset', type=str, default=None, required=False,
                     help='path to dataset')
+parser.add_argument('--shards', type=str, default=None, required=False,
+                    help='path to a dataset packed by pack_dataset.py (used instead of --dataset)')
 parser.add_argument('--load_weights', action='store_true', default=False,
-                    help='continue training')
+                    help='continue training (with --keep_checkpoints: from the full training state of the newest checkpoint)')
 parser.add_argument('--width', type=int, default=96, required=False,
                     help='width')
 parser.add_argument('--height', type=int, default=96, required=False,
@@ -22,12 +24,64 @@ parser.add_argument('--std', type=float, default=1.0, required=False,
                     help='sampling std')
 parser.add_argument('--no_augmentation', action='store_true', default=False,
                     help='')
+parser.add_argument('--cache', type=str, default=None, required=False,
+                    help='directory of the decoded dataset cache (built on first use, rebuilt when the dataset changes)')
+parser.add_argument('--manifest', type=str, default=None, required=False,
+                    help='file listing of the dataset (.npz), written once and updated incrementally')
+parser.add_argument('--uint8_feed', action='store_true', default=False,
+                    help='feed uint8 batches, normalize and augment inside the TF graph')
+parser.add_argument('--decoder', type=str, default='skimage', required=False,
+                    help='image decoder: skimage/pil (pil decodes large JPEGs at reduced size)')
+parser.add_argument('--checkpoint_iteration', type=int, default=0, required=False,
+                    help='also save models + data cursor every n iterations (0: only at the end of an epoch)')
+parser.add_argument('--workers', type=int, default=4, required=False,
+                    help='data loading / augmentation workers (0: load on the training thread)')
+parser.add_argument('--prefetch', type=int, default=8, required=False,
+                    help='max. number of batches loaded ahead')
+parser.add_argument('--processes', action='store_true', default=False,
+                    help='use worker processes instead of threads')
+parser.add_argument('--fused', action='store_true', default=False,
+                    help='run the D_ITER critic updates and the generator update in one session call')
+parser.add_argument('--batched_critic', action='store_true', default=False,
+                    help='score real, generated and interpolated samples in one discriminator pass')
+parser.add_argument('--gp_interval', type=int, default=1, required=False,
+                    help='lazy gradient penalty: compute it every n critic steps (weighted by n)')
+parser.add_argument('--gp_batch_fraction', type=float, default=1.0, required=False,
+                    help='compute the gradient penalty on this fraction of the batch')
+parser.add_argument('--fake_pool', type=int, default=0, required=False,
+                    help='critic steps take generated samples from a pool of this size (0: generate per step)')
+parser.add_argument('--fake_refresh', type=int, default=0, required=False,
+                    help='samples regenerated after each generator update (0: the whole pool)')
+parser.add_argument('--ema', type=float, default=0, required=False,
+                    help='keep a moving average of the generator with this decay, e.g. 0.999: previewed and saved as decoder_ema.h5 (0: off, not with --progressive)')
+parser.add_argument('--keep_checkpoints', type=int, default=0, required=False,
+                    help='write checkpoints (weights + optimizer state) to ./checkpoints in the background and keep the newest N, ./<name>.h5 at the end of each epoch (0: synchronous .h5 checkpoints)')
+parser.add_argument('--keep_best', type=int, default=0, required=False,
+                    help='also keep the N checkpoints with the lowest --best_metric')
+parser.add_argument('--best_metric', type=str, default=None, required=False,
+                    help='loss (mean since the previous checkpoint) that ranks checkpoints for --keep_best, e.g. GL')
+parser.add_argument('--progressive', action='store_true', default=False,
+                    help='progressive-resolution training: from height/16 x width/16 up to full size, fading in each new stage')
+parser.add_argument('--start_level', type=int, default=0, required=False,
+                    help='--progressive: first level (0: height/16, 4: full size)')
+parser.add_argument('--phase_iterations', type=int, default=10000, required=False,
+                    help='--progressive: iterations per fade-in / stable phase')
+parser.add_argument('--pyramid', action='store_true', default=False,
+                    help='--progressive: cache the downsampled levels next to --cache instead of downsampling every batch')
+parser.add_argument('--accumulate', type=int, default=1, required=False,
+                    help='split every batch into n micro-batches and apply their accumulated gradients once (memory of batch_size / n)')
 args = parser.parse_args()
+assert (args.dataset is None) != (args.shards is None), 'give either --dataset or --shards'
+assert args.accumulate == 1 or not args.fused, '--accumulate does not apply to --fused steps'
+assert args.fake_pool == 0 or not args.fused, '--fake_pool does not apply to --fused steps'
+assert 1 <= args.accumulate <= args.batch_size, '--accumulate has to be between 1 and --batch_size'
 
 import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 import tensorflow as tf
+if args.fused: # the fused updates read weights written earlier in the same session call
+    tf.enable_resource_variables()
 config = tf.ConfigProto()
 config.gpu_options.allow_growth = True
 session = tf.Session(config=config)
@@ -36,7 +90,9 @@ from keras import backend as K
 K.set_session(session)
 from keras.models import *
 from tools import *
-from models import build_gan
+from models import build_gan, progressive_networks
+from trainer import Trainer, wgan_step, progressive_step
+from checkpoints import checkpoint_manager
 from keras.datasets import mnist
 from keras.callbacks import TensorBoard
 from keras.callbacks import Callback
@@ -50,40 +106,26 @@ EPOCHS = args.epochs
 w, h, c = args.width, args.height, args.channels
 latent_dim = args.z_dim
 D_ITER = 5
-generator_model, discriminator_model, decoder, discriminator = build_gan(h=h, w=w, c=c, latent_dim=latent_dim, epsilon_std=args.std, dropout_rate=0.2)
+gan_kwargs = dict(epsilon_std=args.std, uint8_input=args.uint8_feed, augment=use_data_augmentation, fused_critic_steps=D_ITER if args.fused else 0, batched_critic=args.batched_critic, gp_interval=args.gp_interval, gp_batch_fraction=args.gp_batch_fraction, reuse_fakes=args.fake_pool > 0)
+if not args.progressive:
+    generator_model, discriminator_model, decoder, discriminator = build_gan(h=h, w=w, c=c, latent_dim=latent_dim, dropout_rate=0.2, ema_decay=args.ema, **gan_kwargs)
 
-train_generator = data_generator(args.dataset, height=h, width=w, channel=c, batch_size=BS, shuffle=True, normalize=not use_data_augmentation)
+if args.shards is not None:
+    train_generator = shard_generator(args.shards, height=h, width=w, channel=c, batch_size=BS, shuffle=True, normalize=not (use_data_augmentation or args.uint8_feed), decoder=args.decoder)
+else:
+    train_generator = data_generator(args.dataset, height=h, width=w, channel=c, batch_size=BS, shuffle=True, normalize=not (use_data_augmentation or args.uint8_feed), cache_path=args.cache, manifest_path=args.manifest, decoder=args.decoder, pyramid_levels=4 if args.progressive and args.pyramid else 0)
 seq = get_imgaug()
-
+checkpointer = checkpoint_manager('./checkpoints', keep_last=args.keep_checkpoints, keep_best=args.keep_best, metric=args.best_metric) if args.keep_checkpoints > 0 else None
+if args.progressive:
+    step = progressive_step(progressive_networks(h=h, w=w, c=c, latent_dim=latent_dim, dropout_rate=0.2), train_generator, latent_dim=latent_dim, std=args.std, d_iter=D_ITER,
+                            start_level=args.start_level, phase_iterations=args.phase_iterations, pool_size=args.fake_pool, pool_refresh=args.fake_refresh, accumulation=args.accumulate, c=c, **gan_kwargs)
+else:
+    step = wgan_step((generator_model, discriminator_model, decoder, discriminator), latent_dim=latent_dim, std=args.std, d_iter=D_ITER, pool_size=args.fake_pool, pool_refresh=args.fake_refresh, accumulation=args.accumulate)
+trainer = Trainer(step,
+                  train_generator, augmenter=seq if use_data_augmentation and not args.uint8_feed else None,
+                  workers=args.workers, queue_size=args.prefetch, use_processes=args.processes,
+                  preview_iteration=args.preview_iteration, checkpoint_iteration=args.checkpoint_iteration,
+                  checkpointer=checkpointer)
 if args.load_weights:
-    decoder.load_weights('./decoder.h5')
-    discriminator.load_weights('./discriminator.h5')
-
-if not os.path.exists('./preview'):
-    os.makedirs('./preview')
-
-d_counter = 0
-preview_t = 0
-for epoch in range(EPOCHS):
-    print("Epoch: %d / %d"%(epoch+1, EPOCHS))
-    train_generator.random_shuffle()
-    with tqdm(total=len(train_generator)) as t:
-        for i in range(len(train_generator)):
-            image_batch, _ = train_generator.__getitem__(i)
-            if use_data_augmentation:
-                image_batch = seq.augment_images(image_batch)
-                image_batch = (image_batch.astype(np.float32) - 127.5) / 127.5
-            noise = np.random.normal(0, args.std, (BS, latent_dim)).astype(np.float32)
-            msg = ''
-            msg += 'DL: {:.2f}, '.format(np.mean(discriminator_model.train_on_batch([image_batch, noise], None)))
-            d_counter += 1
-            if d_counter==D_ITER:
-                msg += 'GL: {:.2f}, '.format(np.mean(generator_model.train_on_batch(np.random.normal(0, args.std, (BS, latent_dim)).astype(np.float32), None)))
-                d_counter = 0
-            t.set_description(msg)
-            t.update()
-            if preview_t % args.preview_iteration == 0:
-                generate_images(decoder, './preview', h, w, c, latent_dim, args.std, 15, 15, preview_t, BS)
-            preview_t += 1
-    decoder.save('./decoder.h5')
-    discriminator.save('./discriminator.h5')
+    trainer.restore()
+trainer.fit(EPOCHS)
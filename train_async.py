@@ -0,0 +1,56 @@
+import argparse
+parser = argparse.ArgumentParser(description='WGAN-GP with the critic and the generator trained asynchronously in two processes (experimental)')
+parser.add_argument('--dataset', type=str, default='mnist', required=False,
+                    help='path to dataset, or mnist / fashion_mnist (32x32x1)')
+parser.add_argument('--cache', type=str, default=None, required=False,
+                    help='directory of the decoded dataset cache (built once here, before the actors start)')
+parser.add_argument('--width', type=int, default=96, required=False,
+                    help='width')
+parser.add_argument('--height', type=int, default=96, required=False,
+                    help='height')
+parser.add_argument('--channels', type=int, default=3, required=False,
+                    help='channels')
+parser.add_argument('--z_dim', type=int, default=100, required=False,
+                    help='latent dimension')
+parser.add_argument('--batch_size', type=int, default=32, required=False,
+                    help='batch size')
+parser.add_argument('--epochs', type=int, default=1000, required=False,
+                    help='epochs (of the critic)')
+parser.add_argument('--std', type=float, default=1.0, required=False,
+                    help='sampling std')
+parser.add_argument('--batched_critic', action='store_true', default=False,
+                    help='score real, generated and interpolated samples in one discriminator pass')
+parser.add_argument('--sync_interval', type=int, default=5, required=False,
+                    help='publish own / pull the other network every n steps of an actor')
+parser.add_argument('--ratio', type=int, default=5, required=False,
+                    help='at most n critic steps per generator step (0: no bound)')
+parser.add_argument('--log_interval', type=int, default=100, required=False,
+                    help='report throughput and staleness every n steps of an actor')
+parser.add_argument('--threads', type=int, default=0, required=False,
+                    help='TF threads per actor (0: half of the cores)')
+parser.add_argument('--preview_iteration', type=int, default=500, required=False,
+                    help='preview every n generator steps')
+parser.add_argument('--seed', type=int, default=0, required=False,
+                    help='seed of the batch order')
+args = parser.parse_args()
+
+# the actors are spawned: they import this script again, without running it
+if __name__ == '__main__':
+    import os
+    from parallel import make_data
+    from actors import run
+
+    if args.dataset in ('mnist', 'fashion_mnist'):
+        h, w, c = 32, 32, 1
+    else:
+        h, w, c = args.height, args.width, args.channels
+    config = {'model': {'h': h, 'w': w, 'c': c, 'latent_dim': args.z_dim, 'epsilon_std': args.std, 'dropout_rate': 0.2, 'batched_critic': args.batched_critic},
+              'data': {'source': args.dataset, 'seed': args.seed, 'cache': args.cache},
+              'conditional': 0, 'batch_size': args.batch_size, 'epochs': args.epochs, 'threads': args.threads,
+              'sync_interval': args.sync_interval, 'ratio': args.ratio, 'log_interval': args.log_interval,
+              'preview_path': './preview', 'preview_iteration': args.preview_iteration, 'output': './generator.h5'}
+    if not os.path.exists('./preview'):
+        os.makedirs('./preview')
+    make_data(config) # builds the dataset cache once, before the critic reads it
+    for role, (rate, staleness) in sorted(run(config).items()):
+        print('{:9s}: {:6.1f} steps/s, mean staleness {:.1f} steps'.format(role, rate, staleness))
@@ -1,9 +1,11 @@
 import argparse
 parser = argparse.ArgumentParser(description='WGAN-GP')
-parser.add_argument('--dataset', type=str, required=True,
+parser.add_argument('--dataset', type=str, default=None, required=False,
                     help='path to dataset')
+parser.add_argument('--shards', type=str, default=None, required=False,
+                    help='path to a dataset packed by pack_dataset.py (used instead of --dataset)')
 parser.add_argument('--load_weights', action='store_true', default=False,
-                    help='continue training')
+                    help='continue training (with --keep_checkpoints: from the full training state of the newest checkpoint)')
 parser.add_argument('--width', type=int, default=96, required=False,
                     help='width')
 parser.add_argument('--height', type=int, default=96, required=False,
@@ -22,12 +24,61 @@ parser.add_argument('--std', type=float, default=1.0, required=False,
                     help='sampling std')
 parser.add_argument('--no_augmentation', action='store_true', default=False,
                     help='')
+parser.add_argument('--cache', type=str, default=None, required=False,
+                    help='directory of the decoded dataset cache (built on first use, rebuilt when the dataset changes)')
+parser.add_argument('--manifest', type=str, default=None, required=False,
+                    help='file listing of the dataset (.npz), written once and updated incrementally')
+parser.add_argument('--uint8_feed', action='store_true', default=False,
+                    help='feed uint8 batches, normalize and augment inside the TF graph')
+parser.add_argument('--balance', type=str, default=None, required=False,
+                    help='draw class-balanced batches: uniform/sqrt/frequency')
+parser.add_argument('--decoder', type=str, default='skimage', required=False,
+                    help='image decoder: skimage/pil (pil decodes large JPEGs at reduced size)')
+parser.add_argument('--checkpoint_iteration', type=int, default=0, required=False,
+                    help='also save models + data cursor every n iterations (0: only at the end of an epoch)')
+parser.add_argument('--workers', type=int, default=4, required=False,
+                    help='data loading / augmentation workers (0: load on the training thread)')
+parser.add_argument('--prefetch', type=int, default=8, required=False,
+                    help='max. number of batches loaded ahead')
+parser.add_argument('--processes', action='store_true', default=False,
+                    help='use worker processes instead of threads')
+parser.add_argument('--fused', action='store_true', default=False,
+                    help='run the D_ITER critic updates and the generator update in one session call')
+parser.add_argument('--batched_critic', action='store_true', default=False,
+                    help='score real, generated and interpolated samples in one discriminator pass')
+parser.add_argument('--gp_interval', type=int, default=1, required=False,
+                    help='lazy gradient penalty: compute it every n critic steps (weighted by n)')
+parser.add_argument('--gp_batch_fraction', type=float, default=1.0, required=False,
+                    help='compute the gradient penalty on this fraction of the batch')
+parser.add_argument('--fake_pool', type=int, default=0, required=False,
+                    help='critic steps take generated samples from a pool of this size (0: generate per step)')
+parser.add_argument('--fake_refresh', type=int, default=0, required=False,
+                    help='samples regenerated after each generator update (0: the whole pool)')
+parser.add_argument('--ema', type=float, default=0, required=False,
+                    help='keep a moving average of the generator with this decay, e.g. 0.999: previewed and saved as generator_ema.h5 (0: off)')
+parser.add_argument('--joint_classifier', action='store_true', default=False,
+                    help='critic and classifier update of a batch in one call (the classifier pass over the real samples is shared)')
+parser.add_argument('--keep_checkpoints', type=int, default=0, required=False,
+                    help='write checkpoints (weights + optimizer state) to ./checkpoints in the background and keep the newest N, ./<name>.h5 at the end of each epoch (0: synchronous .h5 checkpoints)')
+parser.add_argument('--keep_best', type=int, default=0, required=False,
+                    help='also keep the N checkpoints with the lowest --best_metric')
+parser.add_argument('--best_metric', type=str, default=None, required=False,
+                    help='loss (mean since the previous checkpoint) that ranks checkpoints for --keep_best, e.g. GL')
+parser.add_argument('--accumulate', type=int, default=1, required=False,
+                    help='split every batch into n micro-batches and apply their accumulated gradients once (memory of batch_size / n)')
 args = parser.parse_args()
+assert (args.dataset is None) != (args.shards is None), 'give either --dataset or --shards'
+assert args.accumulate == 1 or not args.fused, '--accumulate does not apply to --fused steps'
+assert args.fake_pool == 0 or not args.fused, '--fake_pool does not apply to --fused steps'
+assert 1 <= args.accumulate <= args.batch_size, '--accumulate has to be between 1 and --batch_size'
+assert args.accumulate == 1 or not args.joint_classifier, '--accumulate does not apply to --joint_classifier steps'
 
 import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 import tensorflow as tf
+if args.fused or args.joint_classifier: # the fused / joint updates read weights written earlier in the same session call
+    tf.enable_resource_variables()
 config = tf.ConfigProto()
 config.gpu_options.allow_growth = True
 session = tf.Session(config=config)
@@ -37,6 +88,8 @@ K.set_session(session)
 from keras.models import *
 from tools import *
 from models import wgangp_conditional
+from trainer import Trainer, acwgan_step
+from checkpoints import checkpoint_manager
 from keras.datasets import mnist
 from keras.callbacks import TensorBoard
 from keras.callbacks import Callback
@@ -51,56 +104,23 @@ w, h, c = args.width, args.height, args.channels
 latent_dim = args.z_dim
 D_ITER = 5
 
-train_generator = data_generator(args.dataset, height=h, width=w, channel=c, shuffle=True, normalize=not use_data_augmentation, save_tags=True)
+if args.shards is not None:
+    train_generator = shard_generator(args.shards, height=h, width=w, channel=c, shuffle=True, normalize=not (use_data_augmentation or args.uint8_feed), save_tags=True, decoder=args.decoder)
+else:
+    train_generator = data_generator(args.dataset, height=h, width=w, channel=c, shuffle=True, normalize=not (use_data_augmentation or args.uint8_feed), save_tags=True, cache_path=args.cache, manifest_path=args.manifest, decoder=args.decoder)
+if args.balance is not None:
+    train_generator = balanced_generator(train_generator, distribution=args.balance, batch_size=BS)
 N_CLASS = len(train_generator.tags)
 print('This dataset has %d unique tags'%N_CLASS)
-generator_model, discriminator_model, classifier_model, generator, discriminator, classifier = wgangp_conditional(h=h, w=w, c=c, latent_dim=latent_dim, condition_dim=N_CLASS, epsilon_std=args.std, dropout_rate=0.2)
+generator_model, discriminator_model, classifier_model, generator, discriminator, classifier = wgangp_conditional(h=h, w=w, c=c, latent_dim=latent_dim, condition_dim=N_CLASS, epsilon_std=args.std, dropout_rate=0.2, uint8_input=args.uint8_feed, augment=use_data_augmentation, fused_critic_steps=D_ITER if args.fused else 0, batched_critic=args.batched_critic, gp_interval=args.gp_interval, gp_batch_fraction=args.gp_batch_fraction, reuse_fakes=args.fake_pool > 0, joint_classifier=args.joint_classifier, ema_decay=args.ema)
 
 seq = get_imgaug()
-
+checkpointer = checkpoint_manager('./checkpoints', keep_last=args.keep_checkpoints, keep_best=args.keep_best, metric=args.best_metric) if args.keep_checkpoints > 0 else None
+trainer = Trainer(acwgan_step((generator_model, discriminator_model, classifier_model, generator, discriminator, classifier), latent_dim=latent_dim, num_classes=N_CLASS, std=args.std, d_iter=D_ITER, pool_size=args.fake_pool, pool_refresh=args.fake_refresh, accumulation=args.accumulate),
+                  train_generator, augmenter=seq if use_data_augmentation and not args.uint8_feed else None,
+                  workers=args.workers, queue_size=args.prefetch, use_processes=args.processes,
+                  preview_iteration=args.preview_iteration, checkpoint_iteration=args.checkpoint_iteration,
+                  checkpointer=checkpointer)
 if args.load_weights:
-    generator.load_weights('./generator.h5')
-    discriminator.load_weights('./discriminator.h5')
-    classifier.load_weights('./classifier.h5')
-
-if not os.path.exists('./preview'):
-    os.makedirs('./preview')
-    
-def make_some_noise():
-    noise = np.random.normal(0, args.std, (BS, latent_dim)).astype(np.float32)
-    condition = keras.utils.to_categorical(np.random.randint(N_CLASS, size=(BS,)), N_CLASS)
-    z = np.append(noise, condition, axis=-1)
-    return z, condition
-
-i_counter = 0
-DL, CL, GL = 0, 0, 0
-for epoch in range(EPOCHS):
-    print("Epoch: %d / %d"%(epoch+1, EPOCHS))
-    train_generator.random_shuffle()
-    with tqdm(total=len(train_generator)) as t:
-        for i in range(len(train_generator)):
-            image_batch, image_label = train_generator.__getitem__(i)
-            if use_data_augmentation:
-                image_batch = seq.augment_images(image_batch)
-                image_batch = (image_batch.astype(np.float32) - 127.5) / 127.5
-            
-            z, condition = make_some_noise()
-            DL += np.mean(discriminator_model.train_on_batch([image_batch, z], None))
-            CL += np.mean(classifier_model.train_on_batch(image_batch, image_label))
-            
-            if (i_counter+1) % D_ITER == 0:
-                z, condition = make_some_noise()
-                # CL += np.mean(classifier_model.train_on_batch(image_batch, image_label)) * D_ITER
-                GL += np.mean(generator_model.train_on_batch(z, condition)) * D_ITER
-            
-            if i_counter % args.preview_iteration == 0:
-                generate_images_cgan(generator, './preview', h, w, c, latent_dim, args.std, 5, N_CLASS, i_counter+1)
-            i_counter += 1
-            
-            msg = 'DL: {:.2f}, CL: {:.2f}, GL: {:.2f}'.format(DL/i_counter, CL/i_counter, GL/i_counter) # running mean
-            t.set_description(msg)
-            t.update()
-            
-    generator.save('./generator.h5')
-    discriminator.save('./discriminator.h5')
-    classifier.save('./classifier.h5')
+    trainer.restore()
+trainer.fit(EPOCHS)
@@ -1,7 +1,11 @@
 import argparse
 parser = argparse.ArgumentParser(description='WGAN-GP')
-parser.add_argument('--dataset', type=str, required=True,
+parser.add_argument('--dataset', type=str, default=None, required=False,
                     help='path to dataset')
+parser.add_argument('--shards', type=str, default=None, required=False,
+                    help='path to a dataset packed by pack_dataset.py (used instead of --dataset)')
+parser.add_argument('--load_weights', action='store_true', default=False,
+                    help='continue training (with --keep_checkpoints: from the full training state of the newest checkpoint)')
 parser.add_argument('--width', type=int, default=96, required=False,
                     help='width')
 parser.add_argument('--height', type=int, default=96, required=False,
@@ -18,9 +22,34 @@ parser.add_argument('--preview_iteration', type=int, default=500, required=False
                     help='preview_iteration')
 parser.add_argument('--no_augmentation', action='store_true', default=False,
                     help='')
+parser.add_argument('--cache', type=str, default=None, required=False,
+                    help='directory of the decoded dataset cache (built on first use, rebuilt when the dataset changes)')
+parser.add_argument('--manifest', type=str, default=None, required=False,
+                    help='file listing of the dataset (.npz), written once and updated incrementally')
 parser.add_argument('--mode', type=str, default='l1', required=False,
                     help='l1/l2/bce')
+parser.add_argument('--balance', type=str, default=None, required=False,
+                    help='draw class-balanced batches: uniform/sqrt/frequency')
+parser.add_argument('--decoder', type=str, default='skimage', required=False,
+                    help='image decoder: skimage/pil (pil decodes large JPEGs at reduced size)')
+parser.add_argument('--workers', type=int, default=4, required=False,
+                    help='data loading / augmentation workers (0: load on the training thread)')
+parser.add_argument('--prefetch', type=int, default=8, required=False,
+                    help='max. number of batches loaded ahead')
+parser.add_argument('--processes', action='store_true', default=False,
+                    help='use worker processes instead of threads')
+parser.add_argument('--fused', action='store_true', default=False,
+                    help='all four CVAEGAN updates in one session call')
+parser.add_argument('--low_memory', action='store_true', default=False,
+                    help='condition the encoder with a per-channel bias and use segment sums in the class feature matching (for many classes)')
+parser.add_argument('--keep_checkpoints', type=int, default=0, required=False,
+                    help='write checkpoints (weights + optimizer state) to ./checkpoints in the background and keep the newest N, ./<name>.h5 at the end of each epoch (0: synchronous .h5 checkpoints)')
+parser.add_argument('--keep_best', type=int, default=0, required=False,
+                    help='also keep the N checkpoints with the lowest --best_metric')
+parser.add_argument('--best_metric', type=str, default=None, required=False,
+                    help='loss (mean since the previous checkpoint) that ranks checkpoints for --keep_best, e.g. GL')
 args = parser.parse_args()
+assert (args.dataset is None) != (args.shards is None), 'give either --dataset or --shards'
 
 import numpy as np
 from PIL import Image
@@ -35,6 +64,8 @@ K.set_session(session)
 from keras.models import *
 from tools import *
 from cvaegan import CVAEGAN
+from trainer import Trainer, cvaegan_step
+from checkpoints import checkpoint_manager
 from skimage.io import imsave
 from tqdm import tqdm
 
@@ -46,38 +77,22 @@ w, h, c = args.width, args.height, args.channels
 latent_dim = args.z_dim
 D_ITER = 5
 
-train_generator = data_generator(args.dataset, height=h, width=w, channel=c, shuffle=True, normalize=not use_data_augmentation, save_tags=True, batch_size=BS)
+if args.shards is not None:
+    train_generator = shard_generator(args.shards, height=h, width=w, channel=c, shuffle=True, normalize=not use_data_augmentation, save_tags=True, batch_size=BS, decoder=args.decoder)
+else:
+    train_generator = data_generator(args.dataset, height=h, width=w, channel=c, shuffle=True, normalize=not use_data_augmentation, save_tags=True, batch_size=BS, cache_path=args.cache, manifest_path=args.manifest, decoder=args.decoder)
+if args.balance is not None:
+    train_generator = balanced_generator(train_generator, distribution=args.balance, batch_size=BS)
 N_CLASS = len(train_generator.tags)
 print('This dataset has %d unique tags'%N_CLASS)
 
 seq = get_imgaug()
-
-if not os.path.exists('./preview'):
-    os.makedirs('./preview')
-
-trainer = CVAEGAN(input_shape=(h, w, c), num_attrs=N_CLASS, z_dims=latent_dim, reconstruct_loss=args.mode)  
-generator = trainer.return_models()[1]
-
-i_counter = 0
-for epoch in range(EPOCHS):
-    print("Epoch: %d / %d"%(epoch+1, EPOCHS))
-    train_generator.random_shuffle()
-    with tqdm(total=len(train_generator)) as t:
-        for i in range(len(train_generator)):
-            image_batch, image_label = train_generator.__getitem__(i)
-            if use_data_augmentation:
-                image_batch = seq.augment_images(image_batch)
-                image_batch = (image_batch.astype(np.float32) - 127.5) / 127.5
-            
-            losses = trainer.train_on_batch((image_batch, image_label))
-            
-            if i_counter % args.preview_iteration == 0:
-                generate_images_cvaegan(generator, './preview', h, w, c, latent_dim, 5, N_CLASS, i_counter)
-                trainer.save_models('./weights', i_counter)
-            i_counter += 1
-            
-            msg = 'g_loss: {:.2f}, d_loss: {:.2f}, c_loss: {:.2f}, e_loss: {:.2f}'.format(losses['g_loss'], losses['d_loss'], losses['c_loss'], losses['e_loss'])
-            t.set_description(msg)
-            t.update()
-            
-    trainer.save_models('./weights_epoch', epoch)
+model = CVAEGAN(input_shape=(h, w, c), num_attrs=N_CLASS, z_dims=latent_dim, reconstruct_loss=args.mode, fused=args.fused, low_memory=args.low_memory)
+checkpointer = checkpoint_manager('./checkpoints', keep_last=args.keep_checkpoints, keep_best=args.keep_best, metric=args.best_metric) if args.keep_checkpoints > 0 else None
+trainer = Trainer(cvaegan_step(model), train_generator, augmenter=seq if use_data_augmentation else None,
+                  workers=args.workers, queue_size=args.prefetch, use_processes=args.processes,
+                  preview_iteration=args.preview_iteration, checkpoint_path='./weights_epoch',
+                  checkpointer=checkpointer)
+if args.load_weights:
+    trainer.restore()
+trainer.fit(EPOCHS)
@@ -6,6 +6,10 @@ parser.add_argument('--epochs', type=int, default=1000, required=False,
                     help='epochs')
 parser.add_argument('--preview_iteration', type=int, default=500, required=False,
                     help='preview_iteration')
+parser.add_argument('--fused', action='store_true', default=False,
+                    help='all four CVAEGAN updates in one session call')
+parser.add_argument('--low_memory', action='store_true', default=False,
+                    help='condition the encoder with a per-channel bias and use segment sums in the class feature matching (for many classes)')
 args = parser.parse_args()
 
 import numpy as np
@@ -22,8 +26,8 @@ from keras.models import *
 from keras.datasets import mnist
 from tools import *
 from cvaegan import CVAEGAN
+from trainer import Trainer, cvaegan_step
 from skimage.io import imsave
-from sklearn.utils import shuffle as skshuffle
 from tqdm import tqdm
 
 BS = args.batch_size
@@ -38,32 +42,7 @@ x_train = np.pad(x_train, ((0,0),(2,2),(2,2)), 'constant', constant_values=-1)[.
 y_train = keras.utils.to_categorical(y_train, 10)
 N_CLASS = 10
 
-if not os.path.exists('./preview'):
-    os.makedirs('./preview')
-
-trainer = CVAEGAN(input_shape=(h, w, c), num_attrs=N_CLASS, z_dims=latent_dim, reconstruct_loss='bce')  
-generator = trainer.return_models()[1]
-
-i_counter = 0
-for epoch in range(EPOCHS):
-    print("Epoch: %d / %d"%(epoch+1, EPOCHS))
-    x_train, y_train = skshuffle(x_train, y_train)
-    with tqdm(total=int(np.ceil(float(len(x_train)) / BS))) as t:
-        for i in range(0, len(x_train), BS):
-            r_bound = min(len(x_train), i+BS)
-            l_bound = r_bound - BS
-            image_batch = x_train[l_bound:r_bound]
-            image_label = y_train[l_bound:r_bound]
-            
-            losses = trainer.train_on_batch((image_batch, image_label))
-            
-            if i_counter % args.preview_iteration == 0:
-                generate_images_cvaegan(generator, './preview', h, w, c, latent_dim, 5, N_CLASS, i_counter)
-                trainer.save_models('./weights', i_counter)
-            i_counter += 1
-            
-            msg = 'g_loss: {:.2f}, d_loss: {:.2f}, c_loss: {:.2f}, e_loss: {:.2f}'.format(losses['g_loss'], losses['d_loss'], losses['c_loss'], losses['e_loss'])
-            t.set_description(msg)
-            t.update()
-            
-    trainer.save_models('./weights_epoch', epoch)
+train_generator = array_generator(x_train, y_train, batch_size=BS)
+model = CVAEGAN(input_shape=(h, w, c), num_attrs=N_CLASS, z_dims=latent_dim, reconstruct_loss='bce', fused=args.fused, low_memory=args.low_memory)
+trainer = Trainer(cvaegan_step(model), train_generator, preview_iteration=args.preview_iteration, checkpoint_path='./weights_epoch')
+trainer.fit(EPOCHS)
@@ -0,0 +1,53 @@
+import argparse
+parser = argparse.ArgumentParser(description='Data-parallel WGAN-GP on the CPU cores of one host')
+parser.add_argument('--dataset', type=str, default='mnist', required=False,
+                    help='path to dataset, or mnist / fashion_mnist (32x32x1)')
+parser.add_argument('--cache', type=str, default=None, required=False,
+                    help='directory of the decoded dataset cache (built once here, before the workers start)')
+parser.add_argument('--width', type=int, default=96, required=False,
+                    help='width')
+parser.add_argument('--height', type=int, default=96, required=False,
+                    help='height')
+parser.add_argument('--channels', type=int, default=3, required=False,
+                    help='channels')
+parser.add_argument('--z_dim', type=int, default=100, required=False,
+                    help='latent dimension')
+parser.add_argument('--batch_size', type=int, default=32, required=False,
+                    help='batch size (split over the workers)')
+parser.add_argument('--epochs', type=int, default=1000, required=False,
+                    help='epochs')
+parser.add_argument('--std', type=float, default=1.0, required=False,
+                    help='sampling std')
+parser.add_argument('--conditional', action='store_true', default=False,
+                    help='train wgangp_conditional on the labels of the dataset instead of build_gan')
+parser.add_argument('--batched_critic', action='store_true', default=False,
+                    help='score real, generated and interpolated samples in one discriminator pass')
+parser.add_argument('--workers', type=int, default=4, required=False,
+                    help='worker processes, each with a replica of the models')
+parser.add_argument('--threads', type=int, default=0, required=False,
+                    help='TF threads per worker (0: cores / workers)')
+parser.add_argument('--preview_iteration', type=int, default=500, required=False,
+                    help='preview_iteration')
+parser.add_argument('--seed', type=int, default=0, required=False,
+                    help='seed of the batch order')
+args = parser.parse_args()
+
+# the workers are spawned: they import this script again, without running it
+if __name__ == '__main__':
+    import os
+    from parallel import make_data, run
+
+    if args.dataset in ('mnist', 'fashion_mnist'):
+        h, w, c = 32, 32, 1
+    else:
+        h, w, c = args.height, args.width, args.channels
+    config = {'model': {'h': h, 'w': w, 'c': c, 'latent_dim': args.z_dim, 'epsilon_std': args.std, 'dropout_rate': 0.2, 'batched_critic': args.batched_critic},
+              'data': {'source': args.dataset, 'seed': args.seed, 'cache': args.cache},
+              'conditional': 0, 'batch_size': args.batch_size, 'epochs': args.epochs, 'd_iter': 5, 'threads': args.threads,
+              'preview_path': './preview', 'preview_iteration': args.preview_iteration, 'output': './generator.h5'}
+    if not os.path.exists('./preview'):
+        os.makedirs('./preview')
+    data = make_data(config) # builds the dataset cache once, before the workers read it
+    if args.conditional:
+        config['conditional'] = data.y.shape[-1] if hasattr(data, 'y') else len(data.tags)
+    print('Time per worker: ' + ', '.join('%s: %.1fs'%(k, v) for k, v in sorted(run(config, args.workers).items())))
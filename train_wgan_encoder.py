@@ -1,9 +1,13 @@
 import argparse
 parser = argparse.ArgumentParser(description='WGAN-GP')
-parser.add_argument('--dataset', type=str, required=True,
+parser.add_argument('--dataset', type=str, default=None, required=False,
                     help='path to dataset')
+parser.add_argument('--shards', type=str, default=None, required=False,
+                    help='path to a dataset packed by pack_dataset.py (used instead of --dataset)')
 parser.add_argument('--decoder', type=str, required=True,
                     help='path to decoder')
+parser.add_argument('--load_weights', action='store_true', default=False,
+                    help='continue training from ./encoder.h5 and the saved data cursor')
 parser.add_argument('--batch_size', type=int, default=32, required=False,
                     help='batch size')
 parser.add_argument('--epochs', type=int, default=1000, required=False,
@@ -14,7 +18,20 @@ parser.add_argument('--std', type=float, default=1.0, required=False,
                     help='sampling std')
 parser.add_argument('--no_augmentation', action='store_true', default=False,
                     help='')
+parser.add_argument('--cache', type=str, default=None, required=False,
+                    help='directory of the decoded dataset cache (built on first use, rebuilt when the dataset changes)')
+parser.add_argument('--manifest', type=str, default=None, required=False,
+                    help='file listing of the dataset (.npz), written once and updated incrementally')
+parser.add_argument('--image_decoder', type=str, default='skimage', required=False,
+                    help='image decoder: skimage/pil (pil decodes large JPEGs at reduced size)')
+parser.add_argument('--workers', type=int, default=4, required=False,
+                    help='data loading / augmentation workers (0: load on the training thread)')
+parser.add_argument('--prefetch', type=int, default=8, required=False,
+                    help='max. number of batches loaded ahead')
+parser.add_argument('--processes', action='store_true', default=False,
+                    help='use worker processes instead of threads')
 args = parser.parse_args()
+assert (args.dataset is None) != (args.shards is None), 'give either --dataset or --shards'
 
 import numpy as np
 from PIL import Image
@@ -29,6 +46,7 @@ K.set_session(session)
 from keras.models import *
 from tools import *
 from models import make_encoder, up_bilinear
+from trainer import Trainer, encoder_step
 from pixel_shuffler import PixelShuffler
 from keras.datasets import mnist
 from keras.callbacks import TensorBoard
@@ -48,41 +66,18 @@ EPOCHS = args.epochs
 h, w, c = decoder.output_shape[-3:]
 latent_dim = decoder.input_shape[-1]
 
-train_generator = data_generator(args.dataset, height=h, width=w, channel=c, batch_size=BS, shuffle=True, normalize=not use_data_augmentation, save_tags=False)
+if args.shards is not None:
+    train_generator = shard_generator(args.shards, height=h, width=w, channel=c, batch_size=BS, shuffle=True, normalize=not use_data_augmentation, save_tags=False, decoder=args.image_decoder)
+else:
+    train_generator = data_generator(args.dataset, height=h, width=w, channel=c, batch_size=BS, shuffle=True, normalize=not use_data_augmentation, save_tags=False, cache_path=args.cache, manifest_path=args.manifest, decoder=args.image_decoder)
 
 encoder_model, encoder = make_encoder(decoder)
 
 seq = get_imgaug()
-
-if not os.path.exists('./preview'):
-    os.makedirs('./preview')
-    
-def make_some_noise():
-    return np.random.normal(0, args.std, (BS, latent_dim)).astype(np.float32)
-
-i_counter = 0
-AE = 0
-for epoch in range(EPOCHS):
-    print("Epoch: %d / %d"%(epoch+1, EPOCHS))
-    train_generator.random_shuffle()
-    with tqdm(total=len(train_generator)) as t:
-        for i in range(len(train_generator)):
-            image_batch, _ = train_generator.__getitem__(i)
-            if use_data_augmentation:
-                image_batch = seq.augment_images(image_batch)
-                image_batch = (image_batch.astype(np.float32) - 127.5) / 127.5
-            
-            z = make_some_noise()
-            AE += np.mean(encoder_model.train_on_batch([image_batch, z], None))
-            
-            if i_counter % args.preview_iteration == 0:
-                img = decoder.predict(encoder.predict(image_batch[0:1]))[0]
-                img = np.append(img, image_batch[0], axis=1)
-                imsave('./preview/ite_{:d}.jpg'.format(i_counter), np.squeeze(img))
-            i_counter += 1
-            
-            msg = 'loss: {:.2f}'.format(AE / i_counter)
-            t.set_description(msg)
-            t.update()
-            
-    encoder.save('./encoder.h5')
+trainer = Trainer(encoder_step((encoder_model, encoder), decoder, latent_dim=latent_dim, std=args.std),
+                  train_generator, augmenter=seq if use_data_augmentation else None,
+                  workers=args.workers, queue_size=args.prefetch, use_processes=args.processes,
+                  preview_iteration=args.preview_iteration)
+if args.load_weights:
+    trainer.restore()
+trainer.fit(EPOCHS)
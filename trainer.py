@@ -0,0 +1,503 @@
+import os
+import time
+import random
+import collections
+import contextlib
+import numpy as np
+from keras import backend as K
+from keras.utils import to_categorical
+from skimage.io import imsave
+from tqdm import tqdm
+from tools import prefetch_loader, save_cursor, load_cursor, preview_writer, match_resolution, generate_images, generate_images_cgan, generate_images_cvaegan
+from models import progressive_gan, gradient_accumulator
+
+class phase_timer(object):
+    """
+    Accumulates wall-clock seconds per training phase:
+        with timer('critic'):
+            ...
+    """
+    phases = ('data', 'critic', 'generator', 'preview', 'checkpoint')
+    def __init__(self):
+        self.reset()
+    def reset(self):
+        self.totals = collections.OrderedDict((p, 0.0) for p in self.phases)
+        self.counts = collections.OrderedDict((p, 0) for p in self.phases)
+    @contextlib.contextmanager
+    def __call__(self, phase):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.add(phase, time.time() - t0)
+    def add(self, phase, seconds):
+        self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+        self.counts[phase] = self.counts.get(phase, 0) + 1
+    def summary(self):
+        total = max(sum(self.totals.values()), 1e-9)
+        return ', '.join('%s: %.1fs (%.0f%%)'%(p, t, 100.*t/total) for p, t in self.totals.items() if self.counts[p] > 0)
+
+class fake_pool(object):
+    """
+    Generated samples for the critic steps between two generator updates (build_gan / wgangp_conditional with reuse_fakes=True).
+    After every generator update refresh() generates refresh_size samples in one forward pass, they replace the oldest samples
+    of a ring buffer of pool_size. sample(n) draws a critic batch from the buffer (without replacement).
+    refresh_size == pool_size: the critic only sees samples of the current generator (one block per generator update).
+    refresh_size <  pool_size: a replay pool that also keeps samples of the last pool_size / refresh_size generators.
+    """
+    def __init__(self, generator, make_some_noise, pool_size, refresh_size=None):
+        self.generate = K.function(generator.inputs + [K.learning_phase()], generator.outputs) # dropout on, as in the critic's own generator pass
+        self.make_some_noise = make_some_noise
+        self.pool_size = pool_size
+        self.refresh_size = pool_size if not refresh_size else min(refresh_size, pool_size)
+        self.samples = np.zeros((pool_size,) + tuple(generator.output_shape[1:]), dtype=np.float32)
+        self.filled = 0
+        self.head = 0
+    def refresh(self):
+        generated = self.generate([self.make_some_noise(self.refresh_size), 1])[0]
+        self.samples[(self.head + np.arange(self.refresh_size)) % self.pool_size] = generated
+        self.head = (self.head + self.refresh_size) % self.pool_size
+        self.filled = min(self.pool_size, self.filled + self.refresh_size)
+    def get_state(self):
+        return {'samples': self.samples[:self.filled].copy(), 'filled': self.filled, 'head': self.head}
+    def set_state(self, state):
+        self.samples[:state['filled']] = state['samples']
+        self.filled, self.head = state['filled'], state['head']
+    def sample(self, n):
+        if self.filled == 0:
+            self.refresh()
+        return self.samples[np.random.choice(self.filled, n, replace=n > self.filled)]
+
+class gan_step(object):
+    """
+    Adapts a model bundle from models.py / cvaegan.py to the Trainer:
+    train_critic(x, y) runs every iteration, train_generator(x, y) every d_iter-th iteration,
+    both return a dict of losses. models() lists the networks saved by a checkpoint, trainers() the compiled
+    models whose optimizer state a checkpoint_manager keeps as well, get_state() / set_state() the host-side state
+    of the adapter (the state_attributes and the fake_pool) a resumed run continues from.
+    """
+    d_iter = 1
+    pool = None
+    preview_weights = True # previews also save the generator (off when a checkpoint_manager keeps the weights)
+    preview_seed = 0 # the same latent grid at every preview
+    writer = None # tools.preview_writer: previews are encoded and written off the training thread
+    state_attributes = ('critic_steps', 'batches', 'GL')
+    accumulation = 1 # > 1: every update from this many micro-batches of the batch (gradient_accumulator)
+    def critic_model(self):
+        # with a fake_pool the critic takes generated samples (discriminator_model.on_samples) instead of noise
+        model = self.discriminator_model if self.pool is None else self.discriminator_model.on_samples
+        # gp_interval > 1 (lazy gradient penalty): the penalized critic every gp_interval-th step, model.no_penalty otherwise
+        gp_interval = getattr(model, 'gp_interval', 1)
+        self.critic_steps += 1
+        if gp_interval > 1 and (self.critic_steps-1) % gp_interval != 0:
+            return model.no_penalty
+        return model
+    def critic_input(self, n):
+        # noise for the critic's generator pass, or generated samples from the pool
+        return self.make_some_noise(n) if self.pool is None else self.pool.sample(n)
+    def train_model(self, model, inputs, targets=None):
+        # np.mean(model.train_on_batch(inputs, targets)), or one update from accumulation micro-batches fed one after the other
+        if self.accumulation == 1:
+            return np.mean(model.train_on_batch(inputs, targets))
+        if not hasattr(model, 'accumulator'):
+            model.accumulator = gradient_accumulator(model)
+        accumulate, apply = model.accumulator
+        arrays = (inputs if isinstance(inputs, list) else [inputs]) + ([] if targets is None else [targets])
+        n = len(arrays[0])
+        loss = 0.
+        for ids in np.array_split(np.arange(n), min(self.accumulation, n)): # no empty micro-batches in a short batch
+            micro = [a[ids[0]:ids[-1]+1] for a in arrays]
+            loss += len(ids) * accumulate(micro + [np.ones(len(ids), dtype=np.float32)] * len(model._feed_sample_weights) + [1])[0]
+        apply([])
+        return loss / n
+    def train_critic(self, x_batch, y_batch):
+        return {}
+    def train_generator(self, x_batch, y_batch):
+        return {}
+    def set_iteration(self, iteration):
+        # resuming from .h5 files without a step state: the position in the run is the Trainer's iteration
+        pass
+    def preview(self, path, iteration, x_batch):
+        pass
+    def models(self):
+        return collections.OrderedDict()
+    def trainers(self):
+        return collections.OrderedDict()
+    def get_state(self):
+        state = dict((k, getattr(self, k)) for k in self.state_attributes if hasattr(self, k))
+        if self.pool is not None:
+            state['pool'] = self.pool.get_state()
+        return state
+    def set_state(self, state):
+        for k, v in state.items():
+            if k == 'pool':
+                self.pool.set_state(v)
+            else:
+                setattr(self, k, v)
+    def save(self, path, epoch):
+        for name, model in self.models().items():
+            model.save(os.path.join(path, name+'.h5'))
+    def load(self, path):
+        missing = []
+        for name, model in self.models().items():
+            filename = os.path.join(path, name+'.h5')
+            if hasattr(model, 'reset') and not os.path.exists(filename): # a generator_ema the run was trained without
+                missing.append(model)
+                continue
+            model.load_weights(filename)
+        for model in missing: # starts at the loaded generator
+            model.reset()
+
+class wgan_step(gan_step):
+    """ build_gan(...) -> (generator_model, discriminator_model, decoder, discriminator) """
+    def __init__(self, bundle, latent_dim, std=1.0, d_iter=5, pool_size=0, pool_refresh=None, accumulation=1):
+        self.generator_model, self.discriminator_model, self.decoder, self.discriminator = bundle
+        self.latent_dim = latent_dim
+        self.std = std
+        self.d_iter = d_iter
+        self.accumulation = accumulation
+        self.h, self.w, self.c = self.decoder.output_shape[-3:]
+        self.fused = getattr(self.discriminator_model, 'fused', None) # build_gan(fused_critic_steps=d_iter)
+        self.ema = getattr(self.generator_model, 'ema', None) # build_gan(ema_decay > 0): previewed and saved as decoder_ema
+        self.batches = []
+        self.critic_steps = 0
+        if pool_size > 0: # build_gan(reuse_fakes=True)
+            self.pool = fake_pool(self.decoder, self.make_some_noise, pool_size, pool_refresh)
+    def make_some_noise(self, n):
+        return np.random.normal(0, self.std, (n, self.latent_dim)).astype(np.float32)
+    def train_critic(self, x_batch, y_batch):
+        if self.fused is not None: # collect d_iter batches, then all critic updates + the generator update in one call
+            self.batches.append(x_batch)
+            if len(self.batches) < self.d_iter:
+                return {}
+            DL, self.GL = self.fused([np.stack(self.batches), 1])
+            self.batches = []
+            return {'DL': np.mean(DL)}
+        return {'DL': self.train_model(self.critic_model(), [x_batch, self.critic_input(len(x_batch))])}
+    def train_generator(self, x_batch, y_batch):
+        if self.fused is not None:
+            return {'GL': self.GL}
+        GL = self.train_model(self.generator_model, self.make_some_noise(len(x_batch)))
+        if self.pool is not None: # samples of the updated generator for the next critic steps
+            self.pool.refresh()
+        return {'GL': GL}
+    def preview(self, path, iteration, x_batch):
+        generate_images(self.decoder if self.ema is None else self.ema, path, self.h, self.w, self.c, self.latent_dim, self.std, 15, 15, iteration, len(x_batch), self.preview_weights, self.preview_seed, self.writer)
+    def models(self):
+        models = collections.OrderedDict([('decoder', self.decoder), ('discriminator', self.discriminator)])
+        if self.ema is not None:
+            models['decoder_ema'] = self.ema
+        return models
+    def trainers(self):
+        return collections.OrderedDict([('generator', self.generator_model), ('discriminator', self.discriminator_model)])
+
+class progressive_step(wgan_step):
+    """
+    Progressive-resolution training of the stages of models.progressive_networks:
+    level start_level for phase_iterations, then for every higher level a fade-in phase (alpha of the FadeIn layers
+    0 -> 1) and a stable phase of phase_iterations each, up to level 4 (full resolution) for the rest of the run.
+    Every phase compiles progressive_gan(networks, level, fade, **gan_kwargs), i.e. starts with new optimizers.
+    data.set_scale() (data_generator) serves batches at the resolution of the phase. Batches loaded before a phase
+    change (the batch in hand and the prefetched ones, at the lower level) or from a generator without set_scale are
+    brought to the resolution of the phase by tools.match_resolution.
+    models() are the stages, shared by all phases, trainers() the compiled models of the current phase. The phase is part of
+    the step state, a checkpoint_manager sets it before restoring (see Trainer.restore) so the optimizer state of that phase fits;
+    without one, the schedule continues from the iteration of the data cursor (set_iteration).
+    """
+    state_attributes = ('iterations', 'phase', 'level', 'critic_steps', 'batches', 'GL')
+    def __init__(self, networks, data, latent_dim, std=1.0, d_iter=5, start_level=0, phase_iterations=10000, pool_size=0, pool_refresh=None, accumulation=1, **gan_kwargs):
+        self.networks = networks
+        self.data = data
+        self.start_level = start_level
+        self.phase_iterations = phase_iterations
+        self.gan_kwargs = dict(gan_kwargs, latent_dim=latent_dim)
+        self.step_args = (latent_dim, std, d_iter, pool_size, pool_refresh, accumulation)
+        self.iterations = 0
+        self.phase = None
+        self.set_phase(0)
+    def phase_of(self, iteration):
+        # phase 0: start_level, phase 2k-1: start_level+k fading in, phase 2k: start_level+k
+        return min(iteration // self.phase_iterations, 2 * (4 - self.start_level))
+    def set_phase(self, phase):
+        self.phase = phase
+        self.level, self.fade = self.start_level + (phase+1) // 2, phase % 2 == 1
+        bundle = progressive_gan(self.networks, self.level, self.fade, **self.gan_kwargs)
+        wgan_step.__init__(self, bundle, *self.step_args)
+        if hasattr(self.data, 'set_scale'):
+            self.data.set_scale(4 - self.level)
+    def train_critic(self, x_batch, y_batch):
+        phase = self.phase_of(self.iterations)
+        if phase != self.phase:
+            self.set_phase(phase)
+        if self.fade:
+            alpha = float(self.iterations % self.phase_iterations) / self.phase_iterations
+            K.batch_set_value([(layer.alpha, alpha) for layer in self.discriminator_model.fade])
+        self.iterations += 1
+        return wgan_step.train_critic(self, match_resolution(x_batch, self.h), y_batch)
+    def set_state(self, state):
+        phase = state.get('phase', self.phase_of(state['iterations']))
+        if phase != self.phase: # before the pool state, which has the resolution of the phase
+            self.set_phase(phase)
+        wgan_step.set_state(self, state)
+    def set_iteration(self, iteration):
+        self.set_state({'iterations': iteration})
+    def models(self):
+        return collections.OrderedDict(('%s_%d'%(name, L), stage) for name, stages in sorted(self.networks.items()) for L, stage in enumerate(stages))
+
+class acwgan_step(gan_step):
+    """ wgangp_conditional(...) -> (generator_model, discriminator_model, classifier_model, generator, discriminator, classifier) """
+    def __init__(self, bundle, latent_dim, num_classes, std=1.0, d_iter=5, pool_size=0, pool_refresh=None, accumulation=1):
+        self.generator_model, self.discriminator_model, self.classifier_model, self.generator, self.discriminator, self.classifier = bundle
+        self.latent_dim = latent_dim
+        self.num_classes = num_classes
+        self.std = std
+        self.d_iter = d_iter
+        self.accumulation = accumulation
+        self.h, self.w, self.c = self.generator.output_shape[-3:]
+        self.fused = getattr(self.discriminator_model, 'fused', None) # wgangp_conditional(fused_critic_steps=d_iter)
+        self.ema = getattr(self.generator_model, 'ema', None) # wgangp_conditional(ema_decay > 0): previewed and saved as generator_ema
+        self.batches = []
+        self.critic_steps = 0
+        if pool_size > 0: # wgangp_conditional(reuse_fakes=True)
+            self.pool = fake_pool(self.generator, lambda n: self.make_some_noise(n)[0], pool_size, pool_refresh)
+    def make_some_noise(self, n):
+        noise = np.random.normal(0, self.std, (n, self.latent_dim)).astype(np.float32)
+        condition = to_categorical(np.random.randint(self.num_classes, size=(n,)), self.num_classes)
+        z = np.append(noise, condition, axis=-1)
+        return z, condition
+    def train_critic(self, x_batch, y_batch):
+        if self.fused is not None: # collect d_iter batches, then all critic / classifier updates + the generator update in one call
+            self.batches.append((x_batch, y_batch))
+            if len(self.batches) < self.d_iter:
+                return {}
+            DL, CL, self.GL = self.fused([np.stack([b[0] for b in self.batches]), np.stack([b[1] for b in self.batches]), 1])
+            self.batches = []
+            return collections.OrderedDict([('DL', np.mean(DL)), ('CL', np.mean(CL))])
+        z = self.make_some_noise(len(x_batch))[0] if self.pool is None else self.pool.sample(len(x_batch))
+        critic = self.critic_model()
+        if hasattr(critic, 'joint') and self.accumulation == 1: # wgangp_conditional(joint_classifier=True): critic + classifier update in one call
+            DL, CL = critic.joint([x_batch, z, y_batch, 1])
+            return collections.OrderedDict([('DL', DL), ('CL', CL)])
+        DL = self.train_model(critic, [x_batch, z])
+        CL = self.train_model(self.classifier_model, x_batch, y_batch)
+        return collections.OrderedDict([('DL', DL), ('CL', CL)])
+    def train_generator(self, x_batch, y_batch):
+        if self.fused is not None:
+            return {'GL': self.GL}
+        z, condition = self.make_some_noise(len(x_batch))
+        GL = self.train_model(self.generator_model, z, condition)
+        if self.pool is not None: # samples of the updated generator for the next critic steps
+            self.pool.refresh()
+        return {'GL': GL}
+    def preview(self, path, iteration, x_batch):
+        generate_images_cgan(self.generator if self.ema is None else self.ema, path, self.h, self.w, self.c, self.latent_dim, self.std, 5, self.num_classes, iteration+1, self.preview_weights, self.preview_seed, self.writer)
+    def models(self):
+        models = collections.OrderedDict([('generator', self.generator), ('discriminator', self.discriminator), ('classifier', self.classifier)])
+        if self.ema is not None:
+            models['generator_ema'] = self.ema
+        return models
+    def trainers(self):
+        return collections.OrderedDict([('generator', self.generator_model), ('discriminator', self.discriminator_model), ('classifier', self.classifier_model)])
+
+class encoder_step(gan_step):
+    """ make_encoder(decoder) -> (encoder_model, encoder), trained against the frozen decoder """
+    def __init__(self, bundle, decoder, latent_dim, std=1.0):
+        self.encoder_model, self.encoder = bundle
+        self.decoder = decoder
+        self.latent_dim = latent_dim
+        self.std = std
+    def train_generator(self, x_batch, y_batch):
+        z = np.random.normal(0, self.std, (len(x_batch), self.latent_dim)).astype(np.float32)
+        return {'loss': np.mean(self.encoder_model.train_on_batch([x_batch, z], None))}
+    def preview(self, path, iteration, x_batch):
+        img = self.decoder.predict(self.encoder.predict(x_batch[0:1]))[0]
+        img = np.append(img, x_batch[0], axis=1)
+        if self.writer is None:
+            imsave(os.path.join(path, 'ite_{:d}.jpg'.format(iteration)), np.squeeze(img))
+        else:
+            self.writer.submit(imsave, os.path.join(path, 'ite_{:d}.jpg'.format(iteration)), np.squeeze(img))
+    def models(self):
+        return collections.OrderedDict([('encoder', self.encoder)])
+    def trainers(self):
+        return collections.OrderedDict([('encoder', self.encoder_model)])
+
+class cvaegan_step(gan_step):
+    """ CVAEGAN(...): classifier + discriminator as the critic half, decoder + encoder as the generator half """
+    state_attributes = ('prior', 'generator_losses')
+    def __init__(self, model, weights_path='./weights'):
+        self.model = model
+        self.weights_path = weights_path
+        self.h, self.w, self.c = model.input_shape
+        self.prior = None
+    def train_critic(self, x_batch, y_batch):
+        self.prior = self.model.sample_prior(len(x_batch)) # shared with the generator half, as in CVAEGAN.train_on_batch
+        if self.model.fused_trainer is not None: # CVAEGAN(fused=True): all four updates here, the generator half reports them
+            losses = self.model.train_fused_on_batch((x_batch, y_batch), self.prior)
+            self.generator_losses = {k: losses.pop(k) for k in ('g_loss', 'e_loss')}
+            return collections.OrderedDict((k, np.mean(v)) for k, v in sorted(losses.items()))
+        losses = self.model.train_critic_on_batch((x_batch, y_batch), self.prior)
+        return collections.OrderedDict((k, np.mean(v)) for k, v in sorted(losses.items()))
+    def train_generator(self, x_batch, y_batch):
+        if self.model.fused_trainer is not None:
+            return collections.OrderedDict((k, np.mean(v)) for k, v in sorted(self.generator_losses.items()))
+        losses = self.model.train_generator_on_batch((x_batch, y_batch), self.prior)
+        return collections.OrderedDict((k, np.mean(v)) for k, v in sorted(losses.items()))
+    def preview(self, path, iteration, x_batch):
+        generate_images_cvaegan(self.model.f_dec, path, self.h, self.w, self.c, self.model.z_dims, 5, self.model.num_attrs, iteration, self.preview_seed, self.writer)
+        if self.preview_weights:
+            self.model.save_models(self.weights_path, iteration)
+    def models(self):
+        return collections.OrderedDict(zip(('encoder', 'decoder', 'discriminator', 'classifier'), self.model.return_models()))
+    def trainers(self):
+        return collections.OrderedDict([('encoder', self.model.enc_trainer), ('decoder', self.model.dec_trainer),
+                                        ('discriminator', self.model.dis_trainer), ('classifier', self.model.cls_trainer)])
+    def save(self, path, epoch):
+        self.model.save_models(path, epoch)
+    def load(self, path):
+        # the newest iteration_{epoch}_{name}.h5 of save_models
+        epochs = [int(name.split('_')[1]) for name in os.listdir(path) if name.startswith('iteration_') and name.endswith('_encoder.h5')] if os.path.isdir(path) else []
+        if len(epochs) == 0:
+            raise IOError('no CVAEGAN checkpoint in %s'%path)
+        for name, model in self.models().items():
+            model.load_weights(os.path.join(path, 'iteration_{:d}_{}.h5'.format(max(epochs), name)))
+
+class Trainer(object):
+    """
+    The epoch / batch loop shared by all training scripts:
+    prefetched batches (prefetch_loader) -> step.train_critic every iteration, step.train_generator every step.d_iter-th
+    -> preview every preview_iteration -> checkpoint (models + data cursor) every checkpoint_iteration and at the end of an epoch.
+    Wall-clock time of every phase is accumulated in self.timer, printed and reset at the end of an epoch.
+    callbacks: objects with optional on_step_end(trainer, logs) / on_epoch_end(trainer, epoch) methods.
+    checkpointer: a checkpoints.checkpoint_manager, used instead of step.save / step.load + cursor.json in checkpoint_path;
+    the checkpoint at the end of an epoch also exports the networks as checkpoint_path/<name>.h5.
+    async_preview: previews only run the generator on the training thread, the images are written by a preview_writer.
+    """
+    def __init__(self, step, data, augmenter=None, workers=4, queue_size=8, use_processes=False,
+                 preview_path='./preview', preview_iteration=500, checkpoint_path='.', checkpoint_iteration=0, callbacks=None,
+                 checkpointer=None, async_preview=True):
+        self.step = step
+        self.checkpointer = checkpointer
+        self.step.preview_weights = checkpointer is None
+        self.async_preview = async_preview
+        self.data = data
+        self.loader = prefetch_loader(data, augmenter=augmenter, workers=workers, queue_size=queue_size, use_processes=use_processes)
+        self.preview_path = preview_path
+        self.preview_iteration = preview_iteration
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_iteration = checkpoint_iteration
+        self.callbacks = [] if callbacks is None else callbacks
+        self.timer = phase_timer()
+        self.iteration = 0
+        self.d_counter = 0
+        self.loss_sums = collections.OrderedDict()
+        self.loss_counts = collections.OrderedDict()
+        self.window_sums = collections.OrderedDict() # losses since the previous checkpoint
+        self.window_counts = collections.OrderedDict()
+        self.window_losses = {}
+        self.start_epoch, self.start_position = 0, 0
+        for path in (preview_path, checkpoint_path):
+            if path is not None and not os.path.exists(path):
+                os.makedirs(path)
+    def cursor_path(self):
+        return os.path.join(self.checkpoint_path, 'cursor.json')
+    def restore(self):
+        if self.checkpointer is not None:
+            loop = self.checkpointer.latest_loop_state()
+            if loop is not None: # first: the step state can decide which trainers there are (the phase of progressive_step)
+                self.step.set_state(loop['step'])
+            state = self.checkpointer.restore(self.step)
+            if state is not None:
+                self.data.set_cursor(state['cursor'])
+                self.start_epoch, self.start_position = state['cursor']['epoch'], state['cursor']['position']
+                self.iteration = state['iteration']
+                self.set_loop_state(state['loop'])
+            return
+        self.step.load(self.checkpoint_path)
+        if os.path.exists(self.cursor_path()): # continue where the saved weights stopped in the data
+            cursor = load_cursor(self.cursor_path())
+            self.data.set_cursor(cursor)
+            self.start_epoch, self.start_position = cursor['epoch'], cursor['position']
+            self.iteration = self.start_epoch * len(self.data) + self.start_position
+            self.step.set_iteration(self.iteration)
+    def loop_state(self):
+        # everything besides weights, optimizer state and data cursor that the next step depends on
+        return {'d_counter': self.d_counter, 'loss_sums': self.loss_sums, 'loss_counts': self.loss_counts,
+                'window_sums': self.window_sums, 'window_counts': self.window_counts,
+                'numpy_random': np.random.get_state(), 'random': random.getstate(), 'step': self.step.get_state()}
+    def set_loop_state(self, state):
+        self.d_counter = state['d_counter']
+        self.loss_sums, self.loss_counts = state['loss_sums'], state['loss_counts']
+        self.window_sums = state.get('window_sums', collections.OrderedDict())
+        self.window_counts = state.get('window_counts', collections.OrderedDict())
+        np.random.set_state(state['numpy_random'])
+        random.setstate(state['random'])
+        self.step.set_state(state['step'])
+    def save_checkpoint(self, epoch, export=False):
+        with self.timer('checkpoint'):
+            if self.checkpointer is not None: # weights are read here, written by the checkpointer's thread
+                # keep_best ranks a checkpoint by the mean losses since the previous one, not by the running mean of the run
+                if len(self.window_counts) > 0: # (a checkpoint right after another one keeps its losses)
+                    self.window_losses = dict((k, self.window_sums[k]/self.window_counts[k]) for k in self.window_sums)
+                    self.window_sums, self.window_counts = collections.OrderedDict(), collections.OrderedDict()
+                self.checkpointer.save(self.step, self.iteration, epoch, self.data.get_cursor(), self.window_losses, self.loop_state(),
+                                       export=self.checkpoint_path if export else None)
+                return
+            self.step.save(self.checkpoint_path, epoch)
+            save_cursor(self.data, self.cursor_path())
+    def train_step(self, x_batch, y_batch):
+        logs = collections.OrderedDict()
+        with self.timer('critic'):
+            logs.update(self.step.train_critic(x_batch, y_batch))
+        self.d_counter += 1
+        if self.d_counter == self.step.d_iter:
+            with self.timer('generator'):
+                logs.update(self.step.train_generator(x_batch, y_batch))
+            self.d_counter = 0
+        for k, v in logs.items():
+            self.loss_sums[k] = self.loss_sums.get(k, 0.0) + v
+            self.loss_counts[k] = self.loss_counts.get(k, 0) + 1
+            self.window_sums[k] = self.window_sums.get(k, 0.0) + v
+            self.window_counts[k] = self.window_counts.get(k, 0) + 1
+        return logs
+    def running_losses(self):
+        return ', '.join('{}: {:.2f}'.format(k, self.loss_sums[k]/self.loss_counts[k]) for k in self.loss_sums)
+    def fit(self, epochs):
+        if self.async_preview and self.preview_path is not None:
+            self.step.writer = preview_writer()
+        try:
+            for epoch in range(self.start_epoch, epochs):
+                print("Epoch: %d / %d"%(epoch+1, epochs))
+                self.data.random_shuffle(epoch)
+                start = self.start_position if epoch==self.start_epoch else 0
+                batches = self.loader.iterate(epoch, start=start)
+                with tqdm(total=len(self.data), initial=start) as t:
+                    for i in range(start, len(self.data)):
+                        with self.timer('data'):
+                            x_batch, y_batch = next(batches)
+                        logs = self.train_step(x_batch, y_batch)
+                        if self.preview_path is not None and self.iteration % self.preview_iteration == 0:
+                            with self.timer('preview'):
+                                self.step.preview(self.preview_path, self.iteration, x_batch)
+                        self.iteration += 1
+                        self.data.position = i+1
+                        t.set_description(self.running_losses()) # running mean
+                        t.update()
+                        for callback in self.callbacks:
+                            if hasattr(callback, 'on_step_end'):
+                                callback.on_step_end(self, logs)
+                        if self.checkpoint_iteration > 0 and self.iteration % self.checkpoint_iteration == 0:
+                            self.save_checkpoint(epoch)
+                batches.close()
+                self.save_checkpoint(epoch, export=True)
+                print('Time per phase: ' + self.timer.summary())
+                for callback in self.callbacks:
+                    if hasattr(callback, 'on_epoch_end'):
+                        callback.on_epoch_end(self, epoch)
+                self.timer.reset()
+        finally:
+            self.loader.close()
+            if self.step.writer is not None:
+                self.step.writer.close()
+                self.step.writer = None
+            if self.checkpointer is not None:
+                self.checkpointer.flush()
@@ -105,7 +105,28 @@ class SGDWithWeightnorm(SGD):
 class AdamWithWeightnorm(Adam):
     def get_updates(self, params, loss):
         grads = self.get_gradients(loss, params)
-        self.updates = [K.update_add(self.iterations, 1)]
+        return self.get_updates_from_grads(params, grads)
+
+    def create_slots(self, params):
+        # created once and shared by every get_updates call, so several update steps (e.g. an unrolled
+        # multi-step update in one session call) work on the same optimizer state
+        if getattr(self, 'slots', None) is not None:
+            return self.slots
+        with tf.control_dependencies(None): # may be called under the control dependencies of a previous step
+            self.slots = []
+            for p in params:
+                ps = K.get_variable_shape(p)
+                m, v = K.zeros(ps), K.zeros(ps)
+                if len(ps)>1: # weight normalized: V_scaler and the Adam containers for the 'g' parameter
+                    V_scaler_shape = (ps[-1],)
+                    self.slots.append((m, v, K.ones(V_scaler_shape), K.zeros(V_scaler_shape), K.zeros(V_scaler_shape)))
+                else:
+                    self.slots.append((m, v))
+        self.weights = [self.iterations] + [w for slot in self.slots for w in slot]
+        return self.slots
+
+    def get_updates_from_grads(self, params, grads):
+        slots = self.create_slots(params)
 
         lr = self.lr
         if self.initial_decay > 0:
@@ -113,26 +134,19 @@ class AdamWithWeightnorm(Adam):
 
         t = K.cast(self.iterations + 1, 'float32') # eliminate tf.pow error: "TypeError: Input 'y' of 'Pow' Op has type int64 that does not match type float32 of argument 'x'."
         lr_t = lr * K.sqrt(1. - K.pow(self.beta_2, t)) / (1. - K.pow(self.beta_1, t))
+        with tf.control_dependencies([lr_t]): # read the step count before it is incremented
+            self.updates = [K.update_add(self.iterations, 1)]
 
-        shapes = [K.get_variable_shape(p) for p in params]
-        ms = [K.zeros(shape) for shape in shapes]
-        vs = [K.zeros(shape) for shape in shapes]
-        self.weights = [self.iterations] + ms + vs
-
-        for p, g, m, v in zip(params, grads, ms, vs):
+        for p, g, slot in zip(params, grads, slots):
 
             # if a weight tensor (len > 1) use weight normalized parameterization
             # this is the only part changed w.r.t. keras.optimizers.Adam
             ps = K.get_variable_shape(p)
             if len(ps)>1:
+                m, v, V_scaler, m_g, v_g = slot
 
                 # get weight normalization parameters
-                V, V_norm, V_scaler, g_param, grad_g, grad_V = get_weightnorm_params_and_grads(p, g)
-
-                # Adam containers for the 'g' parameter
-                V_scaler_shape = K.get_variable_shape(V_scaler)
-                m_g = K.zeros(V_scaler_shape)
-                v_g = K.zeros(V_scaler_shape)
+                V, V_norm, V_scaler, g_param, grad_g, grad_V = get_weightnorm_params_and_grads(p, g, V_scaler)
 
                 # update g parameters
                 m_g_t = (self.beta_1 * m_g) + (1. - self.beta_1) * grad_g
@@ -161,6 +175,7 @@ class AdamWithWeightnorm(Adam):
                 add_weightnorm_param_updates(self.updates, new_V_param, new_g_param, p, V_scaler)
 
             else: # do optimization normally
+                m, v = slot
                 m_t = (self.beta_1 * m) + (1. - self.beta_1) * g
                 v_t = (self.beta_2 * v) + (1. - self.beta_2) * K.square(g)
                 p_t = p - lr_t * m_t / (K.sqrt(v_t) + self.epsilon)
@@ -181,12 +196,13 @@ class AdamWithWeightnorm(Adam):
         return self.updates
 
 
-def get_weightnorm_params_and_grads(p, g):
+def get_weightnorm_params_and_grads(p, g, V_scaler=None):
     ps = K.get_variable_shape(p)
 
     # construct weight scaler: V_scaler = g/||V||
-    V_scaler_shape = (ps[-1],)  # assumes we're using tensorflow!
-    V_scaler = K.ones(V_scaler_shape)  # init to ones, so effective parameters don't change
+    if V_scaler is None:
+        V_scaler_shape = (ps[-1],)  # assumes we're using tensorflow!
+        V_scaler = K.ones(V_scaler_shape)  # init to ones, so effective parameters don't change
 
     # get V parameters = ||V||/g * W
     norm_axes = [i for i in range(len(ps) - 1)]
@@ -6,12 +6,31 @@ parser.add_argument('--epochs', type=int, default=50, required=False,
                     help='epochs')
 parser.add_argument('--std', type=float, default=1.0, required=False,
                     help='sampling std')
+parser.add_argument('--fused', action='store_true', default=False,
+                    help='run the D_ITER critic updates and the generator update in one session call')
+parser.add_argument('--batched_critic', action='store_true', default=False,
+                    help='score real, generated and interpolated samples in one discriminator pass')
+parser.add_argument('--gp_interval', type=int, default=1, required=False,
+                    help='lazy gradient penalty: compute it every n critic steps (weighted by n)')
+parser.add_argument('--gp_batch_fraction', type=float, default=1.0, required=False,
+                    help='compute the gradient penalty on this fraction of the batch')
+parser.add_argument('--fake_pool', type=int, default=0, required=False,
+                    help='critic steps take generated samples from a pool of this size (0: generate per step)')
+parser.add_argument('--fake_refresh', type=int, default=0, required=False,
+                    help='samples regenerated after each generator update (0: the whole pool)')
+parser.add_argument('--ema', type=float, default=0, required=False,
+                    help='keep a moving average of the generator with this decay, e.g. 0.999: previewed and saved as generator_ema.h5 (0: off)')
+parser.add_argument('--joint_classifier', action='store_true', default=False,
+                    help='critic and classifier update of a batch in one call (the classifier pass over the real samples is shared)')
 args = parser.parse_args()
+assert args.fake_pool == 0 or not args.fused, '--fake_pool does not apply to --fused steps'
 
 import numpy as np
 from PIL import Image
 import matplotlib.pyplot as plt
 import tensorflow as tf
+if args.fused or args.joint_classifier: # the fused / joint updates read weights written earlier in the same session call
+    tf.enable_resource_variables()
 config = tf.ConfigProto()
 config.gpu_options.allow_growth = True
 session = tf.Session(config=config)
@@ -21,11 +40,11 @@ K.set_session(session)
 from keras.models import *
 from tools import *
 from models import wgangp_conditional
+from trainer import Trainer, acwgan_step
 from keras.datasets import fashion_mnist as mnist
 from keras.callbacks import TensorBoard
 from keras.callbacks import Callback
 from skimage.io import imsave
-from sklearn.utils import shuffle as skshuffle
 from tqdm import tqdm
 
 BS = args.batch_size
@@ -33,51 +52,14 @@ EPOCHS = args.epochs
 w, h, c = 32, 32, 1
 latent_dim = 100
 D_ITER = 5
-generator_model, discriminator_model, classifier_model, generator, discriminator, classifier = wgangp_conditional(h=h, w=w, c=c, latent_dim=latent_dim, condition_dim=10, epsilon_std=args.std, dropout_rate=0.2)
+generator_model, discriminator_model, classifier_model, generator, discriminator, classifier = wgangp_conditional(h=h, w=w, c=c, latent_dim=latent_dim, condition_dim=10, epsilon_std=args.std, dropout_rate=0.2, fused_critic_steps=D_ITER if args.fused else 0, batched_critic=args.batched_critic, gp_interval=args.gp_interval, gp_batch_fraction=args.gp_batch_fraction, reuse_fakes=args.fake_pool > 0, joint_classifier=args.joint_classifier, ema_decay=args.ema)
 
 (x_train, y_train), (___, __) = mnist.load_data()
 x_train = np.squeeze(x_train.astype(np.float32)-127.5) / 127.5
 x_train = np.pad(x_train, ((0,0),(2,2),(2,2)), 'constant', constant_values=-1)[...,np.newaxis]
 y_train = keras.utils.to_categorical(y_train, 10)
 
-if not os.path.exists('./preview'):
-    os.makedirs('./preview')
-
-def make_some_noise():
-    noise = np.random.normal(0, args.std, (BS, latent_dim)).astype(np.float32)
-    condition = keras.utils.to_categorical(np.random.randint(10, size=(BS,)), 10)
-    z = np.append(noise, condition, axis=-1)
-    return z, condition
-
-i_counter = 0
-DL, CL, GL = 0, 0, 0
-for epoch in range(EPOCHS):
-    print("Epoch: %d / %d"%(epoch+1, EPOCHS))
-    x_train, y_train = skshuffle(x_train, y_train)
-    with tqdm(total=int(np.ceil(float(len(x_train)) / BS))) as t:
-        for i in range(0, len(x_train), BS):
-            r_bound = min(len(x_train), i+BS)
-            l_bound = r_bound - BS
-            image_batch = x_train[l_bound:r_bound]
-            image_label = y_train[l_bound:r_bound]
-            
-            z, condition = make_some_noise()
-            DL += np.mean(discriminator_model.train_on_batch([image_batch, z], None))
-            CL += np.mean(classifier_model.train_on_batch(image_batch, image_label))
-            
-            if (i_counter+1) % D_ITER == 0:
-                z, condition = make_some_noise()
-                # CL += np.mean(classifier_model.train_on_batch(image_batch, image_label)) * D_ITER
-                GL += np.mean(generator_model.train_on_batch(z, condition)) * D_ITER
-                
-            if i_counter % 500 == 0:
-                generate_images_cgan(generator, './preview', h, w, c, latent_dim, args.std, 5, 10, i_counter+1)
-            i_counter += 1
-            
-            msg = 'DL: {:.2f}, CL: {:.2f}, GL: {:.2f}'.format(DL/i_counter, CL/i_counter, GL/i_counter) # running mean
-            t.set_description(msg)
-            t.update()
-            
-    generator.save('./generator.h5')
-    discriminator.save('./discriminator.h5')
-    classifier.save('./classifier.h5')
+train_generator = array_generator(x_train, y_train, batch_size=BS)
+trainer = Trainer(acwgan_step((generator_model, discriminator_model, classifier_model, generator, discriminator, classifier), latent_dim=latent_dim, num_classes=10, std=args.std, d_iter=D_ITER, pool_size=args.fake_pool, pool_refresh=args.fake_refresh),
+                  train_generator, preview_iteration=500)
+trainer.fit(EPOCHS)